@@ -154,6 +154,11 @@ class RecordAdmin(VersionAdmin):
     _ows_resources.short_description = "OWS Resources"
 
 
+    def save_related(self, request, form, formsets, change):
+        #update the links and default styles of the record once for all the changed styles
+        with models.batch_style_import():
+            super(RecordAdmin, self).save_related(request, form, formsets, change)
+
     def get_inline_instances(self, request, obj=None):
         if obj and obj.service_type == "WMS":
             return []
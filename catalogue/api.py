@@ -1,12 +1,19 @@
 import traceback
-from rest_framework import serializers, viewsets, status, filters
-from models import Record, Style
+from collections import OrderedDict
+from rest_framework import serializers, viewsets, status, filters, pagination
+from models import Record, Style, Application, projections, schedule_records_view_refresh, batch_style_import
+from bulk import bulk_update
+from cache import bump_catalogue_generation, catalogue_etag, catalogue_last_modified
 from rest_framework.response import Response
-import base64
+from rest_framework.decorators import list_route
+from django.contrib.gis.geos import Polygon
 from django.core.files.base import ContentFile
-import md5
 import json
 from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from pycsw import util
 
 
@@ -31,30 +38,36 @@ class OwsResourceSerializer(serializers.Serializer):
         else:
             return data
 
-    def save(self, record=None):
-        if record:
-            links = []
-            if self.validated_data['gwc']:
-                gwc_endpoints = [endpoint.strip() for endpoint in self.validated_data['gwc_endpoint'].split("^") if endpoint.strip()]
-                for endpoint in gwc_endpoints:
-                    links.append(
-                        record.generate_ows_link(endpoint, 'GWC', self.validated_data['wms_version'])
-                    )
-            elif self.validated_data['wms']:
+    def generate_links(self, record):
+        """
+        Return the generated ows links and the service type version of the record
+        """
+        links = []
+        if self.validated_data['gwc']:
+            gwc_endpoints = [endpoint.strip() for endpoint in self.validated_data['gwc_endpoint'].split("^") if endpoint.strip()]
+            for endpoint in gwc_endpoints:
                 links.append(
-                    record.generate_ows_link(self.validated_data['wms_endpoint'], 'WMS', self.validated_data['wms_version'])
+                    record.generate_ows_link(endpoint, 'GWC', self.validated_data['wms_version'])
                 )
-            if self.validated_data['wfs']:
-                links.append(
-                    record.generate_ows_link(self.validated_data['wfs_endpoint'], 'WFS', self.validated_data['wfs_version'])
-                )
-            if record.service_type == "WMS":
-                record.service_type_version = self.validated_data['wms_version']
-            elif record.service_type == "WFS":
-                record.service_type_version = self.validated_data['wfs_version']
-            else:
-                record.service_type_version = ""
+        elif self.validated_data['wms']:
+            links.append(
+                record.generate_ows_link(self.validated_data['wms_endpoint'], 'WMS', self.validated_data['wms_version'])
+            )
+        if self.validated_data['wfs']:
+            links.append(
+                record.generate_ows_link(self.validated_data['wfs_endpoint'], 'WFS', self.validated_data['wfs_version'])
+            )
+        if record.service_type == "WMS":
+            service_type_version = self.validated_data['wms_version']
+        elif record.service_type == "WFS":
+            service_type_version = self.validated_data['wfs_version']
+        else:
+            service_type_version = ""
+        return links, service_type_version
 
+    def save(self, record=None):
+        if record:
+            links, record.service_type_version = self.generate_links(record)
             style_links = record.style_links
             resources = links + style_links
 
@@ -105,7 +118,8 @@ class RecordSerializer(serializers.ModelSerializer):
     tags = serializers.SerializerMethodField(read_only=True)
 
     def get_tags(self, obj):
-        return obj.tags.values("name", "description")
+        #use the prefetched tags
+        return [{"name": tag.name, "description": tag.description} for tag in obj.tags.all()]
 
     def get_ows_resource(self, obj):
         return obj.ows_resource
@@ -113,6 +127,15 @@ class RecordSerializer(serializers.ModelSerializer):
     def get_metadata_link(self, obj):
         return obj.metadata_link
 
+    #the model columns required by the fields which are not model fields
+    field_columns = {
+        'url': ['identifier'],
+        'metadata_link': ['identifier'],
+        'ows_resource': ['links', 'resource_links'],
+        'styles': [],
+        'tags': [],
+    }
+
     def __init__(self, *args, **kwargs):
         try:
             style_content = kwargs.pop("style_content")
@@ -122,6 +145,8 @@ class RecordSerializer(serializers.ModelSerializer):
             ows_serializer_method = kwargs.pop('ows')
         except:
             ows_serializer_method = 'get'
+        #only serialise the requested fields if not None
+        requested_fields = kwargs.pop("requested_fields", None)
 
         super(RecordSerializer, self).__init__(*args, **kwargs)
         self.fields['styles'] = StyleSerializer(many=True, required=False, style_content=style_content)
@@ -129,6 +154,20 @@ class RecordSerializer(serializers.ModelSerializer):
             self.fields['ows_resource'] = OwsResourceSerializer(write_only=True, required=False)
         elif ows_serializer_method == 'get':
             self.fields['ows_resource'] = serializers.SerializerMethodField(read_only=True)
+        if requested_fields is not None:
+            for name in list(self.fields.keys()):
+                if name not in requested_fields:
+                    self.fields.pop(name)
+
+    @classmethod
+    def get_columns(cls, requested_fields):
+        """
+        Return the model columns required to serialise the requested fields
+        """
+        columns = set()
+        for name in requested_fields:
+            columns.update(cls.field_columns.get(name, [name]))
+        return columns
 
     def get_url(self, obj):
         return '{0}/catalogue/api/records/{1}.json'.format(settings.BASE_URL, obj.identifier)
@@ -160,27 +199,183 @@ class RecordSerializer(serializers.ModelSerializer):
         )
 
 
+class FullTextSearchFilter(filters.BaseFilterBackend):
+    """
+    Ranked full text search of the records, for example ?q=vegetation
+    """
+    search_param = "q"
+    text_search_config = "english"
+
+    def filter_queryset(self, request, queryset, view):
+        q = request.query_params.get(self.search_param, "").strip()
+        if not q:
+            return queryset
+        return queryset.extra(
+            select={"search_rank": "ts_rank(anytext_tsvector, plainto_tsquery(%s, %s))"},
+            select_params=[self.text_search_config, q],
+            where=["anytext_tsvector @@ plainto_tsquery(%s, %s)"],
+            params=[self.text_search_config, q],
+            order_by=["-search_rank", "identifier"]
+        )
+
+
+class RecordCursorPagination(pagination.CursorPagination):
+    """
+    Keyset pagination ordered by identifier, only enabled if the parameter 'cursor' or 'page_size' is present.
+    """
+    ordering = ("identifier", "id")
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        if self.cursor_query_param not in request.query_params and self.page_size_query_param not in request.query_params:
+            return None
+        try:
+            return min(max(int(request.query_params.get(self.page_size_query_param, 100)), 1), self.max_page_size)
+        except ValueError:
+            return 100
+
+
+class RankedSearchPagination(pagination.PageNumberPagination):
+    """
+    Page number pagination of the ranked full text search results, the cursor pagination would replace the rank
+    ordering. Only enabled if the parameter 'page' or 'page_size' is present.
+    """
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        if self.page_query_param not in request.query_params and self.page_size_query_param not in request.query_params:
+            return None
+        try:
+            return min(max(int(request.query_params.get(self.page_size_query_param, 100)), 1), self.max_page_size)
+        except ValueError:
+            return 100
+
+
 class RecordViewSet(viewsets.ModelViewSet):
     queryset = Record.objects.all()
     serializer_class = RecordSerializer
     authentication_classes = []
     lookup_field = "identifier"
-    filter_backends = (filters.DjangoFilterBackend,)
+    filter_backends = (filters.DjangoFilterBackend, FullTextSearchFilter)
     filter_fields = ("tags__name", "application__name")
+    pagination_class = RecordCursorPagination
+    #the fields excluded in compact mode
+    compact_excluded_fields = ("any_text", "ows_resource", "metadata_link")
+
+    def get_requested_fields(self):
+        """
+        Return the fields requested by the parameters 'fields' and 'compact'; return None if all fields are requested.
+        """
+        if self.action not in ("list", "retrieve"):
+            return None
+        fields = self.request.query_params.get("fields")
+        compact = self.request.query_params.get("compact", "false").lower() in ("true", "1", "yes")
+        if fields:
+            fields = [f.strip() for f in fields.split(",") if f.strip()]
+        elif compact:
+            fields = RecordSerializer.Meta.fields
+        else:
+            return None
+        if compact:
+            fields = [f for f in fields if f not in self.compact_excluded_fields]
+        return fields
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if self.request.query_params.get(FullTextSearchFilter.search_param, "").strip():
+                #keep the rank ordering of the search results
+                self._paginator = RankedSearchPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+    def get_serializer(self, *args, **kwargs):
+        if "requested_fields" not in kwargs:
+            kwargs["requested_fields"] = self.get_requested_fields()
+        return super(RecordViewSet, self).get_serializer(*args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super(RecordViewSet, self).get_queryset()
+        if self.action in ("list", "retrieve"):
+            requested_fields = self.get_requested_fields()
+            if requested_fields is None:
+                #serialise the tags and styles without a query for each record
+                return queryset.prefetch_related("tags", "styles")
+            model_fields = set(f.name for f in Record._meta.concrete_fields)
+            #the identifier is used for the lookup and the pagination
+            columns = set(["identifier"]) | RecordSerializer.get_columns(requested_fields)
+            queryset = queryset.only(*[c for c in columns if c in model_fields])
+            queryset = queryset.prefetch_related(*[f for f in ("tags", "styles") if f in requested_fields])
+        return queryset
 
     def createStyle(self, content):
         uploaded_style = ContentFile(content)
         return uploaded_style
 
-    def calculate_checksum(self, content):
-        checksum = md5.new()
-        checksum.update(content)
-        return base64.b64encode(checksum.digest())
+    @staticmethod
+    def transform_bbox(validated_data):
+        """
+        Transform the json bbox into wkt polygon
+        """
+        if validated_data.get('bounding_box'):
+            bounding_box = json.loads(validated_data['bounding_box'])
+            bounding_box = ','.join([str(o) for o in bounding_box])
+            try:
+                validated_data['bounding_box'] = util.bbox2wktpolygon(bounding_box)
+            except:
+                traceback.print_exc()
+                raise serializers.ValidationError("Incorrect bounding box dataformat.")
 
     def perform_destroy(self, instance):
         instance.active = False
         instance.save()
 
+    @list_route(methods=["get"])
+    def bbox(self, request):
+        """
+        Return the active records intersecting the bbox, for example ?bbox=115,-35,120,-30&crs=EPSG:4326&offset=0&limit=100
+        """
+        try:
+            bbox = [float(v) for v in request.GET.get("bbox", "").split(",")]
+            if len(bbox) != 4:
+                raise ValueError()
+        except ValueError:
+            raise serializers.ValidationError("Parameter 'bbox' should be 'minx,miny,maxx,maxy'.")
+        crs = request.GET.get("crs", "EPSG:4326").upper()
+        if crs != "EPSG:4326":
+            try:
+                bbox = projections.transform_bbox(crs, "EPSG:4326", bbox)
+            except Exception as e:
+                raise serializers.ValidationError("Transform the bbox from crs({}) failed. {}".format(crs, e))
+        try:
+            offset = max(int(request.GET.get("offset", 0)), 0)
+            limit = min(max(int(request.GET.get("limit", 100)), 1), 1000)
+        except ValueError:
+            raise serializers.ValidationError("Parameter 'offset' and 'limit' should be integer.")
+
+        qs = Record.objects.filter(active=True, wkb_geometry__intersects=Polygon.from_bbox(bbox))
+        if request.GET.get("app"):
+            qs = qs.filter(applicationlayer__application__name=request.GET["app"])
+        #fetch one more row to know whether there is a next page
+        records = list(qs.order_by("identifier").values("identifier", "title", "crs", "bounding_box")[offset:offset + limit + 1])
+        next_url = None
+        if len(records) > limit:
+            records = records[:limit]
+            params = request.GET.copy()
+            params["offset"] = offset + limit
+            next_url = request.build_absolute_uri("{}?{}".format(request.path, params.urlencode()))
+        for record in records:
+            record["url"] = '{0}/catalogue/api/records/{1}.json'.format(settings.BASE_URL, record["identifier"])
+        return Response({"offset": offset, "limit": limit, "next": next_url, "results": records})
+
+    @method_decorator(condition(etag_func=catalogue_etag, last_modified_func=catalogue_last_modified))
+    def list(self, request, *args, **kwargs):
+        return super(RecordViewSet, self).list(request, *args, **kwargs)
+
+    @method_decorator(condition(etag_func=catalogue_etag, last_modified_func=catalogue_last_modified))
     def retrieve(self, request, *args, **kwargs):
         instance = self.get_object()
         style_content = bool(request.GET.get("style_content", False))
@@ -210,14 +405,7 @@ class RecordViewSet(viewsets.ModelViewSet):
             # save record data.
             identifier = "{}:{}".format(serializer.validated_data['workspace'], serializer.validated_data['name'])
             # transform the bbox data format
-            if serializer.validated_data.get('bounding_box'):
-                bounding_box = json.loads(serializer.validated_data['bounding_box'])
-                bounding_box = ','.join([str(o) for o in bounding_box])
-                try:
-                    serializer.validated_data['bounding_box'] = util.bbox2wktpolygon(bounding_box)
-                except:
-                    traceback.print_exc()
-                    raise serializers.ValidationError("Incorrect bounding box dataformat.")
+            self.transform_bbox(serializer.validated_data)
             try:
                 serializer.instance = Record.objects.get(identifier=identifier)
                 serializer.instance.active = True
@@ -273,9 +461,10 @@ class RecordViewSet(viewsets.ModelViewSet):
                 for uploaded_style in default_style.itervalues():
                     uploaded_style["default"] = True
 
-                #save  style
-                for style_serializer in style_serializers:
-                    style_serializer.save()
+                #save  style, the links and default styles of the record are updated once
+                with batch_style_import():
+                    for style_serializer in style_serializers:
+                        style_serializer.save()
 
             ows_serializer.save(record)
 
@@ -287,3 +476,205 @@ class RecordViewSet(viewsets.ModelViewSet):
             raise
         except Exception as e:
             raise serializers.ValidationError(str(e))
+
+    def _validate_bulk_item(self, data):
+        """
+        Validate an item of the bulk request, which has the same format as the data of 'create'.
+        """
+        if not isinstance(data, dict):
+            raise serializers.ValidationError("Incorrect record dataformat.")
+        data = dict(data)
+        styles_data = data.pop("styles", None) or []
+        ows_data = data.pop("ows_resource", None)
+        serializer = RecordSerializer(data=data, ows='post')
+        serializer.is_valid(raise_exception=True)
+        style_serializers = [StyleSerializer(data=style) for style in styles_data]
+        for style_serializer in style_serializers:
+            style_serializer.is_valid(raise_exception=True)
+            if not style_serializer.validated_data.get("content"):
+                raise serializers.ValidationError("The content of style({}) is empty.".format(style_serializer.validated_data["name"]))
+        ows_serializer = OwsResourceSerializer(data=ows_data)
+        ows_serializer.is_valid(raise_exception=True)
+        self.transform_bbox(serializer.validated_data)
+        validated_data = dict(serializer.validated_data)
+        identifier = "{}:{}".format(validated_data.pop('workspace'), validated_data.pop('name'))
+        return {
+            "identifier": identifier,
+            "data": validated_data,
+            "styles": [dict(style_serializer.validated_data) for style_serializer in style_serializers],
+            "ows": ows_serializer,
+        }
+
+    def _upsert_styles(self, record, record_styles, styles_data, changed_styles, new_styles, released_contents):
+        """
+        Add or update the styles of the record, and set the default styles as 'create' and the style signals do.
+        record_styles is the list of the record's styles, the added styles are appended.
+        The replaced style files are appended to released_contents.
+        Return True if the default styles of the record are changed.
+        """
+        origin_default_style = dict((style.format, style.name) for style in record_styles if style.default)
+        #the default style of each format: the user's default style, the configured default style or the first style
+        default_style = {}
+        for uploaded_style in styles_data:
+            if uploaded_style.get("default", False):
+                default_style[uploaded_style["format"]] = uploaded_style
+        for uploaded_style in styles_data:
+            style_format = uploaded_style["format"]
+            if style_format in default_style and default_style[style_format].get("default", False):
+                continue
+            if origin_default_style.get(style_format) == uploaded_style["name"]:
+                default_style[style_format] = uploaded_style
+            elif style_format not in origin_default_style and style_format not in default_style:
+                default_style[style_format] = uploaded_style
+
+        default_changed = False
+        styles = dict(((style.name, style.format), style) for style in record_styles)
+        #the unsaved styles are not hashable, use the object ids
+        uploaded_styles = set()
+        for uploaded_style in styles_data:
+            content = self.createStyle(uploaded_style["content"].decode("base64"))
+            checksum = Style.calculate_checksum(content)
+            is_default = default_style.get(uploaded_style["format"]) is uploaded_style
+            style = styles.get((uploaded_style["name"], uploaded_style["format"]))
+            if style is None:
+                style = Style(record=record, name=uploaded_style["name"], format=uploaded_style["format"], default=is_default, content=content)
+                style.store_content(checksum)
+                new_styles.append(style)
+                record_styles.append(style)
+                styles[(style.name, style.format)] = style
+                default_changed = default_changed or is_default
+            else:
+                changed = False
+                if style.checksum != checksum[0]:
+                    if style.content:
+                        released_contents.append(style.content.name)
+                    style.content = content
+                    style.store_content(checksum)
+                    changed = True
+                if style.default != is_default:
+                    style.default = is_default
+                    changed = default_changed = True
+                if changed and style.pk:
+                    changed_styles[style.pk] = style
+            uploaded_styles.add(id(style))
+
+        for style in record_styles:
+            if id(style) in uploaded_styles:
+                continue
+            if style.default and style.format in default_style:
+                #only one default style for each format
+                style.default = False
+                default_changed = True
+                if style.pk:
+                    changed_styles[style.pk] = style
+
+        #make sure each format has a default style, the builtin style or the first style
+        for style_format in set(style.format for style in record_styles):
+            if any(style.default for style in record_styles if style.format == style_format):
+                continue
+            candidates = sorted([style for style in record_styles if style.format == style_format], key=lambda s: (s.name != Style.BUILTIN, s.name))
+            candidates[0].default = True
+            default_changed = True
+            if candidates[0].pk:
+                changed_styles[candidates[0].pk] = candidates[0]
+        return default_changed
+
+    def _bulk_upsert(self, items):
+        """
+        Create or update the records and their styles with bulk operations. Return the saved records.
+        """
+        existing = dict((record.identifier, record) for record in Record.objects.filter(identifier__in=list(items.keys())))
+        record_fields = set(["links", "resource_links", "service_type_version", "active", "modified", "fragments"])
+        for identifier, item in list(items.items()):
+            record = existing.get(identifier)
+            data = item["data"]
+            if record:
+                for key in ["title", "abstract", "modified", "insert_date"]:
+                    data.pop(key, None)
+                record.active = True
+                item["original"] = (record.keywords, record.links)
+                item["result"]["status"] = "updated"
+            else:
+                record = Record(identifier=identifier)
+                item["result"]["status"] = "created"
+            for key, value in data.iteritems():
+                setattr(record, key, value)
+            record_fields.update(data.keys())
+            item["record"] = record
+            try:
+                links, record.service_type_version = item["ows"].generate_links(record)
+                item["ows_links"] = [Record.parse_link(link) for link in links]
+            except Exception as e:
+                item["result"].update({"status": "error", "errors": str(e)})
+                del items[identifier]
+
+        records = [item["record"] for item in items.itervalues()]
+        new_records = [record for record in records if not record.pk]
+        if new_records:
+            Record.objects.bulk_create(new_records)
+            pks = dict(Record.objects.filter(identifier__in=[record.identifier for record in new_records]).values_list("identifier", "pk"))
+            for record in new_records:
+                record.pk = pks[record.identifier]
+
+        styles = {}
+        for style in Style.objects.filter(record__in=records):
+            styles.setdefault(style.record_id, []).append(style)
+        changed_styles = {}
+        new_styles = []
+        released_contents = []
+        now = timezone.now()
+        for item in items.itervalues():
+            record = item["record"]
+            record_styles = styles.get(record.pk, [])
+            default_changed = self._upsert_styles(record, record_styles, item["styles"], changed_styles, new_styles, released_contents)
+            record.set_resource_links(item["ows_links"] + [Record.parse_link(Record.generate_style_link(style)) for style in record_styles])
+            #the fragments will be rendered on demand
+            record.fragments = None
+            if "original" in item and (default_changed or item["original"] != (record.keywords, record.links)):
+                record.modified = now
+            item["result"]["url"] = '{0}/catalogue/api/records/{1}.json'.format(settings.BASE_URL, record.identifier)
+
+        bulk_update(Record, records, sorted(record_fields))
+        bulk_update(Style, changed_styles.values(), ["default", "content", "checksum"])
+        Style.objects.bulk_create(new_styles)
+        #the style files are shared by content, only remove the files which are not used any more
+        for name in set(released_contents):
+            Style.release_content(name)
+        return records
+
+    @list_route(methods=["post"])
+    def bulk(self, request):
+        """
+        Create or update a list of records with their styles and ows resources in one transaction.
+        Each item has the same format as the data of 'create'. Return the status of each item.
+        """
+        if not isinstance(request.data, list):
+            raise serializers.ValidationError("A list of records is required.")
+        results = []
+        items = OrderedDict()
+        for data in request.data:
+            try:
+                item = self._validate_bulk_item(data)
+            except serializers.ValidationError as e:
+                results.append({"status": "error", "errors": e.detail})
+                continue
+            result = {"identifier": item["identifier"]}
+            if item["identifier"] in items:
+                result.update({"status": "error", "errors": "Duplicate record in the request."})
+            else:
+                item["result"] = result
+                items[item["identifier"]] = item
+            results.append(result)
+
+        if items:
+            try:
+                with transaction.atomic():
+                    records = self._bulk_upsert(items)
+            except serializers.ValidationError:
+                raise
+            except Exception as e:
+                raise serializers.ValidationError(str(e))
+            #the signals are not sent by the bulk operations
+            bump_catalogue_generation()
+            schedule_records_view_refresh(Application.objects.filter(applicationlayer__layer__in=records).values_list("name", flat=True).distinct())
+        return Response(results)
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class CatalogueConfig(AppConfig):
+    name = 'catalogue'
+
+    def ready(self):
+        #connect the signal receivers which are not in models.py, the management commands and scripts
+        #don't import them through the url conf
+        from . import cache, fragments, pycswsettings
@@ -0,0 +1,36 @@
+"""
+Set-based updates of model instances
+
+Django 1.9 has no bulk update, saving the instances one by one runs one
+statement (and the signals) for each instance. bulk_update writes the fields
+of many instances with one 'UPDATE ... FROM (VALUES ...)' statement.
+"""
+from django.db import connection, models
+
+
+def bulk_update(model, objs, fields, batch_size=500):
+    """
+    Update the fields of the instances with one statement for each batch.
+    The signals are not sent and the save method is not called.
+    """
+    if not objs:
+        return
+    meta = model._meta
+    columns = [meta.pk] + [meta.get_field(f) for f in fields]
+    quote = connection.ops.quote_name
+    pk_column = quote(meta.pk.column)
+    #cast the values to the column types, otherwise postgres takes the untyped values as text
+    row = "({})".format(", ".join("%s::{}".format("integer" if isinstance(f, models.AutoField) else f.db_type(connection)) for f in columns))
+    sql = "UPDATE {} AS t SET {} FROM (VALUES {{}}) AS v({}) WHERE t.{} = v.{}".format(
+        quote(meta.db_table),
+        ", ".join("{0} = v.{0}".format(quote(f.column)) for f in columns[1:]),
+        ", ".join(quote(f.column) for f in columns),
+        pk_column, pk_column
+    )
+    with connection.cursor() as cursor:
+        for start in xrange(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            params = []
+            for obj in batch:
+                params.extend(f.get_db_prep_save(f.pre_save(obj, False), connection) for f in columns)
+            cursor.execute(sql.format(", ".join([row] * len(batch))), params)
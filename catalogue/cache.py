@@ -0,0 +1,156 @@
+"""
+Catalogue generation counter and CSW response cache
+
+The catalogue generation is a version stamp shared by all the worker processes
+through the django cache. It is changed whenever the catalogue data is changed,
+and it is part of the key of every cached CSW response, so all cached
+responses are invalidated at once. It is also the validator of the conditional
+GET requests, which can be answered without touching the database.
+"""
+import hashlib
+import time
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.utils import timezone
+
+from oim_cms.compression import compress, COMPRESSION_MIN_SIZE
+
+from .models import (Record, Style, Tag, Application, ApplicationLayer, PycswConfig,
+                     Collaborator, Organization)
+
+CATALOGUE_GENERATION_KEY = "catalogue_generation"
+#the time when the catalogue generation was changed
+CATALOGUE_GENERATION_TIME_KEY = "catalogue_generation_time"
+
+#requests whose response only depends on the request parameters and the catalogue data
+CACHEABLE_REQUESTS = ("GetCapabilities", "DescribeRecord", "GetRecords", "GetRecordById")
+
+
+def get_catalogue_generation():
+    generation = cache.get(CATALOGUE_GENERATION_KEY)
+    if generation is None:
+        if cache.add(CATALOGUE_GENERATION_KEY, uuid.uuid4().hex, None):
+            cache.set(CATALOGUE_GENERATION_TIME_KEY, int(time.time()), None)
+        generation = cache.get(CATALOGUE_GENERATION_KEY)
+    return generation
+
+
+def get_catalogue_last_modified():
+    """
+    Return the time when the catalogue generation was changed
+    """
+    timestamp = cache.get(CATALOGUE_GENERATION_TIME_KEY)
+    if timestamp is None:
+        #the generation time is lost, the catalogue may be changed at any time before
+        cache.add(CATALOGUE_GENERATION_TIME_KEY, int(time.time()), None)
+        timestamp = cache.get(CATALOGUE_GENERATION_TIME_KEY)
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+def bump_catalogue_generation():
+    """
+    Change the catalogue generation, should be called after any catalogue data change is committed.
+    """
+    cache.set(CATALOGUE_GENERATION_KEY, uuid.uuid4().hex, None)
+    cache.set(CATALOGUE_GENERATION_TIME_KEY, int(time.time()), None)
+
+
+@receiver(post_save, sender=Record)
+@receiver(post_delete, sender=Record)
+@receiver(post_save, sender=Style)
+@receiver(post_delete, sender=Style)
+#the tags are serialised with the records
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Application)
+@receiver(post_delete, sender=Application)
+@receiver(post_save, sender=ApplicationLayer)
+@receiver(post_delete, sender=ApplicationLayer)
+@receiver(post_save, sender=PycswConfig)
+@receiver(post_delete, sender=PycswConfig)
+@receiver(post_save, sender=Collaborator)
+@receiver(post_delete, sender=Collaborator)
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def _catalogue_changed(sender, instance, **kwargs):
+    #the requests before the commit still read the old data, they should not be cached with the new generation
+    transaction.on_commit(bump_catalogue_generation)
+
+
+@receiver(m2m_changed, sender=Record.tags.through)
+@receiver(m2m_changed, sender=Application.records.through)
+def _catalogue_relation_changed(sender, instance, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        transaction.on_commit(bump_catalogue_generation)
+
+
+def catalogue_etag(request, *args, **kwargs):
+    """
+    ETag of a GET request whose response only depends on the url and the catalogue data.
+    Can be used with django.views.decorators.http.condition
+    """
+    return hashlib.md5(u"{}_{}".format(get_catalogue_generation(), request.get_full_path()).encode("utf-8")).hexdigest()
+
+
+def catalogue_last_modified(request, *args, **kwargs):
+    return get_catalogue_last_modified()
+
+
+class CswResponseCache(object):
+    """
+    Cache the responses of the CSW KVP requests in the django cache.
+    """
+    def __init__(self, timeout, max_size):
+        self.timeout = timeout
+        self.max_size = max_size
+
+    def is_cacheable(self, kvp):
+        return kvp.get("request") in CACHEABLE_REQUESTS and "responsehandler" not in kvp
+
+    def get_key(self, app, kvp):
+        """
+        Return the cache key of the request; return None if the request is not cacheable.
+        The key should be got before processing the request, so a response is never
+        cached with a newer catalogue generation.
+        """
+        if not self.is_cacheable(kvp):
+            return None
+        #kvp is normalized by CswEndpoint._normalize_params, the keys are lower case
+        request = u"&".join(u"{}={}".format(k, v) for k, v in sorted(kvp.iteritems()))
+        return "catalogue_csw_{}_{}_{}".format(get_catalogue_generation(), app, hashlib.md5(request.encode("utf-8")).hexdigest())
+
+    def get(self, key, encoding=None):
+        """
+        Return the cached response and its content encoding; return (None, None) if not cached.
+        If encoding is set, the compressed response is returned, it is compressed and cached
+        alongside the response on the first hit, so the repeated hits are not compressed again.
+        """
+        if encoding:
+            response = cache.get("{}_{}".format(key, encoding))
+            if response is not None:
+                return response, encoding
+        response = cache.get(key)
+        if response is None:
+            return None, None
+        if not encoding or len(response) < COMPRESSION_MIN_SIZE:
+            return response, None
+        response = compress(response, encoding)
+        cache.set("{}_{}".format(key, encoding), response, self.timeout)
+        return response, encoding
+
+    def set(self, key, response):
+        if len(response) > self.max_size:
+            return
+        cache.set(key, response, self.timeout)
+
+
+csw_response_cache = CswResponseCache(
+    getattr(settings, "CSW_RESPONSE_CACHE_TIMEOUT", 3600),
+    getattr(settings, "CSW_RESPONSE_CACHE_MAX_SIZE", 1024 * 1024 * 2)
+)
@@ -0,0 +1,129 @@
+"""
+On demand lookup of the extra EPSG definitions
+
+The definitions file has one definition on each line, '<code> proj4 definition <>'.
+The offsets of the lines are indexed once and the index is cached next to the
+file, so a definition is only parsed from the memory-mapped file when it is requested.
+The crs which is not defined in the file is left to pyproj's own database.
+"""
+import json
+import logging
+import mmap
+import os
+import re
+import threading
+
+logger = logging.getLogger(__name__)
+
+epsg_re = re.compile(r"^<([0-9]+)>\s+(.+)\s+<>$")
+
+
+class EpsgRegistry(object):
+    """
+    The extra EPSG definitions of a file, key is the crs, for example 'EPSG:900913'.
+    The index is cached in index_path, defaults to the file path with suffix '.idx'
+    """
+    def __init__(self, path, index_path=None):
+        self.path = path
+        self.index_path = index_path or ("{}.idx".format(path) if path else None)
+        self._lock = threading.Lock()
+        self._index = None
+        self._data = None
+        self._definitions = {}
+
+    @staticmethod
+    def build_index(data):
+        """
+        Return a dict of the line's [offset, length] for each code, the comment and incorrect lines are ignored
+        """
+        index = {}
+        size = len(data)
+        offset = 0
+        while offset < size:
+            end = data.find(b"\n", offset)
+            if end == -1:
+                end = size
+            line = data[offset:end]
+            if line.startswith(b"<"):
+                code = line[1:line.find(b">")]
+                if code.isdigit():
+                    index[code] = [offset, end - offset]
+            offset = end + 1
+        return index
+
+    def _load_index(self, stat):
+        """
+        Return the cached index; return None if not cached or the file is changed
+        """
+        try:
+            with open(self.index_path) as f:
+                cached = json.load(f)
+            if cached["stat"] == stat:
+                return cached["index"]
+        except (IOError, ValueError, KeyError, TypeError):
+            pass
+        return None
+
+    def _save_index(self, stat, index):
+        #write into a temporary file and rename it, the index can be built by multiple processes at the same time
+        tmp_path = "{}.{}".format(self.index_path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"stat": stat, "index": index}, f)
+            os.rename(tmp_path, self.index_path)
+        except (IOError, OSError) as e:
+            logger.warning("Cache the epsg index into {} failed. {}".format(self.index_path, e))
+
+    def _open(self):
+        """
+        Memory-map the file and load the index, the index is built if not cached.
+        """
+        if self._index is not None:
+            return
+        self._index = {}
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            st = os.stat(self.path)
+            stat = [st.st_size, int(st.st_mtime)]
+            if not st.st_size:
+                return
+            with open(self.path, "rb") as f:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            index = self._load_index(stat)
+            if index is None:
+                index = self.build_index(self._data)
+                self._save_index(stat, index)
+            self._index = index
+        except:
+            logger.exception("Load the extra epsg definitions from {} failed.".format(self.path))
+
+    def get(self, crs, default=None):
+        """
+        Return the proj4 definition of the crs; return default if the crs is not defined in the file
+        """
+        crs = crs.upper()
+        if not crs.startswith("EPSG:"):
+            return default
+        code = crs[5:]
+        with self._lock:
+            if code not in self._definitions:
+                self._open()
+                definition = None
+                position = self._index.get(code)
+                if position:
+                    m = epsg_re.match(self._data[position[0]:position[0] + position[1]].strip())
+                    if m:
+                        definition = m.group(2)
+                self._definitions[code] = definition
+            definition = self._definitions[code]
+        return default if definition is None else definition
+
+    def __contains__(self, crs):
+        return self.get(crs) is not None
+
+    def __getitem__(self, crs):
+        definition = self.get(crs)
+        if definition is None:
+            raise KeyError(crs)
+        return definition
@@ -0,0 +1,117 @@
+"""
+A local fake CSW server for the offline harvest tests and benchmarks
+
+The server answers the GetRecords requests with pages of generated Dublin Core
+records, the latency of the responses can be simulated.
+"""
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from xml.sax.saxutils import escape
+
+RESPONSE_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<csw:GetRecordsResponse xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:dct="http://purl.org/dc/terms/" xmlns:ows="http://www.opengis.net/ows" version="2.0.2">
+  <csw:SearchStatus timestamp="{timestamp}"/>
+  <csw:SearchResults numberOfRecordsMatched="{matched}" numberOfRecordsReturned="{returned}" nextRecord="{next}" recordSchema="http://www.opengis.net/cat/csw/2.0.2" elementSet="full">
+{records}
+  </csw:SearchResults>
+</csw:GetRecordsResponse>"""
+
+RECORD_TEMPLATE = """    <csw:Record>
+      <dc:identifier>{identifier}</dc:identifier>
+      <dc:title>{title}</dc:title>
+      <dc:type>http://purl.org/dc/dcmitype/Dataset</dc:type>
+      <dc:subject>harvest</dc:subject>
+      <dct:modified>{modified}</dct:modified>
+      <dct:abstract>{title} harvested from the fake CSW server</dct:abstract>
+      <ows:BoundingBox crs="urn:x-ogc:def:crs:EPSG:6.11:4326">
+        <ows:LowerCorner>-35.0 112.0</ows:LowerCorner>
+        <ows:UpperCorner>-13.0 129.0</ows:UpperCorner>
+      </ows:BoundingBox>
+    </csw:Record>"""
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server.fake_csw
+        server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        params = dict((k.lower(), v[0]) for k, v in urlparse.parse_qs(urlparse.urlparse(self.path).query).iteritems())
+        try:
+            startposition = max(int(params.get("startposition", 1)), 1)
+            maxrecords = int(params.get("maxrecords", 10))
+        except ValueError:
+            self.send_error(400)
+            return
+        body = server.get_records(startposition, maxrecords).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeCswServer(object):
+    """
+    Serve 'count' generated records on a local port, each response is delayed by 'latency' seconds.
+    The records are identified by '<prefix>-<n>', the title and the modified date of the records can be
+    changed with 'revision' to simulate the changed source.
+    Can be used as a context manager, the server is started on entering and stopped on exiting.
+    """
+    def __init__(self, count=100, latency=0, prefix="fakecsw", revision=0):
+        self.count = count
+        self.latency = latency
+        self.prefix = prefix
+        self.revision = revision
+        self.requests = 0
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/csw".format(self._server.server_address[1])
+
+    def get_record(self, n):
+        return RECORD_TEMPLATE.format(
+            identifier=escape("{}-{}".format(self.prefix, n)),
+            title=escape("Fake record {} revision {}".format(n, self.revision)),
+            modified="2016-01-01T00:00:{:02d}Z".format(self.revision % 60))
+
+    def get_records(self, startposition, maxrecords):
+        end = min(startposition + maxrecords, self.count + 1)
+        numbers = range(startposition, end)
+        return RESPONSE_TEMPLATE.format(
+            timestamp=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            matched=self.count, returned=len(numbers), next=end if end <= self.count else 0,
+            records="\n".join(self.get_record(n) for n in numbers))
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), _RequestHandler)
+        self._server.fake_csw = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,217 @@
+"""
+Precomputed CSW XML fragments of the catalogue records
+
+A fragment is the serialised csw:Record (or gmd:MD_Metadata) element of a record
+for an element set name (brief, summary or full). The fragments are rendered
+with pycsw's own writers, so a response built from the fragments is the same
+as the response built by pycsw.
+
+The fragments of a record are rendered after the record is saved (style and link
+changes always save the record) and stored as json in Record.fragments, with the
+version stamp of the pycsw settings they are rendered with. The fragments of
+an old settings version are ignored, and rendered again on demand.
+"""
+import copy
+import json
+import logging
+import threading
+
+from django.dispatch import receiver
+from django.db.models.signals import post_save
+from lxml import etree
+from pycsw import util
+
+from .models import Record, Application, schedule_records_view_refresh
+from .pycswsettings import build_pycsw_settings, get_settings_version
+from .repository import repository_pool
+
+logger = logging.getLogger(__name__)
+
+CSW_NAMESPACE = "http://www.opengis.net/cat/csw/2.0.2"
+GMD_NAMESPACE = "http://www.isotc211.org/2005/gmd"
+
+OUTPUT_SCHEMAS = {
+    CSW_NAMESPACE: "csw",
+    GMD_NAMESPACE: "gmd",
+}
+ELEMENT_SETS = ("brief", "summary", "full")
+#the placeholder of the fragments in a serialised response
+FRAGMENTS_MARKER = u"__catalogue_fragments__"
+
+
+def fragment_key(outputschema, elementsetname):
+    return "{}:{}".format(OUTPUT_SCHEMAS[outputschema], elementsetname)
+
+
+class FragmentRenderer(object):
+    """
+    Render the fragments of a record with a process wide pycsw server.
+    The server is built again if the pycsw settings are changed by any process.
+    The record can be a Record instance or a row loaded by pycsw.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._server = None
+        self._queryables = None
+        self._version = None
+
+    @property
+    def server(self):
+        version = get_settings_version()
+        with self._lock:
+            if self._server is None or self._version != version:
+                from .views import Csw
+                server = Csw(rtconfig=build_pycsw_settings(), env={"QUERY_STRING": ""})
+                #render the fragments with pycsw writers, never from the stored fragments.
+                server.use_fragments = False
+                #only the queryables are required, the repository is not used to render the fragments.
+                self._queryables = copy.deepcopy(server.repository.queryables["_all"])
+                repository_pool.release(getattr(server, "repository", None))
+                self._server = server
+                self._version = version
+            return self._server
+
+    def reset(self):
+        with self._lock:
+            self._server = None
+            self._version = None
+
+    @property
+    def namespaces(self):
+        return self.server.context.namespaces
+
+    def render(self, record, outputschema, elementsetname):
+        """
+        Return the fragment of the record as unicode string
+        """
+        with self._lock:
+            server = self.server
+            #pycsw writers may transform the mappings in place
+            queryables = copy.deepcopy(self._queryables)
+            if outputschema == CSW_NAMESPACE:
+                server.kvp = {"elementsetname": elementsetname, "outputschema": outputschema}
+                element = server._write_record(record, queryables)
+            else:
+                element = server.profiles["loaded"][outputschema].write_record(
+                    record, elementsetname, outputschema, queryables)
+            return etree.tostring(element, encoding="unicode")
+
+    def render_all(self, record):
+        """
+        Return a dict of all the fragments of the record, with the settings version of the fragments as 'version'.
+        """
+        with self._lock:
+            self.server
+            fragments = dict((fragment_key(outputschema, elementsetname), self.render(record, outputschema, elementsetname))
+                             for outputschema in OUTPUT_SCHEMAS for elementsetname in ELEMENT_SETS)
+            fragments["version"] = self._version
+            return fragments
+
+    def response_element(self, root, **attrs):
+        """
+        Return the root element of a response, for example 'csw:GetRecordByIdResponse'
+        """
+        node = etree.Element(util.nspath_eval(root, self.namespaces), nsmap=self.namespaces, **attrs)
+        node.attrib[util.nspath_eval("xsi:schemaLocation", self.namespaces)] = "%s %s/csw/2.0.2/CSW-discovery.xsd" % \
+            (self.namespaces["csw"], self.server.config.get("server", "ogc_schemas_base"))
+        return node
+
+    def envelope(self, node, container=None):
+        """
+        Return the encoded head and tail of the response, the fragments are written between them as the children
+        of the container element; the container defaults to the root element.
+        The head and tail are encoded as pycsw does.
+        """
+        server = self.server
+        container = node if container is None else container
+        container.text = FRAGMENTS_MARKER
+        response = etree.tostring(node, encoding="unicode")
+        container.text = ""
+        head, tail = response.split(FRAGMENTS_MARKER)
+        head = u'<?xml version="1.0" encoding="%s" standalone="no"?>\n<!-- pycsw %s -->\n%s' % (
+            server.encoding, server.context.version, head)
+        return head.encode(server.encoding), tail.encode(server.encoding)
+
+    def encode(self, fragments):
+        return u"".join(fragments).encode(self.server.encoding)
+
+    def write_response(self, root, fragments):
+        """
+        Splice the fragments into a response whose root element is 'root', for example 'csw:GetRecordByIdResponse'
+        Return the encoded response as pycsw does.
+        """
+        head, tail = self.envelope(self.response_element(root))
+        return head + self.encode(fragments) + tail
+
+    def getrecords_envelope(self, matched, returned, nextrecord, outputschema, elementsetname):
+        """
+        Return the encoded head and tail of a GetRecords response, the record fragments are written between them.
+        """
+        node = self.response_element("csw:GetRecordsResponse", version="2.0.2")
+        etree.SubElement(node, util.nspath_eval("csw:SearchStatus", self.namespaces), timestamp=util.get_today_and_now())
+        searchresults = etree.SubElement(node, util.nspath_eval("csw:SearchResults", self.namespaces))
+        for name, value in (("numberOfRecordsMatched", matched), ("numberOfRecordsReturned", returned),
+                            ("nextRecord", nextrecord), ("recordSchema", outputschema), ("elementSet", elementsetname)):
+            searchresults.attrib[name] = str(value)
+        return self.envelope(node, searchresults)
+
+
+renderer = FragmentRenderer()
+
+
+def load_fragment(fragments, outputschema, elementsetname, version=None):
+    """
+    Return the fragment from the stored fragments json; return None if not found or rendered with other settings.
+    version is the current settings version, it's got from the cache if None
+    """
+    if not fragments:
+        return None
+    try:
+        fragments = json.loads(fragments)
+    except ValueError:
+        return None
+    if fragments.get("version") != (version or get_settings_version()):
+        return None
+    return fragments.get(fragment_key(outputschema, elementsetname))
+
+
+def update_fragments(record):
+    """
+    Render and store the fragments of the record. Return the rendered fragments.
+    """
+    try:
+        fragments = renderer.render_all(record)
+    except:
+        logger.exception("Render the fragments of record({}) failed.".format(record.identifier))
+        fragments = None
+    record.fragments = json.dumps(fragments) if fragments else None
+    #update the column directly, saving the record would trigger the signals again.
+    Record.objects.filter(pk=record.pk).update(fragments=record.fragments)
+    return fragments
+
+
+def get_fragment(record, outputschema, elementsetname, version=None):
+    """
+    Return the record's stored fragment; render and store the fragments if not stored.
+    """
+    fragment = load_fragment(record.fragments, outputschema, elementsetname, version)
+    if fragment is None:
+        fragments = update_fragments(record)
+        fragment = fragments[fragment_key(outputschema, elementsetname)] if fragments else \
+            renderer.render(record, outputschema, elementsetname)
+    return fragment
+
+
+@receiver(post_save, sender=Record)
+def _record_saved(sender, instance, **kwargs):
+    update_fields = kwargs.get("update_fields", None)
+    if update_fields and all(f in ("active", "fragments") for f in update_fields):
+        #the serialised columns are not changed
+        return
+    update_fragments(instance)
+    if Application.use_materialized_views():
+        #the materialized views may be refreshed before the fragments are stored, for example in autocommit mode.
+        #the fragments rendered on demand by the read requests don't refresh the views, the views without
+        #the fragments are serialized by pycsw
+        schedule_records_view_refresh(Application.objects.filter(applicationlayer__layer=instance).values_list("name", flat=True))
+
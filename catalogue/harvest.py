@@ -0,0 +1,278 @@
+"""
+Concurrent harvesting of remote CSW catalogues
+
+The pages of all the sources are fetched by a bounded pool of threads, the
+requests to each source are rate limited. The records are parsed with pycsw's
+parsers and written into the catalogue in batches by a single writer; the
+records whose content is not changed are skipped.
+"""
+import hashlib
+import logging
+import threading
+import time
+import urllib
+import urllib2
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from dateutil import parser as date_parser
+from django.db import transaction
+from django.utils import timezone
+from lxml import etree
+from pycsw.core import metadata
+from pycsw.core.config import StaticContext
+
+from .bulk import bulk_update
+from .cache import bump_catalogue_generation
+from .models import Record, schedule_records_view_refresh
+from . import mappings
+
+logger = logging.getLogger(__name__)
+
+CSW_NAMESPACE = "http://www.opengis.net/cat/csw/2.0.2"
+
+
+def get_pycsw_context():
+    context = StaticContext()
+    context.md_core_model = mappings.MD_CORE_MODEL
+    context.refresh_dc(mappings.MD_CORE_MODEL)
+    return context
+
+
+class ParsedRecords(object):
+    """
+    Stand-in of the pycsw repository for metadata.parse_record, which only creates the record objects with dataset.
+    The parsed records are plain objects whose attributes are the table columns.
+    """
+    class dataset(object):
+        pass
+
+
+def parse_records(context, element):
+    """
+    Parse a metadata element, return a list of rows, a row is a dict of the column values.
+    """
+    return [dict((k, v) for k, v in vars(record).iteritems() if not k.startswith("_"))
+            for record in metadata.parse_record(context, element, ParsedRecords)]
+
+
+def save_records(rows, update_existing=True):
+    """
+    Insert or update the parsed rows in one transaction, the signals are not sent.
+    rows is a dict of the parsed row for each identifier.
+    Return (the number of the inserted records, the number of the updated records)
+    """
+    fields = set(f.attname for f in Record._meta.concrete_fields if not f.primary_key)
+    existing = dict(Record.objects.filter(identifier__in=list(rows.keys())).values_list("identifier", "pk"))
+    new_records = []
+    updated_records = {}
+    for identifier, row in rows.iteritems():
+        values = dict((k, v) for k, v in row.iteritems() if k in fields)
+        pk = existing.get(identifier)
+        if pk is None:
+            new_records.append(Record(**values))
+        elif update_existing:
+            #the cached fragments and parsed links are out of date, they are rebuilt when requested
+            values.update(fragments=None, resource_links=None)
+            #only update the parsed columns, group the records by the columns
+            updated_records.setdefault(tuple(sorted(values.keys())), []).append(Record(pk=pk, **values))
+        else:
+            logger.error("ERROR: {} not inserted: the record exists".format(identifier))
+    with transaction.atomic():
+        Record.objects.bulk_create(new_records)
+        for columns, records in updated_records.iteritems():
+            bulk_update(Record, records, columns)
+    return len(new_records), sum(len(records) for records in updated_records.itervalues())
+
+
+def content_hash(xml):
+    if isinstance(xml, unicode):
+        xml = xml.encode("utf-8")
+    return hashlib.md5(xml or "").hexdigest()
+
+
+def parse_date(value):
+    if not value:
+        return None
+    try:
+        value = date_parser.parse(value) if isinstance(value, basestring) else value
+    except (ValueError, OverflowError):
+        return None
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+class RateLimiter(object):
+    """
+    Limit the requests to each source to 'rate' requests per second; no limit if rate is 0
+    """
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = {}
+
+    def wait(self, source):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next.get(source, now))
+            self._next[source] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+class Harvester(object):
+    """
+    Harvest the records of the remote CSW sources into the catalogue.
+    A source which is not a CSW endpoint is harvested as a single metadata document.
+    """
+    def __init__(self, workers=4, page_size=10, rate=0, timeout=30, batch_size=500, outputschema=CSW_NAMESPACE, stdout=None):
+        self.workers = workers
+        self.page_size = page_size
+        self.rate_limiter = RateLimiter(rate)
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.outputschema = outputschema
+        self.stdout = stdout
+        self._local = threading.local()
+
+    @property
+    def context(self):
+        #the pycsw context is not shared by the threads
+        context = getattr(self._local, "context", None)
+        if context is None:
+            context = self._local.context = get_pycsw_context()
+        return context
+
+    def get_page_url(self, source, startposition):
+        params = urllib.urlencode([
+            ("service", "CSW"), ("version", "2.0.2"), ("request", "GetRecords"),
+            ("typenames", "csw:Record"), ("resulttype", "results"), ("elementsetname", "full"),
+            ("outputschema", self.outputschema), ("startposition", startposition), ("maxrecords", self.page_size),
+        ])
+        return "{}{}{}".format(source, "&" if "?" in source else "?", params)
+
+    def fetch_page(self, task):
+        """
+        Fetch and parse a page of a source.
+        Return (source, startposition, the number of the matched records, the parsed rows, error)
+        """
+        source, startposition = task
+        try:
+            self.rate_limiter.wait(source)
+            response = urllib2.urlopen(self.get_page_url(source, startposition), timeout=self.timeout)
+            try:
+                root = etree.fromstring(response.read(), self.context.parser)
+            finally:
+                response.close()
+            searchresults = root.find("{%s}SearchResults" % CSW_NAMESPACE)
+            if root.tag == "{%s}GetRecordsResponse" % CSW_NAMESPACE and searchresults is not None:
+                matched = int(searchresults.get("numberOfRecordsMatched", 0))
+                elements = list(searchresults)
+            elif root.tag == "{%s}ExceptionReport" % "http://www.opengis.net/ows":
+                raise Exception(etree.tostring(root))
+            else:
+                #the source is a metadata document
+                matched = 1
+                elements = [root]
+            rows = []
+            for element in elements:
+                for row in parse_records(self.context, element):
+                    row["source"] = source
+                    rows.append(row)
+            return source, startposition, matched, rows, None
+        except Exception as e:
+            return source, startposition, 0, None, str(e)
+
+    def pages(self, sources):
+        """
+        Fetch the pages of the sources with the thread pool, yield the fetched pages as fetch_page returns.
+        The first page of each source is fetched first, it tells the number of the pages of the source.
+        """
+        pool = ThreadPool(self.workers)
+        try:
+            tasks = [(source, 1) for source in sources]
+            while tasks:
+                next_tasks = []
+                for page in pool.imap_unordered(self.fetch_page, tasks):
+                    source, startposition, matched = page[:3]
+                    if startposition == 1:
+                        next_tasks.extend((source, p) for p in xrange(1 + self.page_size, matched + 1, self.page_size))
+                    yield page
+                tasks = next_tasks
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def changed_rows(self, rows):
+        """
+        Return the rows which are new or changed, the records are compared by the content hash and the modified date.
+        """
+        existing = dict((identifier, (modified, content_hash(xml))) for identifier, modified, xml in
+                        Record.objects.filter(identifier__in=list(rows.keys())).values_list("identifier", "modified", "xml"))
+        changed = OrderedDict()
+        for identifier, row in rows.iteritems():
+            #pycsw:Modified is mapped to the 'date' column
+            modified = parse_date(row.get("date"))
+            if modified:
+                row["modified"] = modified
+            if identifier in existing:
+                stored_modified, stored_hash = existing[identifier]
+                if stored_hash == content_hash(row.get("xml")):
+                    continue
+                if modified and stored_modified and modified < stored_modified:
+                    #the harvested record is older than the stored one
+                    continue
+            changed[identifier] = row
+        return changed
+
+    def write(self, rows):
+        changed = self.changed_rows(rows)
+        inserted, updated = save_records(changed) if changed else (0, 0)
+        self.stats["inserted"] += inserted
+        self.stats["updated"] += updated
+        self.stats["unchanged"] += len(rows) - len(changed)
+
+    def harvest(self, sources):
+        """
+        Harvest the sources, return the statistics
+        """
+        self.stats = dict((k, 0) for k in ("pages", "records", "inserted", "updated", "unchanged", "failed"))
+        start = time.time()
+        rows = OrderedDict()
+        for source, startposition, matched, parsed, error in self.pages(sources):
+            if error:
+                self.stats["failed"] += 1
+                logger.error("Harvest the page({}) of {} failed. {}".format(startposition, source, error))
+                continue
+            self.stats["pages"] += 1
+            self.stats["records"] += len(parsed)
+            for row in parsed:
+                rows.pop(row.get("identifier"), None)
+                rows[row.get("identifier")] = row
+            if len(rows) >= self.batch_size:
+                self.write(rows)
+                rows = OrderedDict()
+                self.report(start)
+        if rows:
+            self.write(rows)
+        if self.stats["inserted"] or self.stats["updated"]:
+            #the signals are not sent by the bulk operations
+            bump_catalogue_generation()
+            schedule_records_view_refresh()
+        self.stats["elapsed"] = time.time() - start
+        self.report(start)
+        return self.stats
+
+    def report(self, start):
+        if not self.stdout:
+            return
+        elapsed = time.time() - start
+        self.stdout.write("Harvested {pages} pages, {records} records: {inserted} inserted, {updated} updated, "
+                          "{unchanged} unchanged, {failed} pages failed".format(**self.stats) +
+                          " in {:.2f}s ({:.0f} records/s)".format(elapsed, self.stats["records"] / elapsed if elapsed else 0))
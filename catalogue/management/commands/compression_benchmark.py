@@ -0,0 +1,81 @@
+from __future__ import absolute_import
+import time
+import uuid
+import zlib
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import resolve
+from django.test import RequestFactory
+
+from oim_cms.compression import compress, ENCODINGS
+
+from ...fragments import CSW_NAMESPACE, GMD_NAMESPACE
+
+
+class Command(BaseCommand):
+    help = """Benchmark the size and the latency of the compressed responses over representative payloads.
+    The payloads are the responses of the urls, the views are called directly without the middlewares."""
+    default_urls = [
+        "/catalogue/?service=CSW&version=2.0.2&request=GetRecords&typenames=csw:Record&resulttype=results&elementsetname=full&maxrecords=100",
+        "/catalogue/?service=CSW&version=2.0.2&request=GetRecords&typenames=csw:Record&resulttype=results&elementsetname=full&maxrecords=100&outputschema={}".format(GMD_NAMESPACE),
+        "/catalogue/?service=CSW&version=2.0.2&request=GetRecords&typenames=csw:Record&resulttype=results&elementsetname=brief&maxrecords=100&outputschema={}".format(CSW_NAMESPACE),
+        "/catalogue/api/records/",
+        "/api/users/",
+    ]
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", action="append", default=[],
+                            help="The url of a payload. Can be specified multiple times. Defaults to the CSW GetRecords, "
+                                 "the catalogue records api and the users api")
+        parser.add_argument("--username", default=None, help="Request the urls as the user")
+        parser.add_argument("--level", type=int, action="append", default=[],
+                            help="The compression level. Can be specified multiple times. Defaults to 1, 6 and 9")
+        parser.add_argument("-n", "--repeat", type=int, default=20,
+                            help="Number of times each payload is compressed. Defaults to %(default)s")
+
+    def get_payload(self, url, user):
+        request = RequestFactory().get(url)
+        request.user = user
+        match = resolve(request.path)
+        response = match.func(request, *match.args, **match.kwargs)
+        if hasattr(response, "render"):
+            response.render()
+        if response.status_code != 200:
+            raise Exception("status {}".format(response.status_code))
+        return b"".join(response.streaming_content) if response.streaming else response.content
+
+    def measure(self, func, repeat):
+        start = time.time()
+        for i in xrange(repeat):
+            result = func()
+        return result, (time.time() - start) * 1000 / repeat
+
+    def handle(self, *args, **options):
+        if options["repeat"] <= 0:
+            raise CommandError("Repeat should be greater than 0")
+        user = User.objects.get(username=options["username"]) if options["username"] else AnonymousUser()
+        levels = options["level"] or [1, 6, 9]
+        cache_key = "compression_benchmark_{}".format(uuid.uuid4().hex)
+        for url in options["url"] or self.default_urls:
+            try:
+                payload = self.get_payload(url, user)
+            except Exception as e:
+                self.stderr.write("Get the payload of {} failed. {}".format(url, e))
+                continue
+            self.stdout.write("{}\n    raw: {} bytes".format(url, len(payload)))
+            for encoding in ENCODINGS:
+                for level in levels:
+                    compressed, compress_time = self.measure(lambda: compress(payload, encoding, level), options["repeat"])
+                    wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+                    decompressed, decompress_time = self.measure(lambda: zlib.decompress(compressed, wbits), options["repeat"])
+                    if decompressed != payload:
+                        raise CommandError("The {} compressed payload of {} is corrupted".format(encoding, url))
+                    #the repeated hits of the cached responses get the compressed response from the cache
+                    cache.set(cache_key, compressed, 60)
+                    cached, cache_time = self.measure(lambda: cache.get(cache_key), options["repeat"])
+                    self.stdout.write("    {:<8} level={} size={} bytes ({:.1%}) compress={:.2f}ms decompress={:.2f}ms cache get={:.2f}ms".format(
+                        encoding, level, len(compressed), float(len(compressed)) / len(payload) if payload else 0,
+                        compress_time, decompress_time, cache_time))
+        cache.delete(cache_key)
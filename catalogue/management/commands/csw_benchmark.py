@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.utils import timezone
+
+from ...models import Record
+from ...views import CswEndpoint
+from ...fragments import CSW_NAMESPACE, OUTPUT_SCHEMAS, ELEMENT_SETS
+
+
+class Command(BaseCommand):
+    help = "Compare the latency of GetRecordById served by the native fast path and by pycsw"
+    benchmark_prefix = "csw_benchmark:"
+
+    def add_arguments(self, parser):
+        parser.add_argument("-n", "--requests", type=int, default=500,
+                            help="Number of GetRecordById requests for each path. Defaults to %(default)s")
+        parser.add_argument("--app", default=None,
+                            help="Request the records through the application's endpoint")
+        parser.add_argument("--elementsetname", default="full", choices=ELEMENT_SETS)
+        parser.add_argument("--outputschema", default=CSW_NAMESPACE, choices=OUTPUT_SCHEMAS)
+        parser.add_argument("--generate", type=int, default=0,
+                            help="Make sure the catalogue has at least this number of records by adding "
+                                 "benchmark records, for example 50000. The added records are removed after "
+                                 "the benchmark unless --keep is specified")
+        parser.add_argument("--keep", action="store_true", default=False,
+                            help="Keep the generated benchmark records")
+
+    def generate_records(self, count):
+        missing = count - Record.objects.filter(active=True).count()
+        if missing <= 0:
+            return 0
+        now = timezone.now()
+        batch = []
+        for i in xrange(missing):
+            minx, miny = random.uniform(110, 150), random.uniform(-40, -12)
+            batch.append(Record(
+                identifier="{}{}".format(self.benchmark_prefix, i),
+                title="Benchmark record {}".format(i),
+                abstract="Benchmark record {} generated by csw_benchmark".format(i),
+                keywords="benchmark,layer",
+                crs="EPSG:4326",
+                bounding_box="POLYGON(({0:.2f} {1:.2f}, {0:.2f} {3:.2f}, {2:.2f} {3:.2f}, {2:.2f} {1:.2f}, {0:.2f} {1:.2f}))".format(minx, miny, minx + 1, miny + 1),
+                modified=now,
+                publication_date=now,
+            ))
+            if len(batch) == 1000:
+                Record.objects.bulk_create(batch)
+                batch = []
+        if batch:
+            Record.objects.bulk_create(batch)
+        return missing
+
+    def run(self, view, identifiers, options):
+        factory = RequestFactory()
+        path = "/catalogue/{}/".format(options["app"]) if options["app"] else "/catalogue/"
+        durations = []
+        for identifier in identifiers:
+            request = factory.get(path, {
+                "service": "CSW",
+                "version": "2.0.2",
+                "request": "GetRecordById",
+                "id": identifier,
+                "elementSetName": options["elementsetname"],
+                "outputSchema": options["outputschema"],
+            })
+            start = time.time()
+            response = view(request, app=options["app"])
+            durations.append((time.time() - start) * 1000)
+            if response.status_code != 200:
+                raise Exception("Request for record({}) failed with status {}".format(identifier, response.status_code))
+        durations.sort()
+        return {
+            "mean": sum(durations) / len(durations),
+            "median": durations[len(durations) // 2],
+            "p95": durations[int(len(durations) * 0.95)],
+            "max": durations[-1],
+        }
+
+    def handle(self, *args, **options):
+        generated = self.generate_records(options["generate"]) if options["generate"] else 0
+        try:
+            identifiers = list(Record.objects.filter(active=True).values_list("identifier", flat=True))
+            if not identifiers:
+                self.stdout.write("No active records in the catalogue.")
+                return
+            self.stdout.write("Catalogue size: {} records ({} generated)".format(len(identifiers), generated))
+            samples = [random.choice(identifiers) for i in xrange(options["requests"])]
+
+            results = []
+            for name, fast_path in (("pycsw", False), ("fast path", True)):
+                view = CswEndpoint.as_view(use_response_cache=False, use_fast_path=fast_path)
+                #warm up the worker (settings, repository pool, reflected views) and the record fragments
+                self.run(view, samples, options)
+                result = self.run(view, samples, options)
+                results.append(result)
+                self.stdout.write("{:<10} mean={mean:.2f}ms median={median:.2f}ms p95={p95:.2f}ms max={max:.2f}ms".format(name, **result))
+            self.stdout.write("Speedup (mean): {:.1f}x".format(results[0]["mean"] / results[1]["mean"]))
+        finally:
+            if generated and not options["keep"]:
+                Record.objects.filter(identifier__startswith=self.benchmark_prefix).delete()
@@ -0,0 +1,56 @@
+from __future__ import absolute_import
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...fakecsw import FakeCswServer
+from ...harvest import Harvester
+from ...models import Record
+
+
+class Command(BaseCommand):
+    help = """Benchmark the harvest of the local fake CSW servers, no network access is required.
+    Each source is harvested twice, the second harvest skips the unchanged records."""
+    benchmark_prefix = "harvest_benchmark"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sources", type=int, default=4,
+                            help="Number of the fake CSW sources. Defaults to %(default)s")
+        parser.add_argument("--records", type=int, default=500,
+                            help="Number of records of each source. Defaults to %(default)s")
+        parser.add_argument("--latency", type=float, default=0.05,
+                            help="Latency of each response in seconds. Defaults to %(default)s")
+        parser.add_argument("--page-size", type=int, default=10,
+                            help="Number of records in a page. Defaults to %(default)s")
+        parser.add_argument("-w", "--workers", type=int, action="append", default=[],
+                            help="Number of the pages fetched at the same time. Can be specified multiple times. "
+                                 "Defaults to 1 and 8")
+        parser.add_argument("--rate", type=float, default=0,
+                            help="Maximum number of requests per second to each source. Defaults to %(default)s")
+        parser.add_argument("--keep", action="store_true", default=False,
+                            help="Keep the harvested benchmark records")
+
+    def handle(self, *args, **options):
+        if options["sources"] <= 0 or options["records"] <= 0:
+            raise CommandError("Sources and records should be greater than 0")
+        servers = [FakeCswServer(options["records"], options["latency"], prefix="{}-{}".format(self.benchmark_prefix, i))
+                   for i in xrange(options["sources"])]
+        try:
+            for server in servers:
+                server.start()
+            for workers in options["workers"] or [1, 8]:
+                self.delete_records()
+                harvester = Harvester(workers=workers, page_size=options["page_size"], rate=options["rate"])
+                for run in ("initial", "unchanged"):
+                    stats = harvester.harvest([server.url for server in servers])
+                    self.stdout.write("workers={:<3} {:<9} harvest: {records} records, {pages} pages, {inserted} inserted, "
+                                      "{updated} updated, {unchanged} unchanged, {failed} failed in {elapsed:.2f}s "
+                                      "({rate:.0f} records/s)".format(
+                                          workers, run, rate=stats["records"] / stats["elapsed"] if stats["elapsed"] else 0, **stats))
+        finally:
+            for server in servers:
+                server.stop()
+            if not options["keep"]:
+                self.delete_records()
+
+    def delete_records(self):
+        Record.objects.filter(identifier__startswith=self.benchmark_prefix).delete()
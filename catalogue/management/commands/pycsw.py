@@ -1,20 +1,79 @@
 from __future__ import absolute_import
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from glob import glob
+from multiprocessing import Pool
 import argparse
 import ConfigParser
 import logging
+import os
+import sys
+import time
 
 from django.core.management.base import BaseCommand
+from django.db import connection
+from lxml import etree
 from pycsw.core import admin
 from pycsw.core.config import StaticContext
 
 from ...pycswsettings import build_pycsw_settings
+from ...models import PycswConfig, Record, schedule_records_view_refresh
+from ...cache import bump_catalogue_generation
+from ...harvest import Harvester, get_pycsw_context, parse_records, save_records
+from ...sitemap import MAX_URLS, SitemapWriter
 from ... import mappings
 #from ... import events  # relying on custom pycsw branch
 
 logger = logging.getLogger(__name__)
 
 
+#the pycsw context of a worker process
+_worker_context = None
+
+def _init_worker():
+    global _worker_context
+    _worker_context = get_pycsw_context()
+
+
+def _parse_file(path):
+    """
+    Parse and validate a metadata file in a worker process.
+    Return (path, the list of the parsed rows, error), a row is a dict of the column values.
+    """
+    try:
+        exml = etree.parse(path, _worker_context.parser)
+    except Exception as e:
+        return path, None, "XML document is not well-formed. {}".format(e)
+    try:
+        rows = parse_records(_worker_context, exml)
+    except Exception as e:
+        return path, None, "Could not parse metadata record. {}".format(e)
+    return path, rows, None
+
+
+def _export_records(args):
+    """
+    Write the metadata records into xml files in a worker process. Return the number of the written files
+    """
+    pks, output_directory = args
+    identifier_column = mappings.MD_CORE_MODEL["mappings"]["pycsw:Identifier"]
+    xml_column = mappings.MD_CORE_MODEL["mappings"]["pycsw:XML"]
+    written = 0
+    for identifier, xml in Record.objects.filter(pk__in=pks).values_list(identifier_column, xml_column):
+        if identifier.find(":") != -1:
+            # it's a URN, sanitize identifier as pycsw does
+            identifier = identifier.split(":")[-1]
+        filename = os.path.join(output_directory, "{}.xml".format(identifier))
+        try:
+            with open(filename, "w") as f:
+                f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+                f.write(xml.encode("utf-8") if isinstance(xml, unicode) else xml)
+            written += 1
+        except Exception as e:
+            logger.error("Writing to file {} failed. {}".format(filename, e))
+    connection.close()
+    return written
+
+
 class PycswAdminHandler(object):
     config = None
     config_defaults = {"table": "records",}
@@ -22,6 +81,7 @@ class PycswAdminHandler(object):
     def __init__(self):
         self.config = None
         self.context = None
+        self.stdout = sys.stdout
 
     def parse_configuration(self, config, context):
         self.config = ConfigParser.SafeConfigParser(self.config_defaults)
@@ -55,24 +115,131 @@ class PycswAdminHandler(object):
                 admin.delete_records(self.context, database, table)
 
     def handle_load(self, args):
+        if args.workers > 1:
+            return self._load_records(args)
         database, table = self._get_db_settings()
         admin.load_records(self.context, database, table, args.input_directory,
                            args.recursive, args.accept_changes)
 
+    def _get_files(self, input_directory, recursive):
+        """
+        Return the metadata files to load, in the same way as pycsw
+        """
+        if os.path.isfile(input_directory):
+            return [input_directory]
+        elif recursive:
+            files = []
+            for root, dirs, names in os.walk(input_directory):
+                files.extend(os.path.join(root, name) for name in names if name.endswith(".xml"))
+            return sorted(files)
+        else:
+            return sorted(glob(os.path.join(input_directory, "*.xml")))
+
+    def _load_records(self, args):
+        """
+        Parse the metadata files with a pool of worker processes and write the records in batches in this process.
+        """
+        files = self._get_files(args.input_directory, args.recursive)
+        total = len(files)
+        #the worker processes don't share the database connection
+        connection.close()
+        pool = Pool(args.workers, initializer=_init_worker)
+        start = time.time()
+        processed = loaded = failed = 0
+        rows = OrderedDict()
+        try:
+            for path, parsed, error in pool.imap_unordered(_parse_file, files, chunksize=16):
+                processed += 1
+                if error:
+                    failed += 1
+                    logger.error("ERROR: {} not loaded: {}".format(path, error))
+                else:
+                    for row in parsed:
+                        #the last parsed record wins if an identifier is loaded more than once
+                        rows.pop(row.get("identifier"), None)
+                        rows[row.get("identifier")] = row
+                if len(rows) >= args.batch_size or (processed == total and rows):
+                    loaded += sum(save_records(rows, args.accept_changes))
+                    rows = OrderedDict()
+                    elapsed = time.time() - start
+                    self.stdout.write("Processed {} of {} files, loaded {} records in {:.2f}s ({:.0f} files/s)".format(
+                        processed, total, loaded, elapsed, processed / elapsed if elapsed else 0))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        if loaded:
+            #the signals are not sent by the bulk operations
+            bump_catalogue_generation()
+            schedule_records_view_refresh()
+        elapsed = time.time() - start
+        return "Loaded {} records from {} files in {:.2f}s ({:.0f} files/s), {} failed".format(
+            loaded, total, elapsed, total / elapsed if elapsed else 0, failed)
+
     def handle_export(self, args):
+        if args.workers > 1:
+            return self._export_records(args)
         database, table = self._get_db_settings()
         admin.export_records(self.context, database, table,
                              args.output_directory)
 
+    def _export_records(self, args):
+        """
+        Write the metadata records into xml files with a pool of worker processes, each worker writes a chunk of the records.
+        """
+        if not os.path.exists(args.output_directory):
+            os.makedirs(args.output_directory)
+        pks = list(Record.objects.order_by("pk").values_list("pk", flat=True))
+        chunk_size = 500
+        chunks = [(pks[i:i + chunk_size], args.output_directory) for i in xrange(0, len(pks), chunk_size)]
+        #the worker processes open their own database connections
+        connection.close()
+        pool = Pool(args.workers)
+        start = time.time()
+        written = 0
+        try:
+            for count in pool.imap_unordered(_export_records, chunks):
+                written += count
+                elapsed = time.time() - start
+                self.stdout.write("Exported {} of {} records in {:.2f}s ({:.0f} records/s)".format(
+                    written, len(pks), elapsed, written / elapsed if elapsed else 0))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return "Exported {} records".format(written)
+
     def handle_harvest(self, args):
+        if args.source:
+            return self._harvest_sources(args)
         database, table = self._get_db_settings()
         url = self.config.get("server", "url")
         admin.refresh_harvested_records(self.context, database, table, url)
 
+    def _harvest_sources(self, args):
+        """
+        Harvest the CSW sources concurrently, the unchanged records are skipped.
+        """
+        page_size = args.page_size
+        if not page_size:
+            config = PycswConfig.objects.first()
+            page_size = config.harvest_page_size if config else 10
+        harvester = Harvester(workers=args.workers, page_size=page_size, rate=args.rate,
+                              timeout=args.timeout, batch_size=args.batch_size, stdout=self.stdout)
+        stats = harvester.harvest(args.source)
+        return "Harvested {} records from {} sources in {:.2f}s, {} pages failed".format(
+            stats["records"], len(args.source), stats["elapsed"], stats["failed"])
+
     def handle_sitemap(self, args):
-        database, table = self._get_db_settings()
         url = self.config.get("server", "url")
-        admin.gen_sitemap(self.context, database, table, url, args.output_path)
+        writer = SitemapWriter(args.output_path, url, base_url=args.base_url, max_urls=args.max_urls)
+        shards, written = writer.write()
+        return "Written {} of {} sitemap files, the sitemap index is {}".format(written, shards, writer.index_path)
 
     def handle_post(self, args):
         return admin.post_xml(args.url, args.xml, args.timeout)
@@ -155,6 +322,13 @@ class PycswAdminHandler(object):
             action="store_true")
         parser.add_argument(
             "-y", "--accept-changes", help="Force updates", action="store_true")
+        parser.add_argument(
+            "-w", "--workers", type=int, default=1,
+            help="Number of processes to parse the files. The records are written in batches "
+                 "if greater than 1. Defaults to %(default)s")
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of records written in one transaction with --workers. Defaults to %(default)s")
         parser.set_defaults(func=self.handle_load)
 
     def _add_export_parser(self, subparsers_obj):
@@ -169,26 +343,56 @@ class PycswAdminHandler(object):
             "output_directory",
             help="path to output directory to write metadata records"
         )
+        parser.add_argument(
+            "-w", "--workers", type=int, default=1,
+            help="Number of processes to write the files. Defaults to %(default)s")
         parser.set_defaults(func=self.handle_export)
 
     def _add_harvest_parser(self, subparsers_obj):
         parser = subparsers_obj.add_parser(
             "harvest",
             help="Refresh harvested records",
-            description="Refresh harvested records"
+            description="Refresh harvested records. The CSW sources are harvested "
+                        "concurrently if specified with --source"
         )
+        parser.add_argument(
+            "-s", "--source", action="append", default=[],
+            help="The url of a CSW source to harvest. Can be specified multiple times")
+        parser.add_argument(
+            "-w", "--workers", type=int, default=4,
+            help="Number of the pages fetched at the same time. Defaults to %(default)s")
+        parser.add_argument(
+            "--rate", type=float, default=0,
+            help="Maximum number of requests per second to each source, 0 is unlimited. Defaults to %(default)s")
+        parser.add_argument(
+            "--page-size", type=int, default=None,
+            help="Number of records in a page. Defaults to the harvest page size of the pycsw configuration")
+        parser.add_argument(
+            "--timeout", type=int, default=30,
+            help="Timeout of a request in seconds. Defaults to %(default)s")
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of records written in one transaction. Defaults to %(default)s")
         parser.set_defaults(func=self.handle_harvest)
 
     def _add_sitemap_parser(self, subparsers_obj):
         parser = subparsers_obj.add_parser(
             "sitemap",
             help="Generate XML sitemap",
-            description="Generate an XML sitemap file"
+            description="Generate an XML sitemap index and the sitemap files of the records. "
+                        "Only the sitemap files whose records are changed are written again"
         )
         parser.add_argument(
             "-o", "--output-path",
-            help="full path to output file. Defaults to the current directory",
+            help="full path to the sitemap index file, the sitemap files are written into the same directory. "
+                 "Defaults to sitemap.xml in the current directory",
             default=".")
+        parser.add_argument(
+            "--base-url", default=None,
+            help="The url where the sitemap files are published. Defaults to the directory of the server url")
+        parser.add_argument(
+            "--max-urls", type=int, default=MAX_URLS,
+            help="Maximum number of urls in a sitemap file. Defaults to %(default)s")
         parser.set_defaults(func=self.handle_sitemap)
 
     def _add_post_parser(self, subparsers_obj):
@@ -285,6 +489,7 @@ class Command(BaseCommand):
         pycsw_config = build_pycsw_settings()
         context = StaticContext()
         self.pycsw_admin_handler.parse_configuration(pycsw_config, context)
+        self.pycsw_admin_handler.stdout = self.stdout
         ArgsObject = namedtuple("ArgsObject", options.keys())
         the_args = ArgsObject(**options)
         result = the_args.func(the_args)
@@ -0,0 +1,189 @@
+from __future__ import absolute_import
+import json
+import time
+import urlparse
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from ...models import Record, schedule_records_view_refresh
+from ...cache import bump_catalogue_generation
+
+
+class Command(BaseCommand):
+    help = """Regenerate the OWS links of the catalogue records in batches, for example after a GeoServer endpoint is moved.
+    The links are generated as OwsResourceSerializer does, and written with one update statement for each batch.
+    """
+    update_sql = """UPDATE catalogue_record AS r
+SET links = v.links, resource_links = v.resource_links::jsonb, service_type_version = v.service_type_version, modified = %s, fragments = NULL
+FROM (VALUES {}) AS v(id, links, resource_links, service_type_version)
+WHERE r.id = v.id"""
+
+    def add_arguments(self, parser):
+        parser.add_argument("-e", "--endpoint", action="append", default=[], metavar="OLD=NEW",
+                            help="Replace the endpoint prefix OLD with NEW. Can be specified multiple times. "
+                                 "If not specified, the links are regenerated with the current endpoints")
+        parser.add_argument("--wms-version", default=None, help="Regenerate the WMS and GWC links with this version")
+        parser.add_argument("--wfs-version", default=None, help="Regenerate the WFS links with this version")
+        parser.add_argument("--workspace", default=None, help="Only relink the records of the workspace")
+        parser.add_argument("--app", default=None, help="Only relink the records of the application")
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="Number of records updated in one transaction. Defaults to %(default)s")
+        parser.add_argument("--dry-run", action="store_true", default=False,
+                            help="Generate the links without saving them")
+
+    def get_queryset(self, options):
+        qs = Record.objects.exclude(links=None).exclude(links="")
+        if options["workspace"]:
+            qs = qs.filter(identifier__startswith="{}:".format(options["workspace"]))
+        if options["app"]:
+            qs = qs.filter(applicationlayer__application__name=options["app"])
+        return qs.only("id", "identifier", "crs", "bounding_box", "links", "resource_links", "service_type", "service_type_version")
+
+    def map_endpoint(self, endpoint):
+        """
+        Return the mapped endpoint; return None if the endpoint is not mapped
+        """
+        if not self.endpoints:
+            return endpoint
+        for old, new in self.endpoints:
+            if endpoint.startswith(old):
+                return new + endpoint[len(old):]
+        return None
+
+    def get_link_args(self, record, link):
+        """
+        Return the arguments of generate_ows_link to regenerate the link; return None if the link is not changed.
+        The parameters which were removed from the endpoint by generate_ows_link are added back.
+        """
+        schema = link["schema"]
+        endpoint = self.map_endpoint(schema["linkage"])
+        if endpoint is None:
+            return None
+        if schema["protocol"] == "OGC:WFS":
+            service_type = "WFS"
+            version = self.options["wfs_version"] or schema["version"]
+            parameters = [("SRSNAME", schema.get("crs"))]
+        elif schema["protocol"] == "OGC:WMS":
+            #the gwc links have the tile size
+            service_type = "GWC" if "width" in schema else "WMS"
+            version = self.options["wms_version"] or schema["version"]
+            parameters = [("SRS", schema.get("crs")), ("FORMAT", schema.get("format"))]
+            if service_type == "GWC":
+                parameters += [("WIDTH", schema.get("width")), ("HEIGHT", schema.get("height"))]
+        else:
+            return None
+        querystring = "&".join("{}={}".format(k, v) for k, v in parameters if v)
+        if querystring:
+            endpoint = "{}{}{}".format(endpoint, "&" if "?" in endpoint else "?", querystring)
+        return (endpoint, service_type, version)
+
+    @staticmethod
+    def link_key(link):
+        """
+        Return the comparable form of a link, the parameters of the link url can be in any order
+        """
+        url = urlparse.urlsplit(link["link"])
+        return (link["name"], link["description"], link["schema"], url[:3],
+                sorted(urlparse.parse_qsl(url.query, keep_blank_values=True)))
+
+    def relink(self, records):
+        """
+        Return a list of (record, links, service_type_version) for the records whose links are changed
+        """
+        relinks = []
+        targets = {}
+        for record in records:
+            links = [(link, self.get_link_args(record, link)) for link in record.ows_links]
+            if not any(args for link, args in links):
+                continue
+            relinks.append((record, links))
+            for link, args in links:
+                if args and link["schema"].get("crs"):
+                    targets.setdefault(link["schema"]["crs"], []).append(record)
+
+        #transform the bboxes of the batch with one pyproj call for each (source crs, target crs)
+        bboxes = {}
+        for target_crs, target_records in targets.iteritems():
+            try:
+                bboxes[target_crs] = Record.transform_bboxes(target_records, target_crs)
+            except Exception as e:
+                self.stderr.write("Transform the bboxes into crs({}) failed. {}".format(target_crs, e))
+                bboxes[target_crs] = {}
+
+        result = []
+        for record, links in relinks:
+            try:
+                ows_links = []
+                for link, args in links:
+                    if args:
+                        target_bbox = bboxes.get(link["schema"].get("crs"), {}).get(record.pk)
+                        link = Record.parse_link(record.generate_ows_link(*args, target_bbox=target_bbox))
+                    ows_links.append(link)
+            except Exception as e:
+                self.failed += 1
+                self.stderr.write("Relink record({}) failed. {}".format(record.identifier, e))
+                continue
+            service_type_version = record.service_type_version
+            if record.service_type == "WMS" and self.options["wms_version"]:
+                service_type_version = self.options["wms_version"]
+            elif record.service_type == "WFS" and self.options["wfs_version"]:
+                service_type_version = self.options["wfs_version"]
+            links = ows_links + record.style_links
+            if (service_type_version == record.service_type_version and
+                    map(self.link_key, links) == map(self.link_key, record.get_resource_links())):
+                #the regenerated links are the same, don't mark the record modified
+                continue
+            result.append((record, links, service_type_version))
+        return result
+
+    def save(self, relinks):
+        if not relinks or self.options["dry_run"]:
+            return
+        params = [timezone.now()]
+        for record, links, service_type_version in relinks:
+            record.set_resource_links(links)
+            params += [record.pk, record.links, json.dumps(record.resource_links), service_type_version]
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(self.update_sql.format(", ".join(["(%s, %s, %s, %s)"] * len(relinks))), params)
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.endpoints = []
+        for mapping in options["endpoint"]:
+            if "=" not in mapping:
+                raise CommandError("Incorrect endpoint mapping '{}', the format is OLD=NEW".format(mapping))
+            self.endpoints.append(tuple(v.strip() for v in mapping.split("=", 1)))
+        if options["batch_size"] <= 0:
+            raise CommandError("Batch size should be greater than 0")
+
+        qs = self.get_queryset(options).order_by("pk")
+        self.failed = 0
+        processed = 0
+        updated = 0
+        start = time.time()
+        last_pk = None
+        while True:
+            batch_start = time.time()
+            records = list((qs.filter(pk__gt=last_pk) if last_pk is not None else qs)[:options["batch_size"]])
+            if not records:
+                break
+            last_pk = records[-1].pk
+            relinks = self.relink(records)
+            self.save(relinks)
+            processed += len(records)
+            updated += len(relinks)
+            elapsed = time.time() - batch_start
+            self.stdout.write("Batch of {} records: {} relinked in {:.2f}s ({:.0f} records/s)".format(
+                len(records), len(relinks), elapsed, len(records) / elapsed if elapsed else 0))
+
+        if updated and not options["dry_run"]:
+            #the signals are not sent by the set-based updates
+            bump_catalogue_generation()
+            schedule_records_view_refresh()
+        elapsed = time.time() - start
+        self.stdout.write("{} {} of {} records in {:.2f}s ({:.0f} records/s), {} failed".format(
+            "Generated the links" if options["dry_run"] else "Relinked", updated, processed, elapsed,
+            processed / elapsed if elapsed else 0, self.failed))
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def recreate_application_views(apps, schema_editor):
+    """
+    The application views are created with 'r.*', recreate them to include the new column
+    """
+    Application = apps.get_model("catalogue", "Application")
+    for name in Application.objects.values_list("name", flat=True):
+        schema_editor.execute("CREATE OR REPLACE VIEW catalogue_record_{0} AS SELECT r.* FROM catalogue_application a join catalogue_applicationlayer l on a.id = l.application_id join catalogue_record r on l.layer_id = r.id WHERE a.name = '{0}' and r.active order by l.order, r.identifier".format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0023_record_legend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='fragments',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunSQL("CREATE OR REPLACE VIEW catalogue_record_all AS SELECT * FROM catalogue_record WHERE active"),
+        migrations.RunPython(recreate_application_views, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+def parse_links(apps, schema_editor):
+    Record = apps.get_model("catalogue", "Record")
+    for record in Record.objects.exclude(links=None).exclude(links="").only("id", "links").iterator():
+        links = []
+        for link in record.links.split("^"):
+            r = link.split("\t")
+            links.append({"name": r[0], "description": r[1], "schema": json.loads(r[2]), "link": r[3]})
+        Record.objects.filter(pk=record.pk).update(resource_links=links)
+
+
+def recreate_application_views(apps, schema_editor):
+    """
+    The application views are created with 'r.*', recreate them to include the new column
+    """
+    Application = apps.get_model("catalogue", "Application")
+    for name in Application.objects.values_list("name", flat=True):
+        schema_editor.execute("CREATE OR REPLACE VIEW catalogue_record_{0} AS SELECT r.* FROM catalogue_application a join catalogue_applicationlayer l on a.id = l.application_id join catalogue_record r on l.layer_id = r.id WHERE a.name = '{0}' and r.active order by l.order, r.identifier".format(name))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0024_record_fragments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='resource_links',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(parse_links, migrations.RunPython.noop),
+        #support the protocol lookups, for example resource_links__contains=[{"schema": {"protocol": "OGC:WMS"}}]
+        migrations.RunSQL(
+            "CREATE INDEX catalogue_record_resource_links_gin ON catalogue_record USING gin (resource_links jsonb_path_ops)",
+            "DROP INDEX catalogue_record_resource_links_gin"
+        ),
+        migrations.RunSQL("CREATE OR REPLACE VIEW catalogue_record_all AS SELECT * FROM catalogue_record WHERE active"),
+        migrations.RunPython(recreate_application_views, migrations.RunPython.noop),
+    ]
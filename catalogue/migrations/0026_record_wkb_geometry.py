@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+
+def recreate_application_views(apps, schema_editor):
+    """
+    The application views are created with 'r.*', recreate them to include the new column
+    """
+    Application = apps.get_model("catalogue", "Application")
+    for name in Application.objects.values_list("name", flat=True):
+        schema_editor.execute("CREATE OR REPLACE VIEW catalogue_record_{0} AS SELECT r.* FROM catalogue_application a join catalogue_applicationlayer l on a.id = l.application_id join catalogue_record r on l.layer_id = r.id WHERE a.name = '{0}' and r.active order by l.order, r.identifier".format(name))
+
+
+#keep wkb_geometry in sync with bounding_box for every write, including the writes from pycsw and the set-based updates.
+#the bounding box is in the record's crs, fall back to EPSG:4326 as pycsw does if the crs is not a known epsg code.
+create_trigger_sql = """
+CREATE OR REPLACE FUNCTION catalogue_record_update_geometry() RETURNS trigger AS $$
+BEGIN
+    NEW.wkb_geometry := NULL;
+    IF NEW.bounding_box IS NULL OR NEW.bounding_box = '' THEN
+        RETURN NEW;
+    END IF;
+    BEGIN
+        IF upper(NEW.crs) LIKE 'EPSG:%' THEN
+            NEW.wkb_geometry := ST_Transform(ST_GeomFromText(NEW.bounding_box, substring(NEW.crs from 6)::integer), 4326);
+        ELSE
+            NEW.wkb_geometry := ST_GeomFromText(NEW.bounding_box, 4326);
+        END IF;
+    EXCEPTION WHEN others THEN
+        BEGIN
+            NEW.wkb_geometry := ST_GeomFromText(NEW.bounding_box, 4326);
+        EXCEPTION WHEN others THEN
+            NEW.wkb_geometry := NULL;
+        END;
+    END;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER catalogue_record_update_geometry BEFORE INSERT OR UPDATE ON catalogue_record
+    FOR EACH ROW EXECUTE PROCEDURE catalogue_record_update_geometry();
+"""
+
+drop_trigger_sql = """
+DROP TRIGGER IF EXISTS catalogue_record_update_geometry ON catalogue_record;
+DROP FUNCTION IF EXISTS catalogue_record_update_geometry();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0025_record_resource_links'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='wkb_geometry',
+            field=django.contrib.gis.db.models.fields.GeometryField(blank=True, editable=False, null=True, srid=4326),
+        ),
+        migrations.RunSQL(create_trigger_sql, drop_trigger_sql),
+        #populate the geometry of the existing records
+        migrations.RunSQL("UPDATE catalogue_record SET bounding_box = bounding_box WHERE bounding_box IS NOT NULL", migrations.RunSQL.noop),
+        migrations.RunSQL("CREATE OR REPLACE VIEW catalogue_record_all AS SELECT * FROM catalogue_record WHERE active"),
+        migrations.RunPython(recreate_application_views, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def recreate_application_views(apps, schema_editor):
+    """
+    The application views are created with 'r.*', recreate them to include the new column
+    """
+    Application = apps.get_model("catalogue", "Application")
+    for name in Application.objects.values_list("name", flat=True):
+        schema_editor.execute("CREATE OR REPLACE VIEW catalogue_record_{0} AS SELECT r.* FROM catalogue_application a join catalogue_applicationlayer l on a.id = l.application_id join catalogue_record r on l.layer_id = r.id WHERE a.name = '{0}' and r.active order by l.order, r.identifier".format(name))
+
+
+#the column name is the one pycsw uses for the full text search of AnyText
+create_tsvector_sql = """
+ALTER TABLE catalogue_record ADD COLUMN anytext_tsvector tsvector;
+
+CREATE OR REPLACE FUNCTION catalogue_record_update_tsvector() RETURNS trigger AS $$
+BEGIN
+    NEW.anytext_tsvector :=
+        setweight(to_tsvector('english', coalesce(NEW.title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(NEW.keywords, '') || ' ' || coalesce(
+            (SELECT string_agg(t.name, ' ') FROM catalogue_tag t JOIN catalogue_record_tags rt ON rt.tag_id = t.id WHERE rt.record_id = NEW.id), ''
+        )), 'B') ||
+        setweight(to_tsvector('english', coalesce(NEW.abstract, '')), 'C') ||
+        setweight(to_tsvector('english', coalesce(NEW.any_text, '')), 'D');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER catalogue_record_update_tsvector BEFORE INSERT OR UPDATE ON catalogue_record
+    FOR EACH ROW EXECUTE PROCEDURE catalogue_record_update_tsvector();
+
+CREATE OR REPLACE FUNCTION catalogue_record_tags_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        UPDATE catalogue_record SET anytext_tsvector = NULL WHERE id = OLD.record_id;
+    ELSE
+        UPDATE catalogue_record SET anytext_tsvector = NULL WHERE id = NEW.record_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER catalogue_record_tags_changed AFTER INSERT OR UPDATE OR DELETE ON catalogue_record_tags
+    FOR EACH ROW EXECUTE PROCEDURE catalogue_record_tags_changed();
+
+CREATE OR REPLACE FUNCTION catalogue_tag_renamed() RETURNS trigger AS $$
+BEGIN
+    UPDATE catalogue_record SET anytext_tsvector = NULL WHERE id IN (SELECT record_id FROM catalogue_record_tags WHERE tag_id = NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER catalogue_tag_renamed AFTER UPDATE OF name ON catalogue_tag
+    FOR EACH ROW EXECUTE PROCEDURE catalogue_tag_renamed();
+
+UPDATE catalogue_record SET anytext_tsvector = NULL;
+
+--pycsw only uses the full text search of AnyText if the index 'fts_gin_idx' exists
+CREATE INDEX fts_gin_idx ON catalogue_record USING gin (anytext_tsvector);
+"""
+
+drop_tsvector_sql = """
+DROP TRIGGER IF EXISTS catalogue_tag_renamed ON catalogue_tag;
+DROP FUNCTION IF EXISTS catalogue_tag_renamed();
+DROP TRIGGER IF EXISTS catalogue_record_tags_changed ON catalogue_record_tags;
+DROP FUNCTION IF EXISTS catalogue_record_tags_changed();
+DROP TRIGGER IF EXISTS catalogue_record_update_tsvector ON catalogue_record;
+DROP FUNCTION IF EXISTS catalogue_record_update_tsvector();
+ALTER TABLE catalogue_record DROP COLUMN anytext_tsvector CASCADE;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0026_record_wkb_geometry'),
+    ]
+
+    operations = [
+        migrations.RunSQL(create_tsvector_sql, drop_tsvector_sql),
+        migrations.RunSQL("CREATE OR REPLACE VIEW catalogue_record_all AS SELECT * FROM catalogue_record WHERE active"),
+        migrations.RunPython(recreate_application_views, migrations.RunPython.noop),
+    ]
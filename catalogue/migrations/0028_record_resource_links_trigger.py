@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+#the links are also changed by pycsw (transactions, load and harvest), which doesn't know the parsed links.
+#the parsed links are reset if the links are changed without them, and are parsed again when requested
+create_trigger_sql = """
+CREATE OR REPLACE FUNCTION catalogue_record_reset_resource_links() RETURNS trigger AS $$
+BEGIN
+    IF NEW.links IS DISTINCT FROM OLD.links AND NEW.resource_links IS NOT DISTINCT FROM OLD.resource_links THEN
+        NEW.resource_links := NULL;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER catalogue_record_reset_resource_links BEFORE UPDATE ON catalogue_record
+    FOR EACH ROW EXECUTE PROCEDURE catalogue_record_reset_resource_links();
+"""
+
+drop_trigger_sql = """
+DROP TRIGGER IF EXISTS catalogue_record_reset_resource_links ON catalogue_record;
+DROP FUNCTION IF EXISTS catalogue_record_reset_resource_links();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0027_record_anytext_tsvector'),
+    ]
+
+    operations = [
+        migrations.RunSQL(create_trigger_sql, drop_trigger_sql),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+records_view_sql = "SELECT l.order AS layer_order, r.* FROM catalogue_application a join catalogue_applicationlayer l on a.id = l.application_id join catalogue_record r on l.layer_id = r.id WHERE a.name = '{}' and r.active"
+
+
+def recreate_application_views(apps, schema_editor):
+    """
+    Add the layer order column to the application views, the materialized views don't keep the order of the rows.
+    The column is the first one, so the views can't be replaced and are recreated in the same kind
+    """
+    Application = apps.get_model("catalogue", "Application")
+    for name in Application.objects.values_list("name", flat=True):
+        view_name = "catalogue_record_{}".format(name)
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relkind in ('v', 'm')", [view_name])
+            row = cursor.fetchone()
+        if row and row[0] == 'm':
+            schema_editor.execute("DROP MATERIALIZED VIEW {} CASCADE".format(view_name))
+            schema_editor.execute("CREATE MATERIALIZED VIEW {} AS {}".format(view_name, records_view_sql.format(name)))
+            schema_editor.execute("CREATE UNIQUE INDEX {0}_id ON {0} (id)".format(view_name))
+        else:
+            schema_editor.execute("DROP VIEW IF EXISTS {} CASCADE".format(view_name))
+            schema_editor.execute("CREATE VIEW {} AS {}".format(view_name, records_view_sql.format(name)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('catalogue', '0028_record_resource_links_trigger'),
+    ]
+
+    operations = [
+        migrations.RunPython(recreate_application_views, migrations.RunPython.noop),
+    ]
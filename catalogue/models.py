@@ -29,13 +29,18 @@ http://localhost:8000/csw/server/?
 import math
 import md5
 import base64
+import binascii
 import os
 import re
 import json
-
-import pyproj
-
-from django.db import models, connection
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import models, connection, transaction
+from django.contrib.postgres.fields import JSONField
+from django.contrib.gis.db.models import GeometryField
 from django.dispatch import receiver
 from django.db.models.signals import post_save, pre_save, post_delete, pre_delete
 from django.conf import settings
@@ -43,30 +48,19 @@ from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.utils import timezone
 
+from .epsg import EpsgRegistry
+from .projection import ProjectionCache
+
+logger = logging.getLogger(__name__)
+
 slug_re = re.compile(r'^[a-z0-9_]+$')
 validate_slug = RegexValidator(slug_re, "Slug can only contain lowercase letters, numbers and underscores", "invalid")
 
 
-#load extra epsg
-epsg_extra = {}
-try:
-    epsgs = None
-    with open(settings.EPSG_EXTRA_FILE, 'rb') as f:
-        epsgs = f.read()
-    epsg_re = re.compile("^<([0-9]+)>\s+(.+)\s+<>$")
-    epsgs = [l.strip() for l in epsgs.splitlines()]
-    #remove empty lines, comment lines and incorrect lines
-    epsgs = [l for l in epsgs if l and l[0] != "#"]
-    #parse each line
-    for l in epsgs:
-        try:
-            m = epsg_re.match(l)
-            if m:
-                epsg_extra["EPSG:{}".format(m.group(1))] = m.group(2)
-        except:
-            pass
-except:
-    pass
+#the extra epsg definitions are loaded on demand
+epsg_extra = EpsgRegistry(getattr(settings, "EPSG_EXTRA_FILE", None))
+
+projections = ProjectionCache(epsg_extra)
 
 class PreviewTile(object):
     @staticmethod
@@ -189,7 +183,51 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
-class Record(models.Model):
+class TrackedFieldsMixin(object):
+    """
+    Keep the loaded values of the tracked fields, so the changed fields can be found without querying the database.
+    """
+    tracked_fields = ()
+
+    def __init__(self, *args, **kwargs):
+        super(TrackedFieldsMixin, self).__init__(*args, **kwargs)
+        self._original_values = {}
+        self.take_snapshot()
+
+    def take_snapshot(self, fields=None):
+        """
+        Store the current values of the tracked fields, the deferred fields are not loaded.
+        """
+        for f in (fields or self.tracked_fields):
+            if f in self.tracked_fields and f in self.__dict__:
+                self._original_values[f] = self.__dict__[f]
+
+    def refresh_from_db(self, using=None, fields=None, **kwargs):
+        super(TrackedFieldsMixin, self).refresh_from_db(using=using, fields=fields, **kwargs)
+        self.take_snapshot(fields)
+
+    def get_changed_fields(self, fields=None):
+        """
+        Return the list of the tracked fields which are changed since the instance was loaded or saved.
+        The original values of the fields which were not loaded are read from the database.
+        """
+        fields = [f for f in (fields or self.tracked_fields) if f in self.tracked_fields]
+        if self.pk is None:
+            return fields
+        original_values = dict((f, self._original_values[f]) for f in fields if f in self._original_values)
+        missing = [f for f in fields if f not in original_values]
+        if missing:
+            values = self._meta.concrete_model._base_manager.filter(pk=self.pk).values(*missing).first()
+            if values is None:
+                return fields
+            original_values.update(values)
+        return [f for f in fields if getattr(self, f) != original_values[f]]
+
+
+class Record(TrackedFieldsMixin, models.Model):
+    #the columns exported to geoserver, the modified date is set if they are changed
+    tracked_fields = ("title", "abstract", "keywords", "links")
+
     identifier = models.CharField(
         max_length=255, db_index=True, help_text="Maps to pycsw:Identifier")
     title = models.CharField(max_length=255, null=True, blank=True, 
@@ -210,12 +248,16 @@ class Record(models.Model):
         help_text=' Maps to pycsw:XML'
     )
     any_text = models.TextField(help_text='Maps to pycsw:AnyText', null=True, blank=True)
+    #the weighted full text search vector 'anytext_tsvector' of title, keywords, tags, abstract and any_text
+    #is maintained by database triggers and is not a model field, see migration 0027
     modified = models.DateTimeField(
         null=True, blank=True, 
         help_text='Maps to pycsw:Modified'
     )
     bounding_box = models.TextField(null=True, blank=True, 
                                     help_text='Maps to pycsw:BoundingBox.It\'s a WKT geometry')
+    #the bounding box in EPSG:4326, maintained from bounding_box and crs by a database trigger. pycsw uses it for the spatial filters
+    wkb_geometry = GeometryField(srid=4326, null=True, blank=True, editable=False)
     abstract = models.TextField(blank=True, null=True, 
                                 help_text='Maps to pycsw:Abstract')
     keywords = models.CharField(max_length=255, blank=True, null=True, 
@@ -233,12 +275,17 @@ class Record(models.Model):
     )
     links = models.TextField(null=True, blank=True, editable=False, 
                              help_text='Maps to pycsw:Links')
+    #the parsed links, the 'links' column is serialised from it by 'set_resource_links'.
+    #reset by a database trigger if the links are changed without it, for example by pycsw
+    resource_links = JSONField(null=True, blank=True, editable=False)
     crs = models.CharField(max_length=255, null=True, blank=True, help_text='Maps to pycsw:CRS')
     # Custom fields
     active = models.BooleanField(default=True, editable=False)
 
     bbox_re = re.compile('POLYGON\s*\(\(([\+\-0-9\.]+)\s+([\+\-0-9\.]+)\s*\, \s*[\+\-0-9\.]+\s+[\+\-0-9\.]+\s*\, \s*([\+\-0-9\.]+)\s+([\+\-0-9\.]+)\s*\, \s*[\+\-0-9\.]+\s+[\+\-0-9\.]+\s*\, \s*[\+\-0-9\.]+\s+[\+\-0-9\.]+\s*\)\)')
     legend = models.FileField(upload_to='catalogue/legends', null=True, blank=True)
+    #precomputed csw:Record and gmd:MD_Metadata fragments (json), maintained by catalogue.fragments
+    fragments = models.TextField(null=True, blank=True, editable=False)
 
     @property 
     def bbox(self):
@@ -273,9 +320,8 @@ class Record(models.Model):
         links = self.ows_links
         resources = []
         for link in links:
-            r = re.split("\t", link)
-            sample_link = r[3]
-            r = json.loads(r[2])
+            sample_link = link['link']
+            r = link['schema']
             if 'WMS' in r['protocol']:
                 _type = 'WMS'
             elif 'WFS' in r['protocol']:
@@ -298,28 +344,43 @@ class Record(models.Model):
     def ows_links(self):
         return self.get_resource_links('ows')
     
-    def get_resource_links(self, _type):
-        if self.links:
-            links = self.links.split('^')
-        else:
-            links = []
-        if _type =='style':
-            style_links = []
-            for link in links:
-                r = re.split("\t", link)
-                r_json = json.loads(r[2])
-                if 'application' in r_json['protocol']:
-                    style_links.append(link)
-            links = style_links
+    def get_resource_links(self, _type=None):
+        """
+        Return the parsed links of the type ('style' or 'ows'), or all the links if type is None.
+        """
+        if self.resource_links is None:
+            #the links were not parsed yet, for example the record was loaded by pycsw
+            self.resource_links = [self.parse_link(link) for link in self.links.split('^')] if self.links else []
+        if _type == 'style':
+            return [link for link in self.resource_links if 'application' in link['schema']['protocol']]
         elif _type == 'ows':
-            ows_links = []
-            for link in links:
-                r = re.split("\t", link)
-                r_json = json.loads(r[2])
-                if 'OGC' in r_json['protocol']:
-                    ows_links.append(link)
-            links = ows_links
-        return links
+            return [link for link in self.resource_links if 'OGC' in link['schema']['protocol']]
+        else:
+            return list(self.resource_links)
+
+    def set_resource_links(self, links):
+        """
+        Set the parsed links and serialise them into the pycsw links column
+        """
+        self.resource_links = links
+        self.links = '^'.join(self.format_link(link) for link in links)
+
+    @staticmethod
+    def parse_link(link):
+        """
+        Parse a link with pycsw format 'name\tdescription\tprotocol\turl', the protocol is a json string
+        """
+        r = re.split("\t", link)
+        return {
+            'name': r[0],
+            'description': r[1],
+            'schema': json.loads(r[2]),
+            'link': r[3]
+        }
+
+    @staticmethod
+    def format_link(link):
+        return u'{0}\t{1}\t{2}\t{3}'.format(link['name'], link['description'], json.dumps(link['schema']), link['link'])
 
     def _calculate_from_bbox(self, side):
         bbox = []
@@ -342,7 +403,32 @@ class Record(models.Model):
             elif side == 'height':
                 return int(bbox[3]) - int(bbox[1])
 
-    def generate_ows_link(self, endpoint, service_type, service_version):
+    @staticmethod
+    def transform_bboxes(records, target_crs):
+        """
+        Transform the bboxes of the records into the target crs with one pyproj call for each source crs.
+        Return a dict: record id -> transformed bbox, which can be passed to generate_ows_link.
+        The records whose crs can't be transformed are not in the result, generate_ows_link reports the error of each record.
+        """
+        bboxes = {}
+        for record in records:
+            bbox = record.bbox
+            if bbox and record.crs and record.crs.upper() != target_crs.upper():
+                bboxes.setdefault(record.crs.upper(), []).append((record.pk, bbox))
+        result = {}
+        for crs, items in bboxes.iteritems():
+            try:
+                transformed_bboxes = projections.transform_bboxes(crs, target_crs, [b for k, b in items])
+            except Exception:
+                continue
+            for (pk, bbox), transformed in zip(items, transformed_bboxes):
+                result[pk] = transformed
+        return result
+
+    def generate_ows_link(self, endpoint, service_type, service_version, target_bbox=None):
+        """
+        target_bbox: the bbox already transformed into the target crs, see transform_bboxes
+        """
         if service_version in ("1.1.0", "1.1"):
             service_version = "1.1.0"
         elif service_version in ("2.0.0", "2", "2.0"):
@@ -376,18 +462,7 @@ class Record(models.Model):
 
             if target_crs and target_crs != self.crs:
                 try:
-                    if self.crs.upper() in epsg_extra:
-                        p1 = pyproj.Proj(epsg_extra[self.crs.upper()])
-                    else:
-                        p1 = pyproj.Proj(init=self.crs)
-
-                    if target_crs in epsg_extra:
-                        p2 = pyproj.Proj(epsg_extra[target_crs])
-                    else:
-                        p2 = pyproj.Proj(init=target_crs)
-
-                    bbox[0], bbox[1] = pyproj.transform(p1, p2, bbox[0], bbox[1])
-                    bbox[2], bbox[3] = pyproj.transform(p1, p2, bbox[2], bbox[3])
+                    bbox = target_bbox or projections.transform_bbox(self.crs, target_crs, bbox)
                 except Exception as e:
                     raise ValidationError("Transform the bbox of layer({0}) from crs({1}) to crs({2}) failed.{3}".format(self.identifier, self.crs, target_crs, str(e)))
             else:
@@ -474,11 +549,7 @@ class Record(models.Model):
             }
             if not bbox:
                 #bbox is null, use australian bbox
-                bbox = [108.0000, -45.0000, 155.0000, -10.0000]
-                p1 = pyproj.Proj(init="EPSG:4283")
-                p2 = pyproj.Proj(init=target_crs)
-                bbox[0], bbox[1] = pyproj.transform(p1, p2, bbox[0], bbox[1])
-                bbox[2], bbox[3] = pyproj.transform(p1, p2, bbox[2], bbox[3])
+                bbox = projections.transform_bbox("EPSG:4283", target_crs, [108.0000, -45.0000, 155.0000, -10.0000])
 
             if not hasattr(PreviewTile, target_crs.replace(":", "_")):
                 raise Exception("GWC service don't support crs({}) ").format(target_crs)
@@ -532,17 +603,39 @@ class Record(models.Model):
         return 'None\tNone\t{0}\t{1}/media/{2}'.format(json.dumps(schema), settings.BASE_URL, style.content)
 
     @staticmethod
-    def update_links(resources, record):
-        pos = 1
-        links = ''
-        for r in resources:
-            if pos == 1:
-                links += r
-            else:
-                links += '^{0}'.format(r)
-            pos += 1
-        record.links = links
-        record.save()
+    def update_links(resources, record, only_changed=False):
+        """
+        resources is a list of parsed links or links with pycsw format
+        if only_changed is True, the record is only saved if the links are changed
+        """
+        record.set_resource_links([Record.parse_link(r) if isinstance(r, basestring) else r for r in resources])
+        if not only_changed or record.get_changed_fields(["links"]):
+            record.save()
+
+    def update_styles(self, default_styles=None):
+        """
+        Set the default style of each format and regenerate the style links with one query, save the record if changed.
+        default_styles is a dict of the preferred default style's pk for each format.
+        """
+        default_styles = default_styles or {}
+        styles = list(self.styles.order_by("pk"))
+        changed_styles = []
+        for style_format in set(style.format for style in styles):
+            candidates = [style for style in styles if style.format == style_format]
+            default_style = next((style for style in candidates if style.pk == default_styles.get(style_format)), None) or \
+                next((style for style in candidates if style.default), None) or \
+                next((style for style in candidates if style.name == Style.BUILTIN), None) or \
+                min(candidates, key=lambda style: style.name)
+            for style in candidates:
+                if style.default != (style is default_style):
+                    style.default = style is default_style
+                    changed_styles.append(style)
+        for default in (True, False):
+            pks = [style.pk for style in changed_styles if style.default == default]
+            if pks:
+                Style.objects.filter(pk__in=pks).update(default=default)
+        #the default flag is part of the style links, the modified date is set if the default styles are changed
+        Record.update_links(self.ows_links + [Record.parse_link(Record.generate_style_link(style)) for style in styles], self, only_changed=True)
 
     @property
     def width(self):
@@ -617,9 +710,8 @@ class Record(models.Model):
 def update_modify_date(sender, instance, **kwargs):
     if instance.pk:
         update_fields=kwargs.get("update_fields", None)
-        if not update_fields or any([f in ("title","abstract","keywords","links") for f in update_fields]):
-            db_instance = Record.objects.get(pk = instance.pk)
-            if any([getattr(db_instance,f) != getattr(instance,f) for f in ("title","abstract","keywords","links")]):
+        if not update_fields or any([f in Record.tracked_fields for f in update_fields]):
+            if instance.get_changed_fields(update_fields):
                 #geoserver related columns are changed, set the modified to now
                 instance.modified = timezone.now()
                 #add field "modified" into the update field list.
@@ -630,8 +722,12 @@ def update_modify_date(sender, instance, **kwargs):
                     update_fields.append("modified")
     
 
+@receiver(post_save, sender=Record)
+def take_record_snapshot(sender, instance, **kwargs):
+    instance.take_snapshot(kwargs.get("update_fields", None))
+
 
-class Style(models.Model):
+class Style(TrackedFieldsMixin, models.Model):
     BUILTIN = "builtin"
     FORMAT_CHOICES = (
         ('SLD', 'SLD'), 
@@ -645,6 +741,8 @@ class Style(models.Model):
     content = models.FileField(upload_to='catalogue/styles')
     checksum = models.CharField(blank=True, max_length=255, editable=False)
 
+    tracked_fields = ("default",)
+
     @property
     def identifier(self):
         return "{}:{}".format(self.record.identifier, self.name)
@@ -678,85 +776,181 @@ class Style(models.Model):
             super(Style, self).delete(using)
 
     def save(self, *args, **kwargs):
-        update_fields=None
-        clean_name = self.name.split('.')
-        self.content.name = 'catalogue/styles/{}_{}.{}'.format(self.record.identifier.replace(':', '_'), clean_name[0], self.format.lower())
-        if self.pk is not None:
-            update_fields=kwargs.get("update_fields", ["default", "content", "checksum"])
-            if "content" in update_fields:
-                if "checksum" not in update_fields: update_fields.append("checksum")
-                orig = Style.objects.get(pk=self.pk)
-                if orig.content:
-                    if orig.checksum != self._calculate_checksum(self.content):
-                        if os.path.isfile(orig.content.path):
-                            os.remove(orig.content.path)
-
-                        if os.path.isfile(self.content.path):
-                            #the style file exists in the file system, remove it
-                            os.remove(self.content.path)
-
-                    else:
-                        #content is not changed, no need to update content and checksum
+        #the content lock taken by store_content is held until the style is saved
+        with transaction.atomic():
+            update_fields=None
+            orig_content = None
+            if self.pk is not None:
+                update_fields=list(kwargs.get("update_fields", ["default", "content", "checksum"]))
+            if self.pk is None or "content" in update_fields:
+                orig = Style.objects.filter(pk=self.pk).values_list("content", "checksum").first() if self.pk is not None else None
+                self.store_content()
+                if orig and orig == (self.content.name, self.checksum):
+                    #content is not changed, no need to update content and checksum
+                    if update_fields is not None:
                         update_fields = [field for field in update_fields if field not in ["content", "checksum"]]
                         if not update_fields:
                             #nothing is needed to update.
                             return
                 else:
-                    if os.path.isfile(orig.content.path):
-                        os.remove(orig.content.path)
-                    if os.path.isfile(self.content.path):
-                        #the style file exists in the file system, remove it
-                        os.remove(self.content.path)
-
-        if update_fields:
-            kwargs["update_fields"] = update_fields
-        super(Style, self).save(*args, **kwargs)
-        
+                    if update_fields is not None and "checksum" not in update_fields:
+                        update_fields.append("checksum")
+                    orig_content = orig[0] if orig else None
+
+            if update_fields:
+                kwargs["update_fields"] = update_fields
+            super(Style, self).save(*args, **kwargs)
+            if orig_content and orig_content != self.content.name:
+                Style.release_content(orig_content)
+
     def __unicode__(self):
         return self.name
-    
-    def _calculate_checksum(self, content):
+
+    @staticmethod
+    def calculate_checksum(content):
+        """
+        Return the base64 and the hex md5 digest of the content, the content is read once in chunks.
+        """
         checksum = md5.new()
-        checksum.update(content.read())
-        return base64.b64encode(checksum.digest())
+        for chunk in content.chunks():
+            checksum.update(chunk)
+        digest = checksum.digest()
+        return base64.b64encode(digest), binascii.hexlify(digest)
+
+    def store_content(self, checksum=None):
+        """
+        Store the uploaded content with the content addressed name 'catalogue/styles/<md5>.<format>'.
+        The file is only written if no other style has the same content.
+        checksum is the result of calculate_checksum if it is already calculated.
+        """
+        if self.content._committed:
+            #the content is already stored
+            if self.content and not self.checksum:
+                self.checksum = Style.calculate_checksum(self.content)[0]
+            return
+        checksum, digest = checksum or Style.calculate_checksum(self.content)
+        self.checksum = checksum
+        name = "catalogue/styles/{}.{}".format(digest, self.format.lower())
+        #the file can't be removed by release_content until the current transaction is finished
+        Style.lock_content(name)
+        if self.content.storage.exists(name):
+            #the same content is shared with other styles
+            self.content = name
+        else:
+            self.content.save(os.path.basename(name), self.content.file, save=False)
+
+    @staticmethod
+    def lock_content(name):
+        """
+        Lock the style file until the end of the current transaction
+        """
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_advisory_xact_lock(hashtext('catalogue_style_content'), hashtext(%s))", [name])
+
+    @staticmethod
+    def release_content(name, exclude_pk=None):
+        """
+        Remove the style file after the current transaction is committed if it is not used by any style.
+        The file is not removed if the transaction is rolled back.
+        """
+        def _release():
+            with transaction.atomic():
+                #the styles which are storing the same content are committed or rolled back before the check
+                Style.lock_content(name)
+                styles = Style.objects.filter(content=name)
+                if exclude_pk is not None:
+                    styles = styles.exclude(pk=exclude_pk)
+                if not styles.exists():
+                    storage = Style._meta.get_field("content").storage
+                    if storage.exists(name):
+                        storage.delete(name)
+        transaction.on_commit(_release)
+
+
+_style_batch = threading.local()
+
+@contextmanager
+def batch_style_import():
+    """
+    Save or delete the styles in a batch.
+    The links and the default styles of a record are not updated for each style,
+    they are updated once for each changed record when the batch exits, and each record is saved once.
+    """
+    if getattr(_style_batch, "records", None) is not None:
+        #in a batch already
+        yield
+        return
+    _style_batch.records = OrderedDict()
+    _style_batch.defaults = {}
+    try:
+        with transaction.atomic():
+            yield
+            records, defaults = _style_batch.records, _style_batch.defaults
+            _style_batch.records = _style_batch.defaults = None
+            #the records can be deleted in the batch
+            existing = set(Record.objects.filter(pk__in=records.keys()).values_list("pk", flat=True))
+            for pk, record in records.iteritems():
+                if pk in existing:
+                    record.update_styles(defaults.get(pk))
+    finally:
+        _style_batch.records = _style_batch.defaults = None
+
+def _batch_style_changed(style):
+    """
+    Add the style's record into the current batch. Return False if not in a batch
+    """
+    records = getattr(_style_batch, "records", None)
+    if records is None:
+        return False
+    if style.record_id not in records:
+        records[style.record_id] = style.record
+    return True
+
+@receiver(post_save, sender=Style)
+def batch_default_style(sender, instance, **kwargs):
+    defaults = getattr(_style_batch, "defaults", None)
+    if defaults is not None and instance.default:
+        #the last saved default style of each format is the default style
+        defaults.setdefault(instance.record_id, {})[instance.format] = instance.pk
 
 @receiver(pre_save, sender=Style)
 def update_links(sender, instance, **kwargs):
-    link = Record.generate_style_link(instance)
-    links_parts = re.split("\t", link)
-    json_link = json.loads(links_parts[2])
-    present = False
+    if _batch_style_changed(instance):
+        return
+    link = Record.parse_link(Record.generate_style_link(instance))
+    json_link = link['schema']
     style_links = instance.record.style_links
     ows_links = instance.record.ows_links
-    if not instance.record.links:
-        instance.record.links = ''
-    for style_link in style_links:
-        parts = re.split("\t", style_link)
-        r = json.loads(parts[2])
-        if r['name'] == json_link['name'] and r['protocol'] == json_link['protocol']:
+    present = False
+    for i, r in enumerate(style_links):
+        if r['schema']['name'] == json_link['name'] and r['schema']['protocol'] == json_link['protocol']:
             present = True
+            if r['link'] != link['link']:
+                #the style content is stored with another name
+                style_links[i] = link
+                Record.update_links(ows_links + style_links, instance.record, only_changed=True)
+            break
     if not present:
         style_links.append(link)
         links = ows_links + style_links
-        Record.update_links(links, instance.record)
+        Record.update_links(links, instance.record, only_changed=True)
 
 @receiver(post_delete, sender=Style)
 def remove_style_links(sender, instance, **kwargs):
+    if _batch_style_changed(instance):
+        return
     style_links = instance.record.style_links
     ows_links = instance.record.ows_links
     #remote deleted style's link
-    for link in style_links:
-        parts = re.split("\t", link)
-        r = json.loads(parts[2])
-        if r['name'] == instance.name and instance.format.lower() in r['protocol']:
-            style_links.remove(link)
+    style_links = [link for link in style_links
+                   if not (link['schema']['name'] == instance.name and instance.format.lower() in link['schema']['protocol'])]
 
     links = ows_links + style_links
-    Record.update_links(links, instance.record)
+    Record.update_links(links, instance.record, only_changed=True)
 
 @receiver(pre_save, sender=Style)
 def set_default_style (sender, instance, **kwargs):
-    if getattr(instance,"triggered_default_style_setting",False):
+    if getattr(instance,"triggered_default_style_setting",False) or _batch_style_changed(instance):
         return
     update_fields=kwargs.get("update_fields", None)
     if not instance.pk or not update_fields or "default" in update_fields:
@@ -777,30 +971,27 @@ def set_default_style (sender, instance, **kwargs):
             if not default_style or default_style.pk == instance.pk:
                 #no default style is configured, set the current one as default style
                 instance.default = True
-                #if default style is changed, set the latiest modifyed date
-                instance.record.modified = timezone.now()
-                instance.record.save(update_fields=["modified"])
+                if instance.get_changed_fields(["default"]):
+                    #if default style is changed, set the latiest modifyed date
+                    instance.record.modified = timezone.now()
+                    instance.record.save(update_fields=["modified"])
 
-@receiver(pre_save, sender=Style)
-def set_checksum (sender, instance, **kwargs):
-    update_fields=kwargs.get("update_fields", None)
-    if not update_fields or "checksum" in update_fields:
-        checksum = md5.new()
-        checksum.update(instance.content.read())
-        instance.checksum = base64.b64encode(checksum.digest())
+@receiver(post_save, sender=Style)
+def take_style_snapshot(sender, instance, **kwargs):
+    instance.take_snapshot(kwargs.get("update_fields", None))
 
 @receiver(post_delete, sender=Style)
 def auto_remove_style_from_disk_on_delete(sender, instance, **kwargs):
     """ Deletes the style file from disk when the
         object is deleted
     """
-    if instance.default:
+    if instance.default and not _batch_style_changed(instance):
         #deleted style is the default style, reset the default style
             instance.record.setup_default_styles(instance.format)
 
     if instance.content:
-        if os.path.isfile(instance.content.path):
-            os.remove(instance.content.path)
+        #the style file can be shared with other styles
+        Style.release_content(instance.content.name, instance.pk)
 
 
 class Application(models.Model):
@@ -813,10 +1004,67 @@ class Application(models.Model):
     create_time = models.DateTimeField(auto_now_add=True, null=False)
     records = models.ManyToManyField(Record)
 
+    #the records of the application with the layer order. The rows of a view are not ordered (a materialized view
+    #doesn't keep the order after it is refreshed), the queries are ordered by 'layer_order', see DatasetRegistry
+    records_view_sql = "SELECT l.order AS layer_order, r.* FROM catalogue_application a join catalogue_applicationlayer l on a.id = l.application_id join catalogue_record r on l.layer_id = r.id WHERE a.name = '{}' and r.active"
+
     @staticmethod
     def get_view_name(app):
         return "catalogue_record_{}".format(app)
 
+    @staticmethod
+    def use_materialized_views():
+        return getattr(settings, "CSW_MATERIALIZED_APPLICATION_VIEWS", False)
+
+    @staticmethod
+    def _get_view_kind(cursor, app):
+        """
+        Return 'v' for view, 'm' for materialized view; return None if not exist
+        """
+        cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s AND relkind in ('v', 'm')", [Application.get_view_name(app)])
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def drop_records_view(cursor, app):
+        kind = Application._get_view_kind(cursor, app)
+        if kind == 'm':
+            cursor.execute("DROP MATERIALIZED VIEW {} CASCADE".format(Application.get_view_name(app)))
+        elif kind == 'v':
+            cursor.execute("DROP VIEW {} CASCADE".format(Application.get_view_name(app)))
+
+    @staticmethod
+    def create_records_view(cursor, app):
+        """
+        Create the records view of the application.
+        A materialized view with an unique index is created if CSW_MATERIALIZED_APPLICATION_VIEWS is enabled,
+        so it can be refreshed concurrently.
+        """
+        view_name = Application.get_view_name(app)
+        if Application.use_materialized_views():
+            Application.drop_records_view(cursor, app)
+            cursor.execute("CREATE MATERIALIZED VIEW {} AS {}".format(view_name, Application.records_view_sql.format(app)))
+            cursor.execute("CREATE UNIQUE INDEX {0}_id ON {0} (id)".format(view_name))
+        else:
+            if Application._get_view_kind(cursor, app) == 'm':
+                Application.drop_records_view(cursor, app)
+            cursor.execute("CREATE OR REPLACE VIEW {} AS {}".format(view_name, Application.records_view_sql.format(app)))
+
+    @staticmethod
+    def refresh_records_views(apps=None):
+        """
+        Refresh the materialized records views of the applications, or all applications if apps is None.
+        """
+        if apps is None:
+            apps = Application.objects.values_list("name", flat=True)
+        cursor = connection.cursor()
+        for app in apps:
+            try:
+                if Application._get_view_kind(cursor, app) == 'm':
+                    cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY {}".format(Application.get_view_name(app)))
+            except:
+                logger.exception("Refresh the records view of application({}) failed.".format(app))
+
 
     @property
     def records_view(self):
@@ -832,10 +1080,13 @@ class ApplicationEventListener(object):
     @staticmethod
     @receiver(pre_delete, sender=Application)
     def _pre_delete(sender, instance, **args):
+        #the reflected view of this application is invalid now
+        from .repository import dataset_registry
+        dataset_registry.invalidate(instance.name)
         #remove the view for this application
         try:
             cursor = connection.cursor()
-            cursor.execute("DROP VIEW {} CASCADE".format(instance.records_view))
+            Application.drop_records_view(cursor, instance.name)
         except:
             #drop failed, maybe the view does not exist, ignore the exception
             connection._rollback()
@@ -844,15 +1095,27 @@ class ApplicationEventListener(object):
     @staticmethod
     @receiver(pre_save, sender=Application)
     def _pre_save(sender, instance, **args):
+        #the reflected view of this application is invalid now, also invalidate the old one if the application is renamed
+        from .repository import dataset_registry
+        dataset_registry.invalidate(instance.name)
+        if instance.pk:
+            for name in Application.objects.filter(pk=instance.pk).exclude(name=instance.name).values_list("name", flat=True):
+                dataset_registry.invalidate(name)
         #create a view for this application
         try:
             cursor = connection.cursor()
-            cursor.execute("CREATE OR REPLACE VIEW {} AS SELECT r.* FROM catalogue_application a join catalogue_applicationlayer l on a.id = l.application_id join catalogue_record r on l.layer_id = r.id WHERE a.name = '{}' and r.active order by l.order, r.identifier".format(instance.records_view, instance.name))
+            Application.create_records_view(cursor, instance.name)
         except Exception as e:
             #create view failed
             connection._rollback()
             raise ValidationError(e)
 
+    @staticmethod
+    @receiver(post_save, sender=Application)
+    def _post_save(sender, instance, **args):
+        #the materialized view is created before the application is saved
+        schedule_records_view_refresh([instance.name])
+
 class ApplicationLayer(models.Model):
     """
     The relationship between application and layer
@@ -869,3 +1132,40 @@ class ApplicationLayer(models.Model):
         ordering = ['application', 'order', 'layer']
 
 
+_pending_refresh = threading.local()
+
+def _refresh_records_views():
+    apps = getattr(_pending_refresh, "apps", None)
+    _pending_refresh.apps = set()
+    if apps:
+        Application.refresh_records_views(apps)
+
+def schedule_records_view_refresh(apps=None):
+    """
+    Refresh the materialized records views of the applications (all applications if apps is None)
+    after the current transaction is committed. The refreshes in a transaction are merged.
+    """
+    if not Application.use_materialized_views():
+        return
+    if apps is None:
+        apps = Application.objects.values_list("name", flat=True)
+    if not hasattr(_pending_refresh, "apps"):
+        _pending_refresh.apps = set()
+    _pending_refresh.apps.update(apps)
+    transaction.on_commit(_refresh_records_views)
+
+class ApplicationLayerEventListener(object):
+    @staticmethod
+    @receiver(post_save, sender=ApplicationLayer)
+    @receiver(post_delete, sender=ApplicationLayer)
+    def _layer_changed(sender, instance, **args):
+        schedule_records_view_refresh(Application.objects.filter(pk=instance.application_id).values_list("name", flat=True))
+
+    @staticmethod
+    @receiver(post_save, sender=Record)
+    def _record_changed(sender, instance, **args):
+        update_fields = args.get("update_fields", None)
+        if update_fields and all(f == "fragments" for f in update_fields):
+            return
+        if Application.use_materialized_views():
+            schedule_records_view_refresh(Application.objects.filter(applicationlayer__layer=instance).values_list("name", flat=True))
@@ -0,0 +1,76 @@
+"""
+Cached pyproj projections and batched bbox transforms
+
+Creating a pyproj projection parses the proj4 definition, which is much more
+expensive than transforming a few points. The projections are cached by crs,
+and the bboxes are transformed with one pyproj call for all the corners.
+"""
+import threading
+from collections import OrderedDict
+
+import pyproj
+
+
+class ProjectionCache(object):
+    """
+    A LRU cache of the pyproj projection pairs, key is (source crs, target crs).
+    definitions is a dict or an EpsgRegistry of the extra proj4 definitions, key is the upper case crs.
+    The crs which is not in the definitions is initialised from pyproj's own database.
+    """
+    def __init__(self, definitions, max_size=64):
+        self.definitions = definitions
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._projs = {}
+        self._pairs = OrderedDict()
+
+    def get_proj(self, crs):
+        crs = crs.upper()
+        proj = self._projs.get(crs)
+        if proj is None:
+            definition = self.definitions.get(crs)
+            if definition:
+                proj = pyproj.Proj(definition)
+            else:
+                proj = pyproj.Proj(init=crs)
+            self._projs[crs] = proj
+        return proj
+
+    def get(self, source_crs, target_crs):
+        """
+        Return the projection pair (source projection, target projection)
+        """
+        key = (source_crs.upper(), target_crs.upper())
+        with self._lock:
+            pair = self._pairs.pop(key, None)
+            if pair is None:
+                pair = (self.get_proj(source_crs), self.get_proj(target_crs))
+            #move to the end as the most recently used one
+            self._pairs[key] = pair
+            while len(self._pairs) > self.max_size:
+                key = self._pairs.popitem(last=False)[0]
+                #remove the projections which are not used by any cached pair
+                used = set(c for k in self._pairs for c in k)
+                for crs in key:
+                    if crs not in used:
+                        self._projs.pop(crs, None)
+            return pair
+
+    def transform_bboxes(self, source_crs, target_crs, bboxes):
+        """
+        Transform a list of bboxes [minx, miny, maxx, maxy] with one pyproj call.
+        Return a list of the transformed bboxes
+        """
+        if not bboxes:
+            return []
+        p1, p2 = self.get(source_crs, target_crs)
+        xs = []
+        ys = []
+        for bbox in bboxes:
+            xs.extend((bbox[0], bbox[2]))
+            ys.extend((bbox[1], bbox[3]))
+        xs, ys = pyproj.transform(p1, p2, xs, ys)
+        return [[xs[i], ys[i], xs[i + 1], ys[i + 1]] for i in xrange(0, len(xs), 2)]
+
+    def transform_bbox(self, source_crs, target_crs, bbox):
+        return self.transform_bboxes(source_crs, target_crs, [bbox])[0]
@@ -1,16 +1,75 @@
 """
 Build pycsw settings
 """
+import copy
 import os.path
+import uuid
 
 from django.core.urlresolvers import reverse
+from django.core.cache import cache
 from django.conf import settings
 from django.apps import apps
+from django.db import transaction
+from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
 
-from .models import PycswConfig
+from .models import PycswConfig, Collaborator, Organization
+
+#cache key of the version stamp shared by all the worker processes
+SETTINGS_VERSION_KEY = "catalogue_pycsw_settings_version"
+
+#process local settings cache. key is app name, value is (version, settings)
+_settings_cache = {}
+
+
+def get_settings_version():
+    """
+    Return the version stamp of the pycsw settings shared by all the worker processes
+    """
+    version = cache.get(SETTINGS_VERSION_KEY)
+    if version is None:
+        #version stamp does not exist or is evicted, initialize it.
+        cache.add(SETTINGS_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(SETTINGS_VERSION_KEY)
+    return version
+
+
+def invalidate_pycsw_settings():
+    """
+    Discard the settings cached by this process and publish a new version stamp,
+    so other worker processes will rebuild their settings on the next request.
+    """
+    _settings_cache.clear()
+    cache.set(SETTINGS_VERSION_KEY, uuid.uuid4().hex, None)
+
+
+@receiver(post_save, sender=PycswConfig)
+@receiver(post_delete, sender=PycswConfig)
+@receiver(post_save, sender=Collaborator)
+@receiver(post_delete, sender=Collaborator)
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+def _pycsw_settings_changed(sender, instance, **kwargs):
+    #other processes may rebuild the settings from the old rows before the change is committed
+    transaction.on_commit(invalidate_pycsw_settings)
 
 
 def build_pycsw_settings(app=None):
+    """
+    Return the pycsw settings for the app.
+    The settings are cached per app in the process and rebuilt only if
+    the version stamp is changed.
+    """
+    version = get_settings_version()
+    cached = _settings_cache.get(app)
+    if not cached or cached[0] != version:
+        cached = (version, _build_pycsw_settings(app))
+        _settings_cache[app] = cached
+    #return a copy, the caller is free to change it.
+    return copy.deepcopy(cached[1])
+
+
+def _build_pycsw_settings(app=None):
     record_table = "public.catalogue_record"
     config = PycswConfig.objects.first()
     if app:
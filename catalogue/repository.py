@@ -0,0 +1,338 @@
+"""
+Pool of initialised pycsw repositories and registry of the reflected
+application record views shared by the CSW requests
+
+pycsw creates a new repository for every request, which reflects the record
+table, detects the postgis version and opens a new session. The repositories
+are kept in a per-worker pool keyed by (database, table, filter) and reused
+by the following requests; only a new session is created for each request.
+"""
+import copy
+import logging
+import threading
+import uuid
+from collections import OrderedDict
+from itertools import chain
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from sqlalchemy import Table, event, exc, select
+from sqlalchemy import inspection, log
+from sqlalchemy import util as sqlalchemy_util
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import create_session
+from sqlalchemy.orm.mapper import Mapper as BaseMapper
+from sqlalchemy.sql import util as sql_util
+
+try:
+    from pycsw import repository as pycsw_repository
+except ImportError:
+    from pycsw.core import repository as pycsw_repository
+
+from .models import Application
+
+logger = logging.getLogger(__name__)
+
+
+def enable_pre_ping(engine):
+    """
+    Test the connection before it is used, and reconnect if the connection was
+    closed by the database server. It is the 'pessimistic disconnect handling'
+    recipe from sqlalchemy documents.
+    """
+    if getattr(engine, "_catalogue_pre_ping", False):
+        return
+
+    @event.listens_for(engine, "engine_connect")
+    def ping_connection(connection, branch):
+        if branch:
+            #sub connection of a connection, already pinged
+            return
+        should_close_with_result = connection.should_close_with_result
+        connection.should_close_with_result = False
+        try:
+            connection.scalar(select([1]))
+        except exc.DBAPIError as e:
+            if e.connection_invalidated:
+                #the connection was invalidated, the pool will reconnect it.
+                connection.scalar(select([1]))
+            else:
+                raise
+        finally:
+            connection.should_close_with_result = should_close_with_result
+
+    engine._catalogue_pre_ping = True
+
+
+class RepositoryPool(object):
+    """
+    A bounded pool of idle repositories.
+    A repository is removed from the pool while it is used by a request, so a
+    repository is never shared by concurrent requests.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        #key is (database, table, filter), value is a list of idle repositories. Ordered by last access time
+        self._idle = OrderedDict()
+        self._size = 0
+        self._stats = {
+            "created": 0,
+            "hits": 0,
+            "misses": 0,
+            "released": 0,
+            "evicted": 0,
+            "in_use": 0,
+        }
+
+    def acquire(self, key):
+        """
+        Return an idle repository for the key; return None if not found
+        """
+        with self._lock:
+            repositories = self._idle.get(key)
+            if repositories:
+                repository = repositories.pop()
+                self._size -= 1
+                if not repositories:
+                    del self._idle[key]
+                self._stats["hits"] += 1
+                self._stats["in_use"] += 1
+                return repository
+            self._stats["misses"] += 1
+            self._stats["in_use"] += 1
+            return None
+
+    def created(self):
+        with self._lock:
+            self._stats["created"] += 1
+
+    def discard(self):
+        """
+        A repository acquired from the pool will not be returned
+        """
+        with self._lock:
+            self._stats["in_use"] -= 1
+
+    def release(self, repository):
+        """
+        Return the repository to the pool after the request is processed.
+        """
+        if not isinstance(repository, PooledRepository) or not repository.pool_key:
+            return
+        try:
+            repository.reset()
+        except:
+            #reset failed, drop the repository
+            logger.exception("Reset the repository({}) failed.".format(repository.pool_key))
+            self.discard()
+            return
+
+        with self._lock:
+            self._stats["in_use"] -= 1
+            self._stats["released"] += 1
+            repositories = self._idle.pop(repository.pool_key, [])
+            repositories.append(repository)
+            #move the key to the end as the most recently used one
+            self._idle[repository.pool_key] = repositories
+            self._size += 1
+            while self._size > self.max_size:
+                #evict the least recently used repository
+                key, repositories = next(self._idle.iteritems())
+                repositories.pop(0)
+                self._size -= 1
+                if not repositories:
+                    del self._idle[key]
+                self._stats["evicted"] += 1
+        logger.debug("Repository pool: {}".format(self.metrics()))
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+            self._size = 0
+
+    def metrics(self):
+        with self._lock:
+            metrics = dict(self._stats)
+            metrics["idle"] = self._size
+            metrics["max_size"] = self.max_size
+            return metrics
+
+
+repository_pool = RepositoryPool(getattr(settings, "CSW_REPOSITORY_POOL_SIZE", 8))
+
+
+class PooledRepository(pycsw_repository.Repository):
+    """
+    A pycsw repository which is taken from the repository pool if possible.
+    """
+    pool_key = None
+
+    def __new__(cls, database, context, app_root=None, table='records', repo_filter=None):
+        repository = repository_pool.acquire((database, table, repo_filter))
+        if repository is None:
+            repository = super(PooledRepository, cls).__new__(cls)
+        return repository
+
+    def __init__(self, database, context, app_root=None, table='records', repo_filter=None):
+        if self.pool_key:
+            #taken from the pool, bind it to the current request.
+            self.context = context
+            self.session = create_session(self.engine)
+            return
+
+        try:
+            super(PooledRepository, self).__init__(database, context, app_root, table, repo_filter)
+        except:
+            repository_pool.discard()
+            raise
+        enable_pre_ping(self.engine)
+        self._default_dataset = self.dataset
+        #pycsw changes the queryables in place when transforming mappings, keep a clean copy
+        self._default_queryables = copy.deepcopy(self.queryables)
+        self.pool_key = (database, table, repo_filter)
+        repository_pool.created()
+
+    def reset(self):
+        """
+        Undo the changes made by the request
+        """
+        self.session.close()
+        self.dataset = self._default_dataset
+        self.queryables = copy.deepcopy(self._default_queryables)
+
+
+#pycsw looks up the repository class from its module when serving a request
+pycsw_repository.Repository = PooledRepository
+
+
+@inspection._self_inspects
+@log.class_logger
+class Mapper(BaseMapper):
+    def _configure_pks(self):
+        self.tables = sql_util.find_tables(self.mapped_table)
+
+        self._pks_by_table = {}
+        self._cols_by_table = {}
+
+        all_cols = sqlalchemy_util.column_set(chain(*[col.proxy_set for col in self._columntoproperty]))
+
+        # identify primary key columns which are also mapped by this mapper.
+        tables = set(self.tables + [self.mapped_table])
+        self._all_tables.update(tables)
+        self._cols_by_table[self.mapped_table] = all_cols
+        primary_key = [c for c in all_cols if c.name in self._primary_key_argument]
+        self._pks_by_table[self.mapped_table] = primary_key
+
+        self.primary_key = tuple(primary_key)
+        self._log("Identified primary key columns: %s", primary_key)
+
+        # determine cols that aren't expressed within our tables; mark these
+        # as "read only" properties which are refreshed upon INSERT/UPDATE
+        self._readonly_props = set(
+            self._columntoproperty[col]
+            for col in self._columntoproperty
+            if self._columntoproperty[col] not in self._identity_key_props and
+            (not hasattr(col, 'table') or
+                col.table not in self._cols_by_table))
+
+
+#cache key of the registry version stamp shared by all the worker processes
+DATASET_REGISTRY_VERSION_KEY = "catalogue_dataset_registry_version"
+
+
+class DatasetRegistry(object):
+    """
+    A LRU registry of the sqlalchemy types reflected from the application record views (catalogue_record_<app>).
+    Key is (database url, app)
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.RLock()
+        self._datasets = OrderedDict()
+        self._version = None
+
+    def _check_version(self):
+        version = cache.get(DATASET_REGISTRY_VERSION_KEY)
+        if version is None:
+            cache.add(DATASET_REGISTRY_VERSION_KEY, uuid.uuid4().hex, None)
+            version = cache.get(DATASET_REGISTRY_VERSION_KEY)
+        if version != self._version:
+            #some application is changed in other process, discard all reflected views
+            with self._lock:
+                self._datasets.clear()
+                self._version = version
+
+    @staticmethod
+    def reflect(engine, app):
+        base = declarative_base(bind=engine, mapper=Mapper)
+        table = Table(Application.get_view_name(app), base.metadata, autoload=True, schema=None)
+        mapper_args = {"primary_key": ["id"]}
+        if "layer_order" in table.c:
+            #the rows of the application views are not ordered, the records are ordered by the layer order unless sorted by the request
+            mapper_args["order_by"] = [table.c.layer_order, table.c.identifier]
+        return type('dataset', (base,), dict(__table__=table, __mapper_args__=mapper_args))
+
+    def get(self, engine, app):
+        """
+        Return the reflected type of the app's record view.
+        Raise NoSuchTableError if the view does not exist.
+        """
+        self._check_version()
+        key = (str(engine.url), app)
+        with self._lock:
+            dataset = self._datasets.pop(key, None)
+            if dataset is None:
+                logger.debug("Reflect the record view of application({})".format(app))
+                dataset = self.reflect(engine, app)
+            #move to the end as the most recently used one
+            self._datasets[key] = dataset
+            while len(self._datasets) > self.max_size:
+                self._datasets.popitem(last=False)
+            return dataset
+
+    def invalidate(self, app=None):
+        """
+        Remove the app's reflected view or all reflected views if app is None,
+        and notify other processes to do the same.
+        """
+        with self._lock:
+            for key in [k for k in self._datasets if app is None or k[1] == app]:
+                del self._datasets[key]
+            self._version = uuid.uuid4().hex
+            cache.set(DATASET_REGISTRY_VERSION_KEY, self._version, None)
+
+    def prewarm(self, engine, apps=None):
+        """
+        Reflect the record views of all applications and the 'all' view
+        """
+        if apps is None:
+            apps = ["all"] + list(Application.objects.values_list("name", flat=True))
+        for app in apps:
+            try:
+                self.get(engine, app)
+            except:
+                logger.exception("Reflect the record view of application({}) failed.".format(app))
+
+
+dataset_registry = DatasetRegistry(getattr(settings, "CSW_DATASET_REGISTRY_SIZE", 100))
+
+
+def prewarm(database=None):
+    """
+    Reflect the record views of all applications at worker start, so the first
+    request of each application doesn't pay the reflection latency.
+    """
+    try:
+        if database is None:
+            from .pycswsettings import build_pycsw_settings
+            database = build_pycsw_settings()["repository"]["database"]
+        engine = pycsw_repository.Repository.create_engine(database)
+        enable_pre_ping(engine)
+        dataset_registry.prewarm(engine)
+        #close the connections, they should not be shared with the forked worker processes
+        engine.dispose()
+    finally:
+        #the django connection is opened by the queries of the settings and the applications
+        connections.close_all()
@@ -0,0 +1,159 @@
+"""
+Streaming sitemap of the catalogue records
+
+The active records are read in chunks ordered by the primary key and written
+into sitemap files, which are listed by a sitemap index. A sitemap file (shard)
+has the records of a fixed primary key range of max_urls keys, so a change of
+a record never moves other records to another shard. The digest of each shard
+is kept in a state file next to the index, so only the shards whose records
+are changed are written again.
+"""
+import hashlib
+import json
+import logging
+import os
+import urllib
+import urlparse
+from xml.sax.saxutils import escape
+
+from django.utils import timezone
+
+from .models import Record
+
+logger = logging.getLogger(__name__)
+
+SITEMAP_NAMESPACE = "http://www.sitemaps.org/schemas/sitemap/0.9"
+#the maximum number of urls of a sitemap file allowed by the sitemap protocol
+MAX_URLS = 50000
+
+
+class SitemapWriter(object):
+    """
+    Write the sitemap index into index_path and the shards 'sitemap-<n>.xml' into the same directory.
+    csw_url is the url of the CSW endpoint which serves the records; base_url is the url of the
+    directory where the sitemap files are published, defaults to the directory of csw_url.
+    """
+    def __init__(self, index_path, csw_url, base_url=None, max_urls=MAX_URLS, chunk_size=2000):
+        if os.path.isdir(index_path):
+            index_path = os.path.join(index_path, "sitemap.xml")
+        self.index_path = index_path
+        self.directory = os.path.dirname(os.path.abspath(index_path))
+        self.name = os.path.splitext(os.path.basename(index_path))[0]
+        self.state_path = os.path.join(self.directory, ".{}.json".format(self.name))
+        self.csw_url = csw_url
+        self.base_url = base_url or urlparse.urljoin(csw_url, ".")
+        self.max_urls = min(max_urls, MAX_URLS)
+        self.chunk_size = chunk_size
+
+    def shard_name(self, number):
+        return "{}-{}.xml".format(self.name, number)
+
+    def records(self):
+        """
+        Yield (pk, identifier, modified) of the active records, the records are read in chunks by the primary key
+        so the whole table is never loaded at once.
+        """
+        last_pk = 0
+        while True:
+            chunk = list(Record.objects.filter(active=True, pk__gt=last_pk).order_by("pk")
+                         .values_list("pk", "identifier", "modified")[:self.chunk_size])
+            for record in chunk:
+                yield record
+            if len(chunk) < self.chunk_size:
+                return
+            last_pk = chunk[-1][0]
+
+    def shards(self):
+        """
+        Yield (shard number, the list of (identifier, modified)) of each shard which has active records.
+        The shard n has the records whose primary key is in [(n - 1) * max_urls, n * max_urls)
+        """
+        number, shard = None, []
+        for pk, identifier, modified in self.records():
+            if pk // self.max_urls + 1 != number:
+                if shard:
+                    yield number, shard
+                number, shard = pk // self.max_urls + 1, []
+            shard.append((identifier, modified))
+        if shard:
+            yield number, shard
+
+    @staticmethod
+    def digest(shard):
+        md5 = hashlib.md5()
+        for identifier, modified in shard:
+            md5.update(u"{}\t{}\n".format(identifier, modified.isoformat() if modified else "").encode("utf-8"))
+        return md5.hexdigest()
+
+    def record_url(self, identifier):
+        return "{}?service=CSW&version=2.0.2&request=GetRepositoryItem&id={}".format(
+            self.csw_url, urllib.quote(identifier.encode("utf-8"), safe=":"))
+
+    def _write_file(self, path, lines):
+        #write into a temporary file and rename it, the published file is never incomplete
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            for line in lines:
+                f.write(line.encode("utf-8") if isinstance(line, unicode) else line)
+        os.rename(tmp_path, path)
+
+    def _shard_lines(self, shard):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="{}">\n'.format(SITEMAP_NAMESPACE)
+        for identifier, modified in shard:
+            if modified:
+                yield u"<url><loc>{}</loc><lastmod>{}</lastmod></url>\n".format(
+                    escape(self.record_url(identifier)), modified.isoformat())
+            else:
+                yield u"<url><loc>{}</loc></url>\n".format(escape(self.record_url(identifier)))
+        yield "</urlset>\n"
+
+    def _index_lines(self, shards):
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="{}">\n'.format(SITEMAP_NAMESPACE)
+        for shard in shards:
+            yield u"<sitemap><loc>{}</loc><lastmod>{}</lastmod></sitemap>\n".format(
+                escape(urlparse.urljoin(self.base_url, shard["file"])), shard["lastmod"])
+        yield "</sitemapindex>\n"
+
+    def load_state(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def write(self):
+        """
+        Write the changed shards and the index. Return (the number of the shards, the number of the written shards)
+        """
+        state = self.load_state()
+        previous = dict((shard["file"], shard) for shard in state.get("shards", []))
+        if state.get("max_urls") != self.max_urls:
+            #the shards were partitioned differently, write all of them again
+            for shard in previous.itervalues():
+                shard["digest"] = None
+        now = timezone.now().replace(microsecond=0).isoformat()
+        shards = []
+        written = 0
+        for number, shard in self.shards():
+            name = self.shard_name(number)
+            path = os.path.join(self.directory, name)
+            digest = self.digest(shard)
+            old = previous.pop(name, None)
+            if old and old["digest"] == digest and os.path.exists(path):
+                shards.append(old)
+                continue
+            self._write_file(path, self._shard_lines(shard))
+            shards.append({"file": name, "digest": digest, "lastmod": now, "count": len(shard)})
+            written += 1
+
+        #remove the shards which have no active records any more
+        for old in previous.itervalues():
+            path = os.path.join(self.directory, old["file"])
+            if os.path.exists(path):
+                os.remove(path)
+
+        if written or previous or not os.path.exists(self.index_path):
+            self._write_file(self.index_path, self._index_lines(shards))
+            with open(self.state_path, "w") as f:
+                json.dump({"max_urls": self.max_urls, "shards": shards}, f)
+        return len(shards), written
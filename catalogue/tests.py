@@ -1,3 +1,879 @@
-from django.test import TestCase
+import copy
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from StringIO import StringIO
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+import pyproj
+from lxml import etree
+from sqlalchemy.orm import create_session
+
+from catalogue.cache import get_catalogue_generation
+from catalogue.epsg import EpsgRegistry
+from catalogue.fakecsw import FakeCswServer
+from catalogue.fragments import get_fragment, load_fragment, CSW_NAMESPACE, ELEMENT_SETS, GMD_NAMESPACE, OUTPUT_SCHEMAS
+from catalogue.harvest import Harvester, get_pycsw_context
+from catalogue.models import (Application, ApplicationLayer, PycswConfig, Record, Style, Tag, batch_style_import,
+                              epsg_extra, projections)
+from catalogue.projection import ProjectionCache
+from catalogue.pycswsettings import SETTINGS_VERSION_KEY, build_pycsw_settings, get_settings_version
+from catalogue.repository import (DATASET_REGISTRY_VERSION_KEY, DatasetRegistry, PooledRepository, RepositoryPool,
+                                  dataset_registry, repository_pool)
+from catalogue.sitemap import SitemapWriter
+from catalogue.views import CswEndpoint
+
+
+class RecordViewSetTestCase(TestCase):
+
+    def create_records(self, count):
+        """Create records with tags and styles, without sending the signals.
+        """
+        start = Record.objects.count()
+        Record.objects.bulk_create([
+            Record(
+                identifier="test:layer{}".format(i), title="Layer {}".format(i), crs="EPSG:4326",
+                bounding_box="POLYGON((115 -35, 115 -30, 120 -30, 120 -35, 115 -35))")
+            for i in range(start, start + count)
+        ])
+        tag, created = Tag.objects.get_or_create(name="test", defaults={"description": "Test"})
+        records = Record.objects.filter(identifier__startswith="test:").exclude(tags=tag)
+        styles = []
+        for record in records:
+            record.tags.add(tag)
+            for style_format in ("SLD", "QML"):
+                styles.append(Style(
+                    record=record, name="style", format=style_format, default=True,
+                    content="catalogue/styles/{}.{}".format(record.identifier.replace(":", "_"), style_format.lower())))
+        Style.objects.bulk_create(styles)
+
+    def count_list_queries(self, path):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), len(response.data)
+
+    def test_list_query_count(self):
+        """Test that the number of queries to list the records doesn't depend on the number of records
+        """
+        self.create_records(2)
+        queries, records = self.count_list_queries("/catalogue/api/records/")
+        self.assertEqual(records, 2)
+        self.create_records(20)
+        self.assertEqual(self.count_list_queries("/catalogue/api/records/"), (queries, 22))
+
+    def test_application_filter_query_count(self):
+        """Test that filtering the records by application doesn't query each record
+        """
+        app = Application.objects.create(name="testapp")
+        self.create_records(2)
+        app.records.add(*Record.objects.all())
+        queries, records = self.count_list_queries("/catalogue/api/records/?application__name=testapp")
+        self.assertEqual(records, 2)
+        self.create_records(20)
+        app.records.add(*Record.objects.all())
+        self.assertEqual(self.count_list_queries("/catalogue/api/records/?application__name=testapp"), (queries, 22))
+
+    def test_sparse_fieldsets_and_cursor_pagination(self):
+        """Test that only the requested fields are returned, page by page
+        """
+        self.create_records(5)
+        response = self.client.get("/catalogue/api/records/", {"fields": "identifier,bounding_box", "page_size": 2})
+        self.assertEqual(response.status_code, 200)
+        identifiers = []
+        while True:
+            for record in response.data["results"]:
+                self.assertEqual(set(record.keys()), set(["identifier", "bounding_box"]))
+                identifiers.append(record["identifier"])
+            if not response.data["next"]:
+                break
+            response = self.client.get(response.data["next"])
+        self.assertEqual(identifiers, sorted(Record.objects.values_list("identifier", flat=True)))
+
+        response = self.client.get("/catalogue/api/records/", {"compact": "true"})
+        self.assertEqual(len(response.data), 5)
+        for field in ("any_text", "ows_resource", "metadata_link"):
+            self.assertNotIn(field, response.data[0])
+
+    def test_ranked_search_pagination(self):
+        """Test that the paginated full text search results are ordered by rank
+        """
+        Record.objects.create(identifier="test:a", title="Rivers", abstract="Vegetation along the rivers")
+        Record.objects.create(identifier="test:b", title="Vegetation")
+        Record.objects.create(identifier="test:c", title="Roads")
+        response = self.client.get("/catalogue/api/records/", {"q": "vegetation", "page_size": 1, "fields": "identifier"})
+        self.assertEqual(response.status_code, 200)
+        identifiers = []
+        while True:
+            identifiers.extend(record["identifier"] for record in response.data["results"])
+            if not response.data["next"]:
+                break
+            response = self.client.get(response.data["next"])
+        self.assertEqual(identifiers, ["test:b", "test:a"])
+
+
+class IndexCountingEpsgRegistry(EpsgRegistry):
+
+    def build_index(self, data):
+        self.built = True
+        return EpsgRegistry.build_index(data)
+
+
+class EpsgRegistryTestCase(SimpleTestCase):
+    definitions = [
+        "+proj=merc +a=6378137 +b=6378137 +lat_ts=0.0 +lon_0=0.0 +x_0=0.0 +y_0=0 +k=1.0 +units=m +nadgrids=@null +wktext  +no_defs",
+        "+proj=longlat +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +no_defs",
+    ]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "epsg")
+        with open(self.path, "w") as f:
+            f.write("# extra definitions\n<900913> {} <>\n<incorrect>\n".format(self.definitions[0]))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_index(self):
+        """Test that the index is built once and cached next to the file, and built again if the file is changed
+        """
+        registry = IndexCountingEpsgRegistry(self.path)
+        self.assertEqual(registry["epsg:900913"], self.definitions[0])
+        self.assertTrue(registry.built)
+        self.assertTrue(os.path.exists("{}.idx".format(self.path)))
+        self.assertNotIn("EPSG:4326", registry)
+        self.assertEqual(registry.get("EPSG:999999", "default"), "default")
+        self.assertIsNone(registry.get("CRS:84"))
+        with self.assertRaises(KeyError):
+            registry["EPSG:999999"]
+
+        #the cached index is used
+        registry = IndexCountingEpsgRegistry(self.path)
+        self.assertEqual(registry["EPSG:900913"], self.definitions[0])
+        self.assertFalse(getattr(registry, "built", False))
+
+        #the file is changed after the index is cached
+        with open(self.path, "a") as f:
+            f.write("<4283> {} <>\n".format(self.definitions[1]))
+        mtime = os.path.getmtime(self.path) + 10
+        os.utime(self.path, (mtime, mtime))
+        registry = IndexCountingEpsgRegistry(self.path)
+        self.assertEqual(registry["EPSG:4283"], self.definitions[1])
+        self.assertTrue(registry.built)
+
+    def test_extra_definitions(self):
+        """Test that the crs defined in the extra file is initialised from the file, and other crs from pyproj
+        """
+        projection_cache = ProjectionCache(EpsgRegistry(self.path))
+        x, y = projection_cache.transform_bbox("EPSG:4326", "EPSG:900913", [10, 0, 20, 10])[:2]
+        self.assertAlmostEqual(x, 1113194.9079, places=3)
+        self.assertAlmostEqual(y, 0, places=3)
+        self.assertIn("EPSG:900913", epsg_extra)
+
+
+class ProjectionTestCase(SimpleTestCase):
+
+    def test_batched_transform(self):
+        """Test that the bboxes transformed in a batch are the same as the bboxes transformed one by one
+        """
+        records = [
+            Record(pk=1, identifier="test:layer1", crs="EPSG:4326", bounding_box="POLYGON((115 -35, 115 -30, 120 -30, 120 -35, 115 -35))"),
+            Record(pk=2, identifier="test:layer2", crs="EPSG:4283", bounding_box="POLYGON((112 -36, 112 -13, 129 -13, 129 -36, 112 -36))"),
+            Record(pk=3, identifier="test:layer3", crs="epsg:4326", bounding_box="POLYGON((116 -33, 116 -31, 117 -31, 117 -33, 116 -33))"),
+            Record(pk=4, identifier="test:layer4", crs="EPSG:999999", bounding_box="POLYGON((1 2, 1 4, 3 4, 3 2, 1 2))"),
+        ]
+        for target_crs in ("EPSG:3857", "EPSG:28350", "EPSG:4326"):
+            bboxes = Record.transform_bboxes(records, target_crs)
+            for record in records[:3]:
+                if record.crs.upper() == target_crs:
+                    self.assertNotIn(record.pk, bboxes)
+                    continue
+                p1, p2 = pyproj.Proj(init=record.crs.upper()), pyproj.Proj(init=target_crs)
+                expected = [pyproj.transform(p1, p2, *record.bbox[0:2]), pyproj.transform(p1, p2, *record.bbox[2:4])]
+                for value, expected_value in zip(bboxes[record.pk], [v for point in expected for v in point]):
+                    self.assertAlmostEqual(value, expected_value, places=6)
+            #the unknown crs is left to the transform of the record, which reports the error
+            self.assertNotIn(4, bboxes)
+            with self.assertRaises(Exception):
+                projections.transform_bbox(records[3].crs, target_crs, records[3].bbox)
+
+    def test_projection_cache(self):
+        """Test that the least recently used projection pair is evicted with the projections not used by other pairs
+        """
+        projection_cache = ProjectionCache({}, max_size=2)
+        pair = projection_cache.get("EPSG:4326", "EPSG:3857")
+        self.assertIs(projection_cache.get("epsg:4326", "epsg:3857"), pair)
+        projection_cache.get("EPSG:4283", "EPSG:3857")
+        projection_cache.get("EPSG:4326", "EPSG:28350")
+        self.assertEqual(list(projection_cache._pairs.keys()), [("EPSG:4283", "EPSG:3857"), ("EPSG:4326", "EPSG:28350")])
+        self.assertEqual(set(projection_cache._projs.keys()), set(["EPSG:4283", "EPSG:3857", "EPSG:4326", "EPSG:28350"]))
+        projection_cache.get("EPSG:4326", "EPSG:4283")
+        self.assertEqual(set(projection_cache._projs.keys()), set(["EPSG:4283", "EPSG:4326", "EPSG:28350"]))
+
+
+class RecordGeometryTestCase(TestCase):
+
+    def test_geometry_trigger(self):
+        """Test that the geometry in EPSG:4326 is maintained from the bounding box and the crs
+        """
+        record = Record.objects.create(identifier="test:layer", title="Layer", crs="EPSG:4326",
+                                       bounding_box="POLYGON((115 -35, 115 -30, 120 -30, 120 -35, 115 -35))")
+        self.assertEqual(Record.objects.get(pk=record.pk).wkb_geometry.extent, (115, -35, 120, -30))
+        #the bounding box is transformed from the record's crs
+        record.crs = "EPSG:3857"
+        record.bounding_box = "POLYGON((0 0, 0 1118889.97, 1113194.91 1118889.97, 1113194.91 0, 0 0))"
+        record.save()
+        for value, expected in zip(Record.objects.get(pk=record.pk).wkb_geometry.extent, (0, 0, 10, 10)):
+            self.assertAlmostEqual(value, expected, places=3)
+        #unknown crs falls back to EPSG:4326
+        Record.objects.filter(pk=record.pk).update(crs="unknown", bounding_box="POLYGON((1 2, 1 4, 3 4, 3 2, 1 2))")
+        self.assertEqual(Record.objects.get(pk=record.pk).wkb_geometry.extent, (1, 2, 3, 4))
+        Record.objects.filter(pk=record.pk).update(bounding_box=None)
+        self.assertIsNone(Record.objects.get(pk=record.pk).wkb_geometry)
+
+    def test_bbox_query(self):
+        """Test that the records intersecting the bbox are returned
+        """
+        Record.objects.create(identifier="test:layer", title="Layer", crs="EPSG:4326",
+                              bounding_box="POLYGON((115 -35, 115 -30, 120 -30, 120 -35, 115 -35))")
+        response = self.client.get("/catalogue/api/records/bbox/", {"bbox": "119,-31,125,-25"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([record["identifier"] for record in response.data["results"]], ["test:layer"])
+        response = self.client.get("/catalogue/api/records/bbox/", {"bbox": "121,-29,125,-25"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["results"], [])
+        for bbox in ("119,-31,125", "a,b,c,d", ""):
+            self.assertEqual(self.client.get("/catalogue/api/records/bbox/", {"bbox": bbox}).status_code, 400)
+
+
+class RecordBulkTestCase(TestCase):
+
+    def item(self, name, **data):
+        item = {
+            "workspace": "test", "name": name, "title": "Layer {}".format(name), "publication_date": "2016-01-01T00:00:00Z",
+            "crs": "EPSG:4326", "bounding_box": "[115, -35, 120, -30]",
+            "ows_resource": {"wfs": True, "wfs_endpoint": "https://example.com/geoserver/wfs", "wfs_version": "1.1.0"},
+            "styles": [{"name": "style", "format": "SLD", "default": True, "content": "<sld/>".encode("base64")}],
+        }
+        item.update(data)
+        return item
+
+    def test_bulk_upsert(self):
+        """Test that the valid records are created or updated in one request, and the invalid records are reported
+        """
+        Record.objects.create(identifier="test:existing", title="Old title", abstract="Old abstract")
+        Record.objects.filter(identifier="test:existing").update(fragments="{}", resource_links=[])
+        generation = get_catalogue_generation()
+        response = self.client.post("/catalogue/api/records/bulk/", json.dumps([
+            self.item("existing", title="New title", abstract="New abstract"),
+            self.item("new"),
+            #the name is required
+            {"workspace": "test", "publication_date": "2016-01-01T00:00:00Z"},
+            #the links of a wms layer can't be generated without crs
+            self.item("broken", crs=None, ows_resource={"wms": True, "wms_endpoint": "https://example.com/wms", "wms_version": "1.1.1"}),
+        ]), content_type="application/json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result["status"] for result in response.data], ["updated", "created", "error", "error"])
+        self.assertEqual(response.data[3]["identifier"], "test:broken")
+        self.assertFalse(Record.objects.filter(identifier="test:broken").exists())
+        self.assertNotEqual(get_catalogue_generation(), generation)
+
+        record = Record.objects.get(identifier="test:existing")
+        #the title of an existing record is not changed
+        self.assertEqual((record.title, record.abstract), ("Old title", "New abstract"))
+        self.assertIsNone(record.fragments)
+        self.assertEqual([link["schema"]["protocol"] for link in record.resource_links], ["OGC:WFS", "application/sld"])
+        self.assertEqual(len(record.links.split("^")), 2)
+
+        record = Record.objects.get(identifier="test:new")
+        self.assertEqual(record.title, "Layer new")
+        self.assertEqual(list(record.styles.values_list("name", "format", "default")), [("style", "SLD", True)])
+        self.assertEqual(len(record.style_links), 1)
+
+
+class CatalogueGenerationTestCase(TransactionTestCase):
+    #the pycsw settings created by the migrations are required
+    serialized_rollback = True
+
+    def test_generation_changed_after_commit(self):
+        """Test that the catalogue generation is changed after the change is committed
+        """
+        generation = get_catalogue_generation()
+        with transaction.atomic():
+            record = Record.objects.create(identifier="test:layer", title="Layer")
+            record.tags.add(Tag.objects.create(name="test", description="Test"))
+            self.assertEqual(get_catalogue_generation(), generation)
+        self.assertNotEqual(get_catalogue_generation(), generation)
+
+        generation = get_catalogue_generation()
+        try:
+            with transaction.atomic():
+                Record.objects.filter(identifier="test:layer").get().delete()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(get_catalogue_generation(), generation)
+
+    def test_tag_changes_etag(self):
+        """Test that the tag changes change the etag of the record list
+        """
+        record = Record.objects.create(identifier="test:layer", title="Layer")
+        etag = self.client.get("/catalogue/api/records/")["ETag"]
+        tag = Tag.objects.create(name="vegetation", description="Vegetation")
+        record.tags.add(tag)
+        response = self.client.get("/catalogue/api/records/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response["ETag"]
+        tag.description = "Vegetation layers"
+        tag.save()
+        self.assertEqual(self.client.get("/catalogue/api/records/", HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_conditional_get_after_commit(self):
+        """Test that the validators are only changed after the change is committed, so a response of the new
+        validators always has the committed data
+        """
+        Record.objects.create(identifier="test:layer1", title="Layer 1")
+        response = self.client.get("/catalogue/api/records/")
+        etag = response["ETag"]
+        with transaction.atomic():
+            Record.objects.create(identifier="test:layer2", title="Layer 2")
+            self.assertEqual(self.client.get("/catalogue/api/records/", HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        response = self.client.get("/catalogue/api/records/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(record["identifier"] for record in response.data), ["test:layer1", "test:layer2"])
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(self.client.get("/catalogue/api/records/", HTTP_IF_NONE_MATCH=response["ETag"]).status_code, 304)
+
+
+class StyleContentTestCase(TransactionTestCase):
+
+    def test_content_addressed_storage(self):
+        """Test that the styles with the same content share one file, which is removed with the last style
+        after the transaction is committed
+        """
+        records = [Record.objects.create(identifier="test:layer{}".format(i), title="Layer {}".format(i)) for i in range(2)]
+        styles = [Style.objects.create(record=record, name="style", format="SLD", content=ContentFile(b"<sld/>")) for record in records]
+        self.assertEqual(styles[0].content.name, styles[1].content.name)
+        self.assertEqual(styles[0].checksum, Style.calculate_checksum(ContentFile(b"<sld/>"))[0])
+        storage = styles[0].content.storage
+        name = styles[0].content.name
+        styles[0].delete()
+        self.assertTrue(storage.exists(name))
+        styles[1].content = ContentFile(b"<sld></sld>")
+        styles[1].save()
+        self.assertNotEqual(styles[1].content.name, name)
+        self.assertFalse(storage.exists(name))
+
+        #the file is kept if the transaction is rolled back
+        try:
+            with transaction.atomic():
+                Style.objects.get(pk=styles[1].pk).delete()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertTrue(storage.exists(styles[1].content.name))
+        styles[1].delete()
+        self.assertFalse(storage.exists(styles[1].content.name))
+
+
+class StyleTestCase(TestCase):
+
+    def test_batch_style_import(self):
+        """Test that the record is saved once for the styles imported in a batch
+        """
+        record = Record.objects.create(identifier="test:layer", title="Layer")
+        saved = []
+        def record_saved(sender, instance, **kwargs):
+            saved.append(instance.pk)
+        post_save.connect(record_saved, sender=Record)
+        try:
+            with batch_style_import():
+                for i in range(10):
+                    Style.objects.create(record=record, name="style{}".format(i), format="SLD", content=ContentFile(b"<sld/>"))
+        finally:
+            post_save.disconnect(record_saved, sender=Record)
+        self.assertEqual(saved, [record.pk])
+        self.assertEqual(list(record.styles.filter(default=True).values_list("name", flat=True)), ["style0"])
+        self.assertEqual(len(Record.objects.get(pk=record.pk).style_links), 10)
+
+
+class RecordTestCase(TestCase):
+
+    def test_changed_fields(self):
+        """Test that the changed fields are found without querying the database
+        """
+        Record.objects.create(identifier="test:layer", title="Layer", abstract="Abstract")
+        record = Record.objects.get(identifier="test:layer")
+        with self.assertNumQueries(0):
+            self.assertEqual(record.get_changed_fields(), [])
+            record.title = "New Layer"
+            self.assertEqual(record.get_changed_fields(), ["title"])
+        modified = record.modified
+        record.save()
+        self.assertGreater(record.modified, modified)
+        self.assertEqual(record.get_changed_fields(), [])
+
+        #the deferred fields are read from the database
+        record = Record.objects.only("identifier").get(identifier="test:layer")
+        record.abstract = "New Abstract"
+        self.assertEqual(record.get_changed_fields(["abstract"]), ["abstract"])
+
+    def test_resource_links_reset(self):
+        """Test that the parsed links are reset if the links are changed without them
+        """
+        record = Record.objects.create(identifier="test:layer", title="Layer")
+        link = {"name": "test:layer", "description": "", "schema": {"protocol": "OGC:WMS", "version": "1.1.1"},
+                "link": "https://example.com/wms"}
+        record.set_resource_links([link])
+        record.save()
+        self.assertEqual(Record.objects.get(pk=record.pk).ows_links, [link])
+
+        #the links are changed by pycsw
+        link["link"] = "https://example.com/new/wms"
+        Record.objects.filter(pk=record.pk).update(links=Record.format_link(link))
+        record = Record.objects.get(pk=record.pk)
+        self.assertIsNone(record.resource_links)
+        self.assertEqual(record.ows_links, [link])
+
+    def test_fragments_settings_version(self):
+        """Test that the fragments rendered with old pycsw settings are rendered again
+        """
+        record = Record.objects.create(identifier="test:layer", title="Layer")
+        fragments = Record.objects.get(pk=record.pk).fragments
+        self.assertIsNotNone(load_fragment(fragments, GMD_NAMESPACE, "full"))
+
+        #the settings are changed by other process
+        cache.set(SETTINGS_VERSION_KEY, "other process", None)
+        self.assertIsNone(load_fragment(fragments, GMD_NAMESPACE, "full"))
+        record = Record.objects.get(pk=record.pk)
+        self.assertIsNotNone(get_fragment(record, GMD_NAMESPACE, "full"))
+        fragments = Record.objects.get(pk=record.pk).fragments
+        self.assertIsNotNone(load_fragment(fragments, GMD_NAMESPACE, "full", get_settings_version()))
+
+    def test_pycsw_full_text_search(self):
+        """Test that pycsw searches AnyText with the full text search index
+        """
+        config = build_pycsw_settings()["repository"]
+        repository = PooledRepository(config["database"], get_pycsw_context(), table=config["table"])
+        try:
+            self.assertTrue(repository.fts)
+        finally:
+            repository_pool.release(repository)
+
+
+class RelinkOwsTestCase(TestCase):
+
+    def test_relink(self):
+        """Test that only the records whose links are changed are relinked and marked modified
+        """
+        record = Record.objects.create(identifier="test:layer", title="Layer", crs="EPSG:4326",
+                                       bounding_box="POLYGON((115 -35, 115 -30, 120 -30, 120 -35, 115 -35))")
+        record.set_resource_links([Record.parse_link(record.generate_ows_link("https://example.com/geoserver/wfs", "WFS", "1.1.0"))])
+        record.save()
+        modified = timezone.now() - timedelta(days=1)
+        Record.objects.filter(pk=record.pk).update(modified=modified)
+        fragments = Record.objects.get(pk=record.pk).fragments
+
+        call_command("relink_ows", stdout=StringIO())
+        record = Record.objects.get(pk=record.pk)
+        self.assertEqual((record.modified, record.fragments), (modified, fragments))
+
+        call_command("relink_ows", endpoint=["https://example.com/geoserver=https://new.example.com/geoserver"], stdout=StringIO())
+        record = Record.objects.get(pk=record.pk)
+        self.assertGreater(record.modified, modified)
+        self.assertIsNone(record.fragments)
+        self.assertEqual([link["schema"]["linkage"] for link in record.ows_links], ["https://new.example.com/geoserver/wfs"])
+        self.assertTrue(record.ows_links[0]["link"].startswith("https://new.example.com/geoserver/wfs?"))
+
+
+class StubRepository(PooledRepository):
+    """A repository which is not connected to a database, to test the pool
+    """
+    def __new__(cls, key):
+        return object.__new__(cls)
+
+    def __init__(self, key):
+        self.pool_key = key
+
+    def reset(self):
+        pass
+
+
+class RepositoryPoolTestCase(TestCase):
+
+    def create_repository(self):
+        config = build_pycsw_settings()["repository"]
+        return PooledRepository(config["database"], get_pycsw_context(), table=config["table"])
+
+    def test_reuse(self):
+        """Test that a released repository is reused by the next request, with the changes of the request undone
+        """
+        repository = self.create_repository()
+        dataset, queryables = repository.dataset, copy.deepcopy(repository.queryables)
+        repository.dataset = object()
+        repository.queryables["_all"].clear()
+        repository_pool.release(repository)
+
+        reused = self.create_repository()
+        try:
+            self.assertIs(reused, repository)
+            self.assertIs(reused.dataset, dataset)
+            self.assertEqual(reused.queryables, queryables)
+        finally:
+            repository_pool.release(reused)
+
+    def test_discard_failed_repository(self):
+        """Test that a repository which failed to initialise is not counted as in use
+        """
+        in_use = repository_pool.metrics()["in_use"]
+        with self.assertRaises(Exception):
+            PooledRepository("postgresql://nobody@127.0.0.1:1/nodb", get_pycsw_context(), table="public.catalogue_record")
+        self.assertEqual(repository_pool.metrics()["in_use"], in_use)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used repository is evicted if the pool is full
+        """
+        pool = RepositoryPool(2)
+        repositories = [StubRepository(key) for key in ("a", "b", "a", "c")]
+        for repository in repositories:
+            self.assertIsNone(pool.acquire(repository.pool_key))
+        for repository in repositories[:3]:
+            pool.release(repository)
+        #the repositories of 'a' are the most recently used ones, 'b' is evicted
+        self.assertEqual((pool.metrics()["idle"], pool.metrics()["evicted"]), (2, 1))
+        self.assertIsNone(pool.acquire("b"))
+        pool.release(repositories[3])
+        #the least recently used repository of 'a' is evicted
+        self.assertEqual(pool.metrics()["evicted"], 2)
+        self.assertIs(pool.acquire("a"), repositories[2])
+        self.assertIsNone(pool.acquire("a"))
+        self.assertIs(pool.acquire("c"), repositories[3])
+
+
+class DatasetRegistryTestCase(TestCase):
+
+    def setUp(self):
+        self.registry = DatasetRegistry(2)
+        self.reflected = []
+        def reflect(engine, app):
+            self.reflected.append(app)
+            return object()
+        self.registry.reflect = reflect
+        self.engine = PooledRepository.create_engine(build_pycsw_settings()["repository"]["database"])
+
+    def get(self, *apps):
+        for app in apps:
+            self.registry.get(self.engine, app)
+
+    def test_lru_eviction(self):
+        """Test that the least recently used view is evicted if the registry is full
+        """
+        self.get("a", "b", "a", "c", "a")
+        self.assertEqual(self.reflected, ["a", "b", "c"])
+        self.get("b")
+        self.assertEqual(self.reflected, ["a", "b", "c", "b"])
+
+    def test_invalidate(self):
+        """Test that only the invalidated view is reflected again, and all views are reflected again
+        if the registry is invalidated by other process
+        """
+        self.get("a", "b")
+        self.registry.invalidate("a")
+        self.get("a", "b")
+        self.assertEqual(self.reflected, ["a", "b", "a"])
+
+        cache.set(DATASET_REGISTRY_VERSION_KEY, "other process", None)
+        self.get("a", "b")
+        self.assertEqual(self.reflected, ["a", "b", "a", "a", "b"])
+
+
+class CswEndpointTestCase(TestCase):
+
+    def get(self, **params):
+        params = dict({"service": "CSW", "version": "2.0.2"}, **params)
+        response = self.client.get("/catalogue/", params)
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content) if response.streaming else response.content
+
+    def test_exception_not_cached(self):
+        """Test that the exception reports are not cached
+        """
+        Record.objects.create(identifier="test:layer", title="Layer")
+        response, content = self.get(request="GetRecordById", elementsetname="full")
+        self.assertIn("ExceptionReport", content)
+        response, content = self.get(request="GetRecordById", elementsetname="full")
+        self.assertIn("ExceptionReport", content)
+        self.assertFalse(response.has_header("X-csw-cache-hit"))
+
+        #the normal responses are cached
+        self.get(request="GetRecordById", elementsetname="full", id="test:layer")
+        response, content = self.get(request="GetRecordById", elementsetname="full", id="test:layer")
+        self.assertEqual(response["X-csw-cache-hit"], "success")
+
+    def test_streamed_get_records(self):
+        """Test that the streamed GetRecords response has the records of the page in chunks, consistent with the envelope
+        """
+        for i in xrange(5):
+            Record.objects.create(identifier="test:layer{}".format(i), title="Layer {}".format(i))
+        chunk_size = CswEndpoint.stream_chunk_size
+        CswEndpoint.stream_chunk_size = 1
+        try:
+            response, content = self.get(request="GetRecords", typenames="csw:Record", resulttype="results",
+                                         elementsetname="brief", startposition=2, maxrecords=3)
+        finally:
+            CswEndpoint.stream_chunk_size = chunk_size
+        self.assertTrue(response.streaming)
+        root = etree.fromstring(content)
+        searchresults = root.find("{%s}SearchResults" % CSW_NAMESPACE)
+        self.assertEqual((searchresults.get("numberOfRecordsMatched"), searchresults.get("numberOfRecordsReturned"),
+                          searchresults.get("nextRecord")), ("5", "3", "5"))
+        self.assertEqual([e.text for e in searchresults.iter("{http://purl.org/dc/elements/1.1/}identifier")],
+                         ["test:layer1", "test:layer2", "test:layer3"])
+
+
+class CswFastPathTestCase(TransactionTestCase):
+    """The requests processed by pycsw, which reads the committed data with its own connection
+    """
+    serialized_rollback = True
+
+    def get(self, app=None, **params):
+        params = dict({"service": "CSW", "version": "2.0.2"}, **params)
+        response = self.client.get("/catalogue/{}/".format(app) if app else "/catalogue/", params)
+        self.assertEqual(response.status_code, 200)
+        return response, b"".join(response.streaming_content) if response.streaming else response.content
+
+    def get_by_pycsw(self, app=None, **params):
+        use_fast_path, use_response_cache = CswEndpoint.use_fast_path, CswEndpoint.use_response_cache
+        CswEndpoint.use_fast_path = CswEndpoint.use_response_cache = False
+        try:
+            return self.get(app, **params)
+        finally:
+            CswEndpoint.use_fast_path, CswEndpoint.use_response_cache = use_fast_path, use_response_cache
+
+    def create_records(self):
+        for i in xrange(2):
+            record = Record.objects.create(
+                identifier="test:layer{}".format(i), title="Layer {}".format(i), abstract="Abstract of layer {}".format(i),
+                keywords="vegetation,test", crs="EPSG:4326", publication_date=timezone.now(),
+                bounding_box="POLYGON((115 -35, 115 -30, 120 -30, 120 -35, 115 -35))")
+            record.set_resource_links([Record.parse_link(record.generate_ows_link("https://example.com/geoserver/wfs", "WFS", "1.1.0"))])
+            record.save()
+
+    def test_get_record_by_id(self):
+        """Test that the GetRecordById responses served from the fragments are the same as the pycsw responses
+        """
+        self.create_records()
+        for outputschema in OUTPUT_SCHEMAS:
+            for elementsetname in ELEMENT_SETS:
+                params = {"request": "GetRecordById", "id": "test:layer0,test:layer1",
+                          "outputschema": outputschema, "elementsetname": elementsetname}
+                kvp = dict({"service": "CSW", "version": "2.0.2"}, **params)
+                content = CswEndpoint()._get_record_by_id("all", kvp)
+                self.assertIsNotNone(content)
+                self.assertEqual(content, self.get_by_pycsw(**params)[1], "{} {}".format(outputschema, elementsetname))
+
+    def test_get_record_by_id_fallback(self):
+        """Test that the GetRecordById requests which can't be served from the fragments are left to pycsw
+        """
+        self.create_records()
+        kvp = {"service": "CSW", "version": "2.0.2", "request": "GetRecordById", "id": "test:layer0", "elementsetname": "full"}
+        endpoint = CswEndpoint()
+        self.assertIsNotNone(endpoint._get_record_by_id("all", kvp))
+        #unknown app
+        self.assertIsNone(endpoint._get_record_by_id("nosuchapp", kvp))
+        #profile record
+        Record.objects.filter(identifier="test:layer0").update(typename="gmd:MD_Metadata", schema=GMD_NAMESPACE)
+        self.assertIsNone(endpoint._get_record_by_id("all", kvp))
+        self.assertIsNotNone(endpoint._get_record_by_id("all", dict(kvp, outputschema=GMD_NAMESPACE)))
+        Record.objects.filter(identifier="test:layer0").update(typename="csw:Record", schema=CSW_NAMESPACE)
+        #repository filter
+        config = PycswConfig.objects.first()
+        config.repository_filter = "active = true"
+        config.save()
+        self.assertIsNone(endpoint._get_record_by_id("all", kvp))
+
+    def test_profile_records_get_records(self):
+        """Test that a GetRecords page with profile records is processed by pycsw
+        """
+        app = Application.objects.create(name="testmixed")
+        try:
+            ApplicationLayer.objects.create(application=app, order=1, layer=Record.objects.create(
+                identifier="test:record", title="Record", typename="csw:Record"))
+            ApplicationLayer.objects.create(application=app, order=2, layer=Record.objects.create(
+                identifier="test:iso", title="ISO record", typename="gmd:MD_Metadata", schema=GMD_NAMESPACE))
+            response, content = self.get(app="testmixed", request="GetRecords", typenames="csw:Record",
+                                         resulttype="results", elementsetname="full")
+            self.assertFalse(response.streaming)
+            searchresults = etree.fromstring(content).find("{%s}SearchResults" % CSW_NAMESPACE)
+            self.assertEqual(searchresults.get("numberOfRecordsReturned"), "2")
+
+            #the page without profile records is streamed
+            response, content = self.get(app="testmixed", request="GetRecords", typenames="csw:Record",
+                                         resulttype="results", elementsetname="full", maxrecords=1)
+            self.assertTrue(response.streaming)
+        finally:
+            app.delete()
+
+
+@override_settings(CSW_MATERIALIZED_APPLICATION_VIEWS=True)
+class MaterializedViewTestCase(TransactionTestCase):
+    serialized_rollback = True
+
+    def test_layer_order(self):
+        """Test that the records of a materialized application view are ordered by the layer order after refreshes,
+        and the fragments rendered by the read requests don't refresh the views
+        """
+        app = Application.objects.create(name="testorder")
+        try:
+            for order, identifier in enumerate(("test:c", "test:a", "test:b"), 1):
+                ApplicationLayer.objects.create(application=app, layer=Record.objects.create(identifier=identifier), order=order)
+            record = Record.objects.get(identifier="test:a")
+            record.title = "Layer A"
+            record.save()
+
+            database = build_pycsw_settings()["repository"]["database"]
+            session = create_session(PooledRepository.create_engine(database))
+            try:
+                dataset = dataset_registry.reflect(session.bind, "testorder")
+                self.assertEqual([r.identifier for r in session.query(dataset)], ["test:c", "test:a", "test:b"])
+            finally:
+                session.close()
+
+            Record.objects.update(fragments=None)
+            with CaptureQueriesContext(connection) as context:
+                self.assertIsNotNone(get_fragment(record, CSW_NAMESPACE, "full"))
+            self.assertFalse([q for q in context.captured_queries if "REFRESH" in q["sql"]])
+        finally:
+            app.delete()
+
+
+class HarvestTestCase(TestCase):
+
+    def test_harvest(self):
+        """Test that the pages are harvested concurrently and the unchanged records are skipped
+        """
+        with FakeCswServer(25) as server:
+            harvester = Harvester(workers=3, page_size=10)
+            stats = harvester.harvest([server.url])
+            self.assertEqual((stats["pages"], stats["inserted"], stats["failed"]), (3, 25, 0))
+            self.assertEqual(Record.objects.filter(identifier__startswith="fakecsw-").count(), 25)
+
+            stats = harvester.harvest([server.url])
+            self.assertEqual((stats["inserted"], stats["updated"], stats["unchanged"]), (0, 0, 25))
+            #the fragments of the record are rendered and stored
+            self.assertIn("Fake record 1 revision 0", self.get_record_by_id("fakecsw-1"))
+
+            server.revision = 1
+            stats = harvester.harvest([server.url])
+            self.assertEqual((stats["inserted"], stats["updated"], stats["unchanged"]), (0, 25, 0))
+            self.assertEqual(Record.objects.get(identifier="fakecsw-1").title, "Fake record 1 revision 1")
+            content = self.get_record_by_id("fakecsw-1")
+            self.assertIn("Fake record 1 revision 1", content)
+            self.assertNotIn("Fake record 1 revision 0", content)
+
+    def get_record_by_id(self, identifier):
+        response = self.client.get("/catalogue/", {
+            "service": "CSW", "version": "2.0.2", "request": "GetRecordById", "id": identifier, "elementsetname": "full"})
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content) if response.streaming else response.content
+
+
+class SitemapTestCase(TestCase):
+
+    def test_sharded_sitemap(self):
+        """Test that the sitemap is sharded by the primary key and only the changed shards are written again
+        """
+        for pk in xrange(10, 15):
+            Record.objects.create(pk=pk, identifier="test:layer{}".format(pk), title="Layer {}".format(pk))
+        directory = tempfile.mkdtemp()
+        try:
+            #the shards of the primary keys [10, 11], [12, 13] and [14]
+            writer = SitemapWriter(directory, "https://example.com/catalogue/", max_urls=2)
+            self.assertEqual(writer.write(), (3, 3))
+            self.assertEqual(sorted(os.listdir(directory)),
+                             [".sitemap.json", "sitemap-6.xml", "sitemap-7.xml", "sitemap-8.xml", "sitemap.xml"])
+            with open(os.path.join(directory, "sitemap.xml")) as f:
+                self.assertIn("<loc>https://example.com/catalogue/sitemap-8.xml</loc>", f.read())
+            self.assertEqual(writer.write(), (3, 0))
+
+            record = Record.objects.get(pk=14)
+            record.title = "New Layer"
+            record.save()
+            self.assertEqual(writer.write(), (3, 1))
+
+            #removing a record of the first shard doesn't change the other shards
+            Record.objects.filter(pk=10).delete()
+            self.assertEqual(writer.write(), (3, 1))
+            Record.objects.filter(pk=11).delete()
+            self.assertEqual(writer.write(), (2, 0))
+            self.assertFalse(os.path.exists(os.path.join(directory, "sitemap-6.xml")))
+        finally:
+            shutil.rmtree(directory)
+
+
+class PycswCommandTestCase(TransactionTestCase):
+    #the command closes the database connection for its worker processes
+    serialized_rollback = True
+
+    RECORD_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<csw:Record xmlns:csw="http://www.opengis.net/cat/csw/2.0.2" xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:dct="http://purl.org/dc/terms/" xmlns:ows="http://www.opengis.net/ows">
+  <dc:identifier>test:load{0}</dc:identifier>
+  <dc:title>Loaded layer {0}</dc:title>
+  <dc:type>dataset</dc:type>
+  <dc:subject>load{0}</dc:subject>
+  <dct:abstract>Abstract of the loaded layer {0}</dct:abstract>
+  <ows:BoundingBox crs="urn:ogc:def:crs:EPSG::4326">
+    <ows:LowerCorner>-{0} 110</ows:LowerCorner>
+    <ows:UpperCorner>-{1} 120</ows:UpperCorner>
+  </ows:BoundingBox>
+</csw:Record>
+"""
+
+    def setUp(self):
+        self.input_directory = tempfile.mkdtemp()
+        for n in xrange(7):
+            with open(os.path.join(self.input_directory, "load{}.xml".format(n)), "w") as f:
+                f.write(self.RECORD_TEMPLATE.format(n + 10, n + 5))
+
+    def tearDown(self):
+        shutil.rmtree(self.input_directory)
+
+    def load(self, *args):
+        call_command("pycsw", "load", self.input_directory, "-y", *args, stdout=StringIO())
+        return list(Record.objects.filter(identifier__startswith="test:load").order_by("identifier").values_list(
+            "identifier", "title", "abstract", "keywords", "typename", "schema", "xml", "any_text",
+            "bounding_box", "crs"))
+
+    def export(self, *args):
+        directory = tempfile.mkdtemp()
+        call_command("pycsw", "export", directory, *args, stdout=StringIO())
+        files = {}
+        for name in os.listdir(directory):
+            with open(os.path.join(directory, name)) as f:
+                files[name] = f.read()
+        shutil.rmtree(directory)
+        return files
+
+    def test_parallel_load_and_export(self):
+        """Test that the parallel load and export produce the same records and files as a single process
+        """
+        records = self.load("-w", "1")
+        self.assertEqual(len(records), 7)
+        files = self.export("-w", "1")
+        self.assertIn("load10.xml", files)
+
+        Record.objects.filter(identifier__startswith="test:load").delete()
+        #the records are written in several batches
+        self.assertEqual(self.load("-w", "2", "--batch-size", "3"), records)
+        self.assertEqual(self.export("-w", "2"), files)
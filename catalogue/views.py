@@ -1,23 +1,24 @@
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse, Http404
+from django.conf import settings
 from django.views.generic import View
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from django.utils.decorators import method_decorator
 from django.core.urlresolvers import reverse
 from django.contrib.sites.shortcuts import get_current_site
 from lxml import etree
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.types import Integer
-from sqlalchemy.schema import Column
-from sqlalchemy import inspection,log
-from sqlalchemy import util as sqlalchemy_util
-from sqlalchemy.sql import util as sql_util
-from sqlalchemy.orm.mapper import Mapper as BaseMapper
+from sqlalchemy.exc import NoSuchTableError
 from pycsw.server import Csw as PyCsw
-from itertools import chain
-from .models import Application
 
-from .pycswsettings import build_pycsw_settings
+from oim_cms.compression import accepted_encoding, set_content_encoding
+
+from .pycswsettings import build_pycsw_settings, get_settings_version
+from .repository import repository_pool, dataset_registry
+from .cache import csw_response_cache, catalogue_etag, catalogue_last_modified
+from .fragments import (renderer, get_fragment, load_fragment, OUTPUT_SCHEMAS, ELEMENT_SETS,
+                        CSW_NAMESPACE, GMD_NAMESPACE)
+from .models import Record, Application
 
 import logging
 import traceback
@@ -28,10 +29,47 @@ from pycsw.server import write_boundingbox
 logger = logging.getLogger(__name__)
 
 class Csw(PyCsw):
+    #use the precomputed record fragments if possible
+    use_fragments = True
+
+    def __init__(self, *args, **kwargs):
+        super(Csw, self).__init__(*args, **kwargs)
+        #the stored fragments are only used if they are rendered with the current settings
+        self.settings_version = get_settings_version()
+        profile = self.profiles["loaded"].get(GMD_NAMESPACE) if self.profiles else None
+        if profile:
+            #serialize gmd:MD_Metadata from the precomputed fragments if possible
+            write_record = profile.write_record
+            def _write_record(result, esn, outputschema, queryables, caps=None):
+                if caps is None:
+                    element = self._get_fragment(result, GMD_NAMESPACE, esn, queryables)
+                    if element is not None:
+                        return element
+                return write_record(result, esn, outputschema, queryables, caps)
+            profile.write_record = _write_record
+
+    def _get_fragment(self, recobj, outputschema, elementsetname, queryables):
+        """
+        Return the record's precomputed fragment as element; return None if not available.
+        The fragments are rendered with the original mappings, they can't be used if the mappings are transformed.
+        """
+        if not self.use_fragments or elementsetname not in ELEMENT_SETS:
+            return None
+        default_queryables = getattr(self.repository, "_default_queryables", None)
+        if not default_queryables or queryables != default_queryables["_all"]:
+            return None
+        fragment = load_fragment(getattr(recobj, "fragments", None), outputschema, elementsetname, self.settings_version)
+        return etree.fromstring(fragment, self.context.parser) if fragment else None
+
     def _write_record(self, recobj, queryables):
         ''' replicate from original method.
            Only changes is the column separator in links is "\t" instead of ","
         '''
+        if not ('elementname' in self.kvp and len(self.kvp['elementname']) > 0):
+            record = self._get_fragment(recobj, CSW_NAMESPACE, self.kvp['elementsetname'], queryables)
+            if record is not None:
+                return record
+
         if self.kvp['elementsetname'] == 'brief':
             elname = 'BriefRecord'
         elif self.kvp['elementsetname'] == 'summary':
@@ -134,62 +172,75 @@ class Csw(PyCsw):
                 record.append(bboxel)
         return record
 
-@inspection._self_inspects
-@log.class_logger
-class Mapper(BaseMapper):
-    def _configure_pks(self):
-        self.tables = sql_util.find_tables(self.mapped_table)
-
-        self._pks_by_table = {}
-        self._cols_by_table = {}
-
-        all_cols = sqlalchemy_util.column_set(chain(*[col.proxy_set for col in self._columntoproperty]))
-
-        pk_cols = sqlalchemy_util.column_set(c for c in all_cols if c.primary_key)
-        # identify primary key columns which are also mapped by this mapper.
-        tables = set(self.tables + [self.mapped_table])
-        self._all_tables.update(tables)
-        self._cols_by_table[self.mapped_table] = all_cols
-        primary_key = [c for c in all_cols if c.name in self._primary_key_argument]
-        self._pks_by_table[self.mapped_table] = primary_key
-
-        self.primary_key = tuple(primary_key)
-        self._log("Identified primary key columns: %s", primary_key)
-
-        # determine cols that aren't expressed within our tables; mark these
-        # as "read only" properties which are refreshed upon INSERT/UPDATE
-        self._readonly_props = set(
-            self._columntoproperty[col]
-            for col in self._columntoproperty
-            if self._columntoproperty[col] not in self._identity_key_props and
-            (not hasattr(col, 'table') or
-                col.table not in self._cols_by_table))
-
 class CswEndpoint(View):
-    application_records = {}
+    use_response_cache = True
+    use_fast_path = True
+    #the number of records loaded and written at a time by the streaming GetRecords responses
+    stream_chunk_size = getattr(settings, "CSW_STREAMING_CHUNK_SIZE", 100)
+
+    #answer the conditional requests with 304 before processing the request
+    @method_decorator(condition(etag_func=catalogue_etag, last_modified_func=catalogue_last_modified))
     def get(self, request,app=None):
+        kvp = self._normalize_params(request.GET)
+        cache_key = csw_response_cache.get_key(app or "all", kvp) if self.use_response_cache else None
+        if cache_key:
+            response, encoding = csw_response_cache.get(cache_key, accepted_encoding(request))
+            if response is not None:
+                response = HttpResponse(response, content_type="application/xml")
+                if encoding:
+                    set_content_encoding(response, encoding)
+                response["X-csw-cache-hit"] = "success"
+                return response
+
+        if self.use_fast_path:
+            response = self._get_record_by_id(app or "all", kvp)
+            if response is not None:
+                if cache_key:
+                    csw_response_cache.set(cache_key, response)
+                return HttpResponse(response, content_type="application/xml")
+
+            #the streaming responses are not cached
+            response = self._get_records(app or "all", kvp)
+            if response is not None:
+                return response
+
         pycsw_settings = build_pycsw_settings(app)
         server = Csw(rtconfig=pycsw_settings, env=request.META.copy())
         if not app:
             app = "all"
         #request by named app, use app related view
-        record_table = Application.get_view_name(app)
         try:
-            if not self.application_records.get(app,None):
-                base = declarative_base(bind=server.repository.engine,mapper=Mapper)
-                self.application_records[app] = type('dataset', (base,),
-                        dict(__tablename__=record_table,__table_args__={'autoload': True,'schema': None},__mapper_args__={"primary_key":["id"]}))
-            server.repository.dataset = self.application_records[app]
+            server.repository.dataset = dataset_registry.get(server.repository.engine, app)
+        except NoSuchTableError:
+            repository_pool.release(getattr(server, "repository", None))
+            raise Http404("Application({}) does not exist.".format(app))
         except:
-            pass
+            repository_pool.release(getattr(server, "repository", None))
+            raise
 
         server.request = "http://{}{}".format(get_current_site(request),
                                               reverse("csw_endpoint"))
         server.requesttype = request.method
-        server.kvp = self._normalize_params(request.GET)
-        response = server.dispatch()
+        server.kvp = kvp
+        try:
+            response = server.dispatch()
+        finally:
+            repository_pool.release(getattr(server, "repository", None))
+        if cache_key and not self._is_exception(server):
+            #the exception report may be caused by a transient error, don't cache it
+            csw_response_cache.set(cache_key, response)
         return HttpResponse(response, content_type="application/xml")
 
+    @staticmethod
+    def _is_exception(server):
+        """
+        Return True if pycsw responded with an ows:ExceptionReport
+        """
+        if getattr(server, "exception", False):
+            return True
+        root = getattr(server, "response", None)
+        return getattr(root, "tag", None) == "{http://www.opengis.net/ows}ExceptionReport"
+
     @method_decorator(csrf_exempt)
     def dispatch(self, request, *args, **kwargs):
         return super(CswEndpoint, self).dispatch(request, *args, **kwargs)
@@ -201,10 +252,115 @@ class CswEndpoint(View):
         logger.info(request.body)
         server.request = request.body
         server.requesttype = request.method
-        status_code, response = server.dispatch()
+        try:
+            status_code, response = server.dispatch()
+        finally:
+            repository_pool.release(getattr(server, "repository", None))
         return HttpResponse(response, status=status_code,
                             content_type="application/xml")
 
+    def _get_record_by_id(self, app, kvp):
+        """
+        Serve the simple GetRecordById requests from the precomputed record fragments without pycsw.
+        Return None if the request is not supported; the request should be processed by pycsw.
+        """
+        if (kvp.get("service") != "CSW" or kvp.get("version") != "2.0.2" or
+                kvp.get("request") != "GetRecordById" or not kvp.get("id")):
+            return None
+        if any(k in kvp for k in ("elementname", "mode", "responsehandler")):
+            return None
+        if kvp.get("outputformat", "application/xml") != "application/xml":
+            return None
+        outputschema = kvp.get("outputschema", CSW_NAMESPACE)
+        elementsetname = kvp.get("elementsetname", "summary")
+        if outputschema not in OUTPUT_SCHEMAS or elementsetname not in ELEMENT_SETS:
+            return None
+        if build_pycsw_settings(None if app == "all" else app)["repository"].get("filter"):
+            #repository filter is a sql where clause, leave it to pycsw
+            return None
+
+        ids = [i for i in kvp["id"].split(",") if i]
+        records = Record.objects.filter(identifier__in=ids, active=True)
+        if app != "all":
+            if not Application.objects.filter(name=app).exists():
+                return None
+            records = records.filter(applicationlayer__application__name=app).order_by("applicationlayer__order", "identifier")
+
+        records = list(records)
+        if outputschema == CSW_NAMESPACE and any(record.typename not in ("", "csw:Record") for record in records):
+            #pycsw transforms the mappings for profile records
+            return None
+        version = get_settings_version()
+        fragments = [get_fragment(record, outputschema, elementsetname, version) for record in records]
+        return renderer.write_response("csw:GetRecordByIdResponse", fragments)
+
+    def _get_records(self, app, kvp):
+        """
+        Stream the results of the simple GetRecords requests from the precomputed record fragments without pycsw.
+        The envelope is written first, then the records are loaded and written in chunks,
+        so the memory used by a response doesn't depend on maxrecords.
+        Return None if the request is not supported; the request should be processed by pycsw.
+        """
+        if (kvp.get("service") != "CSW" or kvp.get("version") != "2.0.2" or
+                kvp.get("request") != "GetRecords" or kvp.get("resulttype") != "results"):
+            return None
+        if any(k in kvp for k in ("elementname", "constraint", "bbox", "q", "time", "sortby",
+                                  "distributedsearch", "responsehandler", "requestid")):
+            return None
+        if kvp.get("outputformat", "application/xml") != "application/xml" or kvp.get("typenames") != "csw:Record":
+            return None
+        outputschema = kvp.get("outputschema", CSW_NAMESPACE)
+        elementsetname = kvp.get("elementsetname")
+        if outputschema not in OUTPUT_SCHEMAS or elementsetname not in ELEMENT_SETS:
+            return None
+        pycsw_settings = build_pycsw_settings(None if app == "all" else app)
+        if pycsw_settings["repository"].get("filter"):
+            #repository filter is a sql where clause, leave it to pycsw
+            return None
+        try:
+            startposition = int(kvp.get("startposition", 1))
+            maxrecords = int(kvp.get("maxrecords", pycsw_settings["server"].get("maxrecords", 10)))
+        except ValueError:
+            return None
+        if startposition < 1 or maxrecords < 0:
+            return None
+        #the records can't be more than the configured max records
+        maxrecords = min(maxrecords, int(pycsw_settings["server"].get("maxrecords", maxrecords)))
+
+        records = Record.objects.filter(active=True)
+        if app != "all":
+            if not Application.objects.filter(name=app).exists():
+                return None
+            records = records.filter(applicationlayer__application__name=app).order_by("applicationlayer__order", "identifier", "id")
+        else:
+            records = records.order_by("identifier", "id")
+
+        #the keys of the page and the number of the matched records are got by one query from the same snapshot,
+        #the records are loaded by the keys in chunks, so the changes during streaming don't duplicate or drop records
+        offset = startposition - 1
+        page = list(records.extra(select={"matched": "count(*) OVER ()"})
+                    .values_list("pk", "matched", "typename")[offset:offset + maxrecords]) if maxrecords else []
+        if outputschema == CSW_NAMESPACE and any(typename not in ("", "csw:Record") for _, _, typename in page):
+            #pycsw transforms the mappings for profile records
+            return None
+        matched = page[0][1] if page else records.count()
+        pks = [pk for pk, _, _ in page]
+        returned = len(pks)
+        nextrecord = startposition + maxrecords if returned and startposition + maxrecords <= matched else 0
+        head, tail = renderer.getrecords_envelope(matched, returned, nextrecord, outputschema, elementsetname)
+        version = get_settings_version()
+
+        def stream():
+            yield head
+            for start in xrange(0, returned, self.stream_chunk_size):
+                chunk_pks = pks[start:start + self.stream_chunk_size]
+                chunk = Record.objects.in_bulk(chunk_pks)
+                yield renderer.encode([get_fragment(chunk[pk], outputschema, elementsetname, version)
+                                       for pk in chunk_pks if pk in chunk])
+            yield tail
+
+        return StreamingHttpResponse(stream(), content_type="application/xml")
+
     # TODO - Remove this method once pycsw mainlines the pending pull request
     def _normalize_params(self, query_dict):
         """
@@ -0,0 +1,122 @@
+"""
+Response compression negotiated by the Accept-Encoding header
+
+The CSW endpoint and the apis return verbose XML and JSON documents, which are
+compressed with gzip or deflate if the client accepts them.
+"""
+import re
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+ENCODINGS = ("gzip", "deflate")
+
+COMPRESSION_LEVEL = getattr(settings, "RESPONSE_COMPRESSION_LEVEL", 6)
+#it's not worth compressing the short responses
+COMPRESSION_MIN_SIZE = getattr(settings, "RESPONSE_COMPRESSION_MIN_SIZE", 200)
+compressed_paths = [re.compile(p) for p in getattr(settings, "COMPRESSED_RESPONSE_PATHS", [])]
+
+
+def accepted_encoding(request):
+    """
+    Return the preferred encoding ('gzip' or 'deflate') accepted by the request; return None if none is accepted.
+    """
+    accepted = {}
+    for item in request.META.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        params = [p.strip() for p in item.split(";")]
+        name = params[0].lower()
+        quality = 1.0
+        for param in params[1:]:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0
+        if name in ENCODINGS or name == "*":
+            accepted[name] = quality
+    candidates = [(accepted.get(e, accepted.get("*", 0)), -i, e) for i, e in enumerate(ENCODINGS)]
+    quality, order, encoding = max(candidates)
+    return encoding if quality > 0 else None
+
+
+def _compressor(encoding, level=None):
+    level = level or COMPRESSION_LEVEL
+    if encoding == "gzip":
+        #the gzip header has no timestamp, the same data is always compressed to the same bytes
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        #the http deflate encoding is the zlib format
+        return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
+    raise ValueError("Unsupported encoding '{}'".format(encoding))
+
+
+def compress(data, encoding, level=None):
+    """
+    Return the data compressed with the encoding
+    """
+    compressor = _compressor(encoding, level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_sequence(sequence, encoding, level=None):
+    """
+    Compress the streaming content with the encoding.
+    Each item is flushed, so the client gets the data as soon as it is produced.
+    """
+    compressor = _compressor(encoding, level)
+    for item in sequence:
+        data = compressor.compress(item) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def set_content_encoding(response, encoding):
+    """
+    Set the headers of a response whose content is compressed with the encoding
+    """
+    response["Content-Encoding"] = encoding
+    if not response.streaming:
+        response["Content-Length"] = str(len(response.content))
+
+
+def weaken_etag(response):
+    etag = response.get("ETag")
+    if etag and not etag.startswith("W/"):
+        #the compressed content is semantically equivalent, a weak etag still matches the conditional requests
+        response["ETag"] = "W/{}".format(etag)
+
+
+class CompressionMiddleware(object):
+    """
+    Compress the responses of the paths configured in COMPRESSED_RESPONSE_PATHS with gzip or deflate.
+    The responses which have a Content-Encoding already, for example the cached compressed responses, are not changed.
+    """
+    def process_response(self, request, response):
+        if not any(p.match(request.path) for p in compressed_paths):
+            return response
+        patch_vary_headers(response, ("Accept-Encoding",))
+        if response.has_header("Content-Encoding"):
+            if response["Content-Encoding"] in ENCODINGS:
+                #compressed by the view, the etag is set by the view decorators after the content is compressed
+                weaken_etag(response)
+            return response
+        if not response.streaming and len(response.content) < COMPRESSION_MIN_SIZE:
+            return response
+        encoding = accepted_encoding(request)
+        if not encoding:
+            return response
+
+        if response.streaming:
+            #the compressed size is unknown until the content is streamed
+            response.streaming_content = compress_sequence(response.streaming_content, encoding)
+            del response["Content-Length"]
+        else:
+            content = compress(response.content, encoding)
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+        set_content_encoding(response, encoding)
+        weaken_etag(response)
+        return response
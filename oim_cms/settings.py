@@ -133,6 +133,7 @@ SESSION_COOKIE_SECURE = env('SESSION_COOKIE_SECURE', False)
 CSRF_COOKIE_SECURE = env('CSRF_COOKIE_SECURE', False)
 CACHES = {'default': cache.config()}
 MIDDLEWARE_CLASSES = (
+    'oim_cms.compression.CompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -216,6 +217,23 @@ FRESHDESK_ENDPOINT = env('FRESHDESK_ENDPOINT', None)
 FRESHDESK_AUTH = (env('FRESHDESK_KEY'), 'X')
 POSTGREST_ROLE = env('POSTGREST_ROLE', 'postgrest')
 POSTGREST_BINARY = env('POSTGREST_BINARY', '/usr/local/bin/postgrest')
+# Maximum number of idle pycsw repositories kept by each worker process
+CSW_REPOSITORY_POOL_SIZE = env('CSW_REPOSITORY_POOL_SIZE', 8)
+# Maximum number of reflected catalogue application views kept by each worker process
+CSW_DATASET_REGISTRY_SIZE = env('CSW_DATASET_REGISTRY_SIZE', 100)
+# Timeout (seconds) and maximum size (bytes) of the cached CSW responses
+CSW_RESPONSE_CACHE_TIMEOUT = env('CSW_RESPONSE_CACHE_TIMEOUT', 3600)
+CSW_RESPONSE_CACHE_MAX_SIZE = env('CSW_RESPONSE_CACHE_MAX_SIZE', 2 * 1024 * 1024)
+# Back the catalogue application record views with materialized views, the applications should be saved again after it is changed
+CSW_MATERIALIZED_APPLICATION_VIEWS = env('CSW_MATERIALIZED_APPLICATION_VIEWS', False)
+# The number of records loaded and written at a time by the streaming CSW GetRecords responses
+CSW_STREAMING_CHUNK_SIZE = env('CSW_STREAMING_CHUNK_SIZE', 100)
+# Compress the responses of these paths with gzip or deflate if the client accepts them
+COMPRESSED_RESPONSE_PATHS = [r'^/catalogue/', r'^/api/']
+RESPONSE_COMPRESSION_LEVEL = env('RESPONSE_COMPRESSION_LEVEL', 6)
+RESPONSE_COMPRESSION_MIN_SIZE = env('RESPONSE_COMPRESSION_MIN_SIZE', 200)
+# The extra proj4 definitions of the epsg codes which are not in pyproj's database, an index is cached in the same folder
+EPSG_EXTRA_FILE = env('EPSG_EXTRA_FILE', os.path.join(BASE_DIR, 'catalogue', 'data', 'epsg'))
 
 # Email settings
 EMAIL_HOST = env('EMAIL_HOST', None)
@@ -4,6 +4,7 @@ import json
 from mixer.backend.django import mixer
 import random
 import string
+import zlib
 
 from organisation.models import DepartmentUser, Location, OrgUnit, CostCentre
 from registers.models import ITSystem
@@ -206,6 +207,17 @@ class DepartmentUserResourceTestCase(ApiTestCase):
         # Division 1 won't be present in the response.
         self.assertNotContains(response, self.div1.name)
 
+    def test_compressed_user_list(self):
+        """Test that the DepartmentUserResource list response is compressed if the client accepts it
+        """
+        url = '/api/users/'
+        response = self.client.get(url)
+        for encoding, wbits in (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS)):
+            compressed = self.client.get(url, HTTP_ACCEPT_ENCODING=encoding)
+            self.assertEqual(compressed['Content-Encoding'], encoding)
+            self.assertIn('Accept-Encoding', compressed['Vary'])
+            self.assertEqual(json.loads(zlib.decompress(compressed.content, wbits)), json.loads(response.content))
+
 
 class LocationResourceTestCase(ApiTestCase):
 
@@ -10,3 +10,11 @@ confy.read_environment_file(".env")
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "oim_cms.settings")
 application = get_wsgi_application()
+
+# Reflect the catalogue application views before serving requests.
+try:
+    from catalogue.repository import prewarm
+    prewarm()
+except Exception:
+    import logging
+    logging.getLogger(__name__).exception("Prewarm the catalogue application views failed.")